@@ -10,16 +10,123 @@
 
 # Load config or inputs manually
 CmdName=$(basename "$0")
-Syntax="${CmdName} [-c config][-a ASLZip][-m M0Zip][-s SubjectID][-j JSON][-v][-n][-l]"
+Syntax="${CmdName} [-c config][-a ASLZip][-m M0Zip][-s SubjectID][-j JSON][-w WorkDir][-o OutputDir][-t StdDir][-v][-n][-l]"
 function sys {
     [ -n "${opt_n}${opt_v}" ] && echo "$@" 1>&2
     [ -n "$opt_n" ] || "$@"
 }
 
-while getopts a:c:i:m:s:nvl arg
+# Helper functions and tools that shell-function stages run besides the function itself
+declare -A stage_code=([registration]="ants_to_template transform_store ${ANTSPATH:+${ANTSPATH}/}antsRegistration")
+
+# Run a stage through the content-addressed stage cache (workflows/stage_cache.py)
+# Usage: cached_stage <name> "<inputs>" "<outputs>" <command...>
+# The key covers the content of the inputs, the command line (without the run-specific
+# directories) and the code that runs: the workflow script of a py_step and the modules it
+# imports, the version of an external tool, or a shell function with what stage_code lists.
+# A re-run restores every unchanged stage and resumes at the first one whose key changed.
+# Outputs may be glob patterns. Set ASLSCP_NO_CACHE=1 to bypass.
+function cached_stage {
+    local name="$1" inputs="$2" outputs="$3"
+    shift 3
+    if [ -n "$ASLSCP_NO_CACHE" ]; then
+        timed "$name" "$@"
+        return $?
+    fi
+    local params="${*//${workdir}/}"
+    params="${params//${export_dir}/}"
+    params="${params//${exe_dir}/}"
+    params="${params//${std}/}"
+    local tools=() funcs=() code="" t
+    if [ "$1" = py_step ]; then
+        tools=("$2")
+    elif [ "$(type -t "$1")" = function ]; then
+        funcs=("$1")
+        for t in ${stage_code[$name]}; do
+            if [ "$(type -t "$t")" = function ]; then funcs+=("$t"); else tools+=("$t"); fi
+        done
+        code="$(declare -f "${funcs[@]}")"
+    else
+        tools=("$1")
+    fi
+    local key
+    key=$(python3 ${exe_dir}/stage_cache.py key -name "$name" -params "$params" -tools "${tools[@]}" -code "$code" -in $inputs) || { "$@"; return $?; }
+    local -
+    set -f
+    if python3 ${exe_dir}/stage_cache.py restore -name "$name" -key "$key" -out $outputs; then
+        echo "Stage ${name}: restored from cache (${key:0:12})"
+        return 0
+    fi
+    # Remove old outputs, so an output the stage does not write is never stored from an earlier run
+    set +f
+    rm -f $outputs
+    set -f
+    timed "$name" "$@" || return $?
+    python3 ${exe_dir}/stage_cache.py store -name "$name" -key "$key" -out $outputs
+}
+
+# Run an external tool and append its wall time, CPU, peak RSS and bytes read/written to the
+# trace (workflows/timings.py). Usage: timed <stage> <command...>
+# Shell functions such as py_step trace themselves and are run as is.
+# The tool gets the thread budget of its stage (stage_threads, from workflows/threads.py), 1 by default.
+function timed {
+    local stage="$1"
+    shift
+    local n=${stage_threads[$stage]:-1}
+    if [ -z "$ASLSCP_TRACE" ] || [ "$(type -t "$1")" = function ]; then
+        OMP_NUM_THREADS=$n MKL_NUM_THREADS=$n OPENBLAS_NUM_THREADS=$n ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=$n "$@"
+        return $?
+    fi
+    OMP_NUM_THREADS=$n MKL_NUM_THREADS=$n OPENBLAS_NUM_THREADS=$n ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=$n \
+        python3 ${exe_dir}/timings.py run -stage "$stage" -- "$@"
+}
+
+# Run a Python workflow step inside the long-lived orchestrator (workflows/orchestrator.py),
+# which keeps modules imported and images in memory between steps.
+# Usage: py_step <step> <args...>. Falls back to a fresh interpreter if the orchestrator is not running.
+function py_step {
+    local step="$1"
+    shift
+    if [ -n "$orch_pid" ] && kill -0 "$orch_pid" 2>/dev/null; then
+        # One request per line: working directory, step, args, each ended by the ASCII unit separator
+        { printf '%s\x1f' "$PWD" "$step" "$@"; printf '\n'; } >&${orch_req_fd}
+        local status=""
+        until read -r -t 5 status <&${orch_rep_fd}; do
+            kill -0 "$orch_pid" 2>/dev/null || { echo "Orchestrator exited during ${step}"; orch_pid=""; return 1; }
+        done
+        return ${status:-1}
+    fi
+    timed "$step" python3 ${exe_dir}/${step}.py "$@"
+}
+
+function start_orchestrator {
+    orch_dir="${workdir}/.orchestrator"
+    rm -rf "$orch_dir"
+    mkdir -p "$orch_dir"
+    mkfifo "${orch_dir}/requests" "${orch_dir}/replies" || return 1
+    # Read-write opens never block, and keep the FIFOs open for the whole run
+    exec {orch_req_fd}<>"${orch_dir}/requests"
+    exec {orch_rep_fd}<>"${orch_dir}/replies"
+    # Started with the whole budget so NumPy's BLAS can use it; each step is then limited to its own (threads.py)
+    OMP_NUM_THREADS=$ASLSCP_THREADS MKL_NUM_THREADS=$ASLSCP_THREADS OPENBLAS_NUM_THREADS=$ASLSCP_THREADS \
+        python3 ${exe_dir}/orchestrator.py serve -fifo "$orch_dir" {orch_req_fd}>&- {orch_rep_fd}>&- &
+    orch_pid=$!
+    trap stop_orchestrator EXIT
+}
+
+function stop_orchestrator {
+    [ -n "$orch_pid" ] || return 0
+    # Closing the request FIFO ends the orchestrator's loop
+    exec {orch_req_fd}>&- {orch_rep_fd}>&-
+    wait "$orch_pid" 2>/dev/null
+    orch_pid=""
+    rm -rf "$orch_dir"
+}
+
+while getopts a:c:i:j:m:o:s:t:w:nvl arg
 do
     case "$arg" in
-        a|c|j|m|n|s|v)
+        a|c|j|m|n|o|s|t|v|w)
                   eval "opt_${arg}='${OPTARG:=1}'" ;;
     esac
 done
@@ -65,17 +172,30 @@ flywheel="/flywheel/v0"
 data_dir="${flywheel}/input"
 [ -e "$data_dir" ] || mkdir "$data_dir"
 
-export_dir="${flywheel}/output"
-[ -e "$export_dir" ] || mkdir "$export_dir"
+# Output, work and atlas directories can be overridden so several sessions can run side by side
+if [ -n "$opt_o" ]; then
+	export_dir="$opt_o"
+else
+	export_dir="${flywheel}/output"
+fi
+[ -e "$export_dir" ] || mkdir -p "$export_dir"
 
-std="${data_dir}/std"
+if [ -n "$opt_t" ]; then
+	std="$opt_t"
+else
+	std="${data_dir}/std"
+fi
 [ -e "$std" ] || mkdir "$std"
 
 viz="${export_dir}/viz"
 [ -e "$viz" ] || mkdir "$viz"
 
-workdir="${flywheel}/work"
-[ -e "$workdir" ] || mkdir "$workdir"
+if [ -n "$opt_w" ]; then
+	workdir="$opt_w"
+else
+	workdir="${flywheel}/work"
+fi
+[ -e "$workdir" ] || mkdir -p "$workdir"
 
 m0_dcmdir="${workdir}/m0_dcmdir"
 [ -e "$m0_dcmdir" ] || mkdir "$m0_dcmdir"
@@ -86,92 +206,80 @@ asl_dcmdir="${workdir}/asl_dcmdir"
 stats="${export_dir}/stats"
 [ -e "$stats" ] || mkdir "$stats"
 
-exe_dir="${flywheel}/workflows"
-[ -e "$exe_dir" ] || mkdir "$exe_dir"
+exe_dir="$(dirname "$(readlink -f "$0")")/workflows"
+[ -e "$exe_dir" ] || exe_dir="${flywheel}/workflows"
+
+# Intermediates stay uncompressed (.nii): FSL reads them without gunzip and the Python steps
+# memory-map them. Only the deliverables are gzipped, on export. ASLSCP_COMPRESS_WORK=1 keeps .nii.gz work files.
+if [ -n "$ASLSCP_COMPRESS_WORK" ]; then
+    ext=".nii.gz"
+    export FSLOUTPUTTYPE=NIFTI_GZ
+else
+    ext=".nii"
+    export FSLOUTPUTTYPE=NIFTI
+fi
+export ASLSCP_WORK_EXT="$ext"
+
+# Trace every stage into the work directory, summarised into stats/timings.json at the end
+# Set ASLSCP_NO_TRACE=1 to turn it off
+if [ -z "$ASLSCP_NO_TRACE" ]; then
+    export ASLSCP_TRACE="${workdir}/timings.jsonl"
+    : > "$ASLSCP_TRACE"
+fi
+
+# Thread budget from the cgroup CPU quota (ASLSCP_THREADS overrides it): registration, synthstrip and the
+# multi-delay fit get all of it, the light stages one thread each (see workflows/threads.py)
+eval "$(python3 ${exe_dir}/threads.py plan)"
+export OMP_NUM_THREADS=1 MKL_NUM_THREADS=1 OPENBLAS_NUM_THREADS=1 ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=1
+echo "Thread budget: ${ASLSCP_THREADS}"
+
+start_orchestrator
 
 if [ $ge_data == TRUE ]; then
     ## add GE processing here
     echo "GE processing"
 else
     ### Get information about the scan
-    touch ${workdir}/metadata.txt
-
-    python3 ${exe_dir}/flywheel_context.py
+    # Metadata may already be provided (e.g. by the batch driver), only query Flywheel otherwise
+    if [ ! -s "${workdir}/metadata.txt" ]; then
+        touch ${workdir}/metadata.txt
+        py_step flywheel_context -workdir ${workdir}
+    fi
 
     # Check if metadata was created successfully
     if [ ! -f "${workdir}/metadata.txt" ]; then
         echo "ERROR: Failed to generate metadata file"
     fi
 
-    # Source the metadata for use in bash (parse JSON)
+    # metadata.txt is shown in output.pdf, metadata.json has the same fields for scripts
     METADATA_FILE="${workdir}/metadata.txt"
     echo "Metadata file created at: $METADATA_FILE"
 
     ### Data Preprocessing
-    # Check if the data is a zip file
-    # Unzip if so
-
-    if file "$asl_zip" | grep -q 'Zip archive data'; then
-	    unzip -d "$asl_dcmdir" "$asl_zip"  
-	    dcm2niix -f %d -b y -o ${asl_dcmdir}/ "$asl_dcmdir"
-    else
-	    cp -r "$asl_zip" ${asl_dcmdir}/
-	    dcm2niix -f %d -b y -o ${asl_dcmdir}/ "$asl_zip"
-    fi
-
-    if file "$m0_zip" | grep -q 'Zip archive data'; then
-	    unzip -d "$m0_dcmdir" "$m0_zip"
-	    dcm2niix -f %d -b y -o ${m0_dcmdir}/ "$m0_dcmdir"
-    else
-	    cp -r "$m0_zip" ${m0_dcmdir}/
-	    dcm2niix -f %d -b y -o ${m0_dcmdir}/ "$m0_zip"
-    fi
-
-    # Dcm2niix doesn't always work first try, so check and redo if files aren't present
-
-    attempt=1
-    max_attempt=2
-
-    # Loop until both files are found or max attempts are reached
-    while (( attempt <= max_attempt )); do
-        echo "Attempt $attempt of $max_attempts..."
-
-        # Use find to locate the files
-        asl_file=$(find "$asl_dcmdir" -maxdepth 1 -type f -name "*ASL.nii")
-        m0_file=$(find "$m0_dcmdir" -maxdepth 1 -type f -name "*M0.nii")
-
-        # Debugging output
-        echo "ASL file: $asl_file"
-        echo "M0 file: $m0_file"
-
-        if [[ -n "$asl_file" && -n "$m0_file" ]]; then
-            echo "Both files found: $asl_file and $m0_file"
-            break  # Exit the loop
+    # The DICOMs are read straight from the input zip (or folder), grouped by series and written as
+    # <series description>.nii/.json (workflows/dicom_ingest.py). dcm2niix only converts what the
+    # ingest does not handle (e.g. mosaic or compressed images).
+    function ingest_dicom {
+        local name="$1" src="$2" out="$3"
+        cached_stage dicom_ingest_${name} "$src" "${out}/*.nii ${out}/*.json" py_step dicom_ingest -in "$src" -out "$out" && return 0
+        echo "DICOM ingest of ${src} failed, converting with dcm2niix"
+        if file "$src" | grep -q 'Zip archive data'; then
+            timed unzip_${name} unzip -o -q -d "$out" "$src"
+            timed dcm2niix_${name} dcm2niix -f %d -b y -o "$out"/ "$out"
         else
-            if (( attempt < max_attempt )); then
-                echo "Files missing. Retrying..."
-                for dir_name in ${asl_zip} ${m0_zip}
-                    do
-                    dcm2niix -f %d -b y -o ${workdir}/ ${dir_name}/
-                done
-
-            else
-                echo "Files still missing after $max_attempts attempts. Exiting."
-                exit 1  # Exit with error code
-            fi
+            timed dcm2niix_${name} dcm2niix -f %d -b y -o "$out"/ "$src"
         fi
-        (( attempt++ ))
-        sleep 5  # Optional: Wait a few seconds before retrying
-    done
-
-    # Extract dicom header info to get parameters for cbf calculation
-    # Exception so that any type of file can be taken in
-    dcm_file=$(find "${m0_dcmdir}" -type f ! -name "*.nii" ! -name "*.nii.gz" ! -name "*.json" | head -n 1)
-
-    # If the dicoms are not there or cannot be found, exit
-    if [ -z "$dcm_file" ]; then
-	    echo "No dicom file!"
-	    exit 1
+    }
+    ingest_dicom asl "$asl_zip" "$asl_dcmdir"
+    ingest_dicom m0 "$m0_zip" "$m0_dcmdir"
+
+    asl_file=$(find "$asl_dcmdir" -maxdepth 1 -type f -name "*ASL.nii" | sort | head -n 1)
+    m0_file=$(find "$m0_dcmdir" -maxdepth 1 -type f -name "*M0.nii" | sort | head -n 1)
+    echo "ASL file: $asl_file"
+    echo "M0 file: $m0_file"
+    if [[ -z "$asl_file" || -z "$m0_file" ]]; then
+        echo "No *ASL.nii and *M0.nii series in the inputs. Exiting."
+        exit 1
     fi
 
     # Check optional variables in configs and convert "null" to empty string
@@ -203,14 +311,14 @@ else
         echo "m0_scale: ${m0_scale}"
     else
         echo "Extracting parameters from DICOM files."
-        echo $dcm_file
-        ld=$(iconv -f UTF-8 -t UTF-8//IGNORE "$dcm_file" | awk -F 'sWipMemBlock.alFree\\[0\\][[:space:]]*=[[:space:]]*' '{print $2}' | tr -d '[:space:]')
+        # One pass over the ASCCONV block of a few files of the M0 series, checked to agree
+        # and cached per series UID; writes ld=, pld=, nbs= and m0_scale= assignments
+        dicom_params="${workdir}/dicom_params.sh"
+        rm -f "$dicom_params"
+        py_step ascconv -dcm "$m0_zip" -out "$dicom_params" && . "$dicom_params"
         echo "ld: ${ld}"
-        pld=$(iconv -f UTF-8 -t UTF-8//IGNORE "$dcm_file" | awk -F 'sWipMemBlock.alFree\\[1\\][[:space:]]*=[[:space:]]*' '{print $2}' | tr -d '[:space:]')
         echo "pld: ${pld}"
-        nbs=$(iconv -f UTF-8 -t UTF-8//IGNORE "$dcm_file" | awk -F 'sWipMemBlock.alFree\\[11\\][[:space:]]*=[[:space:]]*' '{print $2}' | tr -d '[:space:]')
         echo "nbs: ${nbs}"
-        m0_scale=$(iconv -f UTF-8 -t UTF-8//IGNORE "$dcm_file" | awk -F 'sWipMemBlock.alFree\\[20\\][[:space:]]*=[[:space:]]*' '{print $2}' | tr -d '[:space:]')
         echo "m0_scale: ${m0_scale}"
     fi
 
@@ -220,37 +328,37 @@ else
     fi
 
     # Merge Data
-    fslmerge -t ${workdir}/all_data.nii.gz $m0_file $asl_file
+    timed fslmerge fslmerge -t ${workdir}/all_data${ext} $m0_file $asl_file
 
     # Motion correction
-    mcflirt -in ${workdir}/all_data.nii.gz -out ${workdir}/mc.nii.gz
+    cached_stage mcflirt "${workdir}/all_data${ext}" "${workdir}/mc${ext}" mcflirt -in ${workdir}/all_data${ext} -out ${workdir}/mc${ext}
 
     # Split the data back up after motion correction
-    fslroi ${workdir}/mc.nii.gz ${workdir}/m0_mc.nii.gz 0 1
-    fslroi ${workdir}/mc.nii.gz ${workdir}/m0_ir_mc.nii.gz 0 2
-    fslroi ${workdir}/mc.nii.gz ${workdir}/asl_mc.nii.gz 2 -1
+    timed fslroi fslroi ${workdir}/mc${ext} ${workdir}/m0_mc${ext} 0 1
+    timed fslroi fslroi ${workdir}/mc${ext} ${workdir}/m0_ir_mc${ext} 0 2
+    timed fslroi fslroi ${workdir}/mc${ext} ${workdir}/asl_mc${ext} 2 -1
 
     # Skull-Stripping
-    ${FREESURFER_HOME}/bin/mri_synthstrip -i ${workdir}/m0_mc.nii.gz -m ${workdir}/mask.nii.gz
+    cached_stage synthstrip "${workdir}/m0_mc${ext}" "${workdir}/mask${ext}" ${FREESURFER_HOME}/bin/mri_synthstrip -i ${workdir}/m0_mc${ext} -m ${workdir}/mask${ext}
 
     # Erode mask and use on CBF map
-    fslmaths ${workdir}/mask.nii.gz -ero ${workdir}/mask_ero.nii.gz
+    timed mask_erode fslmaths ${workdir}/mask${ext} -ero ${workdir}/mask_ero${ext}
 
-    # Merge all data then motion correction by running mcflirt
-    # If statment to check for nbs of 3 - this is from old data, should not come up for any protocol 2023 and on
+    # Label/control subtraction, temporal mean and tSNR in one streaming pass over the ASL series
+    # Data with nbs of 3 is from old protocols (none from 2023 on) and has the control first
     if [ "$nbs" == 3 ]; then
-        asl_file --data=${workdir}/asl_mc.nii.gz --ntis=1 --iaf=ct --diff --out=${workdir}/sub.nii.gz
         echo "nbs is 3, switching label and control"
     else
-        asl_file --data=${workdir}/asl_mc.nii.gz --ntis=1 --iaf=tc --diff --out=${workdir}/sub.nii.gz
         echo "nbs is greater than 3, no changes made to pipeline"
     fi
-
-    fslmaths ${workdir}/sub.nii.gz -Tmean ${workdir}/sub_av.nii.gz
+    cached_stage asl_subtract "${workdir}/asl_mc${ext}" "${workdir}/sub${ext} ${workdir}/sub_av${ext} ${workdir}/tSNR_map${ext}" \
+        py_step asl_subtract -asl ${workdir}/asl_mc${ext} -nbs $nbs -out ${workdir}
 
     ### Calculate CBF
-    python3 /flywheel/v0/workflows/cbf_calc.py -m0 ${workdir}/m0_mc.nii.gz -asl ${workdir}/sub_av.nii.gz -m ${workdir}/mask.nii.gz -ld $ld -pld $pld -nbs $nbs -scale $m0_scale -out ${workdir}
-    fslmaths ${workdir}/cbf.nii.gz -mas ${workdir}/mask_ero.nii.gz ${workdir}/cbf_mas.nii.gz
+    # CBF of every pair (cbf_pairs), averaged over the pairs SCORE does not reject as outliers, streamed in z-slabs;
+    # the kept and rejected pairs are listed in stats/cbf_score.json
+    cached_stage cbf_calc "${workdir}/m0_mc${ext} ${workdir}/sub${ext} ${workdir}/mask${ext}" "${workdir}/cbf${ext} ${workdir}/cbf_pairs${ext} ${stats}/cbf_score.json" \
+        py_step cbf_calc -m0 ${workdir}/m0_mc${ext} -asl ${workdir}/sub${ext} -m ${workdir}/mask${ext} -ld $ld -pld $pld -nbs $nbs -scale $m0_scale -out ${workdir} -score ${stats}/cbf_score.json -slab 16
 
     # Check what number is in the file name
     sidecar_json="${asl_file%.nii*}.json"      # works for .nii and .nii.gz
@@ -276,82 +384,88 @@ else
     if [ "$qt1_capable" = true ]; then
         echo "Version is greater than 22. Generating quantitative T1."
     # Fit T1 with function z. Skip this step for the recover project bc t1 data is messed up.
-        python3 /flywheel/v0/workflows/t1fit.py -m0_ir ${workdir}/m0_ir_mc.nii.gz -m ${workdir}/mask.nii.gz -out ${workdir} -stats ${stats}
+        cached_stage t1fit "${workdir}/m0_ir_mc${ext} ${workdir}/mask${ext}" "${workdir}/t1${ext} ${workdir}/m0${ext}" \
+            py_step t1fit -m0_ir ${workdir}/m0_ir_mc${ext} -m ${workdir}/mask${ext} -out ${workdir} -stats ${stats}
     else
         echo "Version is 22 or lower. Cannot generate quantitative T1."
     fi
 
     # Smoothing ASL image subject space, deforming images to match template
-    fslmaths ${workdir}/sub_av.nii.gz -s 1.5 -mas ${workdir}/mask.nii.gz ${workdir}/s_asl.nii.gz 
-    ${ANTSPATH}/antsRegistration --dimensionality 3 --transform "Affine[0.25]" --metric "MI[${std}/batsasl/bats_asl_masked.nii.gz,${workdir}/s_asl.nii.gz,1,32]" --convergence 100x20 --shrink-factors 4x1 --smoothing-sigmas 2x0mm --transform "SyN[0.1]" --metric "CC[${std}/batsasl/bats_asl_masked.nii.gz,${workdir}/s_asl.nii.gz,1,1]" --convergence 40x20 --shrink-factors 2x1 --smoothing-sigmas 2x0mm  --output "[${workdir}/ind2temp,${workdir}/ind2temp_warped.nii.gz,${workdir}/temp2ind_warped.nii.gz]" --collapse-output-transforms 1 --interpolation BSpline -v 1
+    timed smooth_asl fslmaths ${workdir}/sub_av${ext} -s 1.5 -mas ${workdir}/mask${ext} ${workdir}/s_asl${ext} 
+    template="${std}/batsasl/bats_asl_masked.nii.gz"
+
+    # Affine + SyN registration of s_asl to the template
+    # Usage: ants_to_template <affine convergence> <SyN convergence> [antsRegistration options...]
+    function ants_to_template {
+        local affine_conv="$1" syn_conv="$2"
+        shift 2
+        timed registration ${ANTSPATH}/antsRegistration --dimensionality 3 "$@" --transform "Affine[0.25]" --metric "MI[${template},${workdir}/s_asl${ext},1,32]" --convergence ${affine_conv} --shrink-factors 4x1 --smoothing-sigmas 2x0mm --transform "SyN[0.1]" --metric "CC[${template},${workdir}/s_asl${ext},1,1]" --convergence ${syn_conv} --shrink-factors 2x1 --smoothing-sigmas 2x0mm  --output "[${workdir}/ind2temp,${workdir}/ind2temp_warped${ext},${workdir}/temp2ind_warped${ext}]" --collapse-output-transforms 1 --interpolation BSpline -v 1
+    }
+
+    # A subject registered before starts from its stored affine (workflows/transform_store.py), composed
+    # with a quick rigid step from this session to the stored one, and runs shorter schedules. Initial
+    # transforms apply last-listed first: affine.mat maps the template to the stored session, sess2prior
+    # the stored session to this one. The full registration runs if there is no prior or the result
+    # matches the template worse than the subject's last full one. ASLSCP_NO_WARM_START=1 always runs
+    # the full registration.
+    function register_to_template {
+        local prior="${workdir}/prior_registration"
+        local store_args=(-metadata ${workdir}/metadata.txt -template ${template})
+        local save_args=(-affine ${workdir}/ind2temp0GenericAffine.mat -moving ${workdir}/s_asl${ext} -warped ${workdir}/ind2temp_warped${ext})
+        if [ -z "$ASLSCP_NO_WARM_START" ] && py_step transform_store lookup "${store_args[@]}" -out ${prior}; then
+            local prior_moving
+            prior_moving=$(ls ${prior}/moving.nii*)
+            if timed registration_rigid ${ANTSPATH}/antsRegistration --dimensionality 3 --transform "Rigid[0.1]" --metric "MI[${prior_moving},${workdir}/s_asl${ext},1,32]" --convergence 50x20 --shrink-factors 2x1 --smoothing-sigmas 1x0mm --output ${workdir}/sess2prior -v 1 \
+                && ants_to_template 30x10 15x10 --initial-moving-transform ${workdir}/sess2prior0GenericAffine.mat --initial-moving-transform ${prior}/affine.mat \
+                && py_step transform_store check "${store_args[@]}" -warped ${workdir}/ind2temp_warped${ext}; then
+                py_step transform_store save "${store_args[@]}" "${save_args[@]}"
+                return 0
+            fi
+            echo "Warm start did not succeed, running the full registration"
+        fi
+        ants_to_template 100x20 40x20 || return $?
+        py_step transform_store save "${store_args[@]}" "${save_args[@]}" -full
+        return 0
+    }
+
+    cached_stage registration "${workdir}/s_asl${ext} ${template}" \
+        "${workdir}/ind2temp0GenericAffine.mat ${workdir}/ind2temp1Warp.nii.gz ${workdir}/ind2temp1InverseWarp.nii.gz ${workdir}/ind2temp_warped${ext} ${workdir}/temp2ind_warped${ext}" \
+        register_to_template
     echo "ANTs Registration finished"
 
     # Warping atlases, deforming ROI
     # Standardize CBF images to a common template
-    # Removed --use-BSpline flag because we do not want to deform the ROIs
+    # Atlases use nearest neighbour because we do not want to deform the ROIs
     # Schaefer 2018 atlas is the 100 parcels 17 networks version
-    ${ANTSPATH}/WarpImageMultiTransform 3 ${std}/batsasl/bats_cbf.nii.gz ${workdir}/w_batscbf.nii.gz -R ${workdir}/sub_av.nii.gz -i ${workdir}/ind2temp0GenericAffine.mat ${workdir}/ind2temp1InverseWarp.nii.gz
     list=("arterial2" "cortical" "subcortical" "thalamus" "landau" "schaefer2018") ##list of ROIs
 
-    # Eroding some ROIs so that they are not touching the edges of the CBF map and not including incorrect CBF values
-    # deforming ROI
-    for str in "${list[@]}"
-    do
-        echo ${str}
-        touch ${stats}/tmp_${str}.txt
-        touch ${stats}/cbf_${str}.txt
-        touch ${stats}/${str}_vox.txt
-        echo "Printed ${stats}"
-        ${ANTSPATH}/WarpImageMultiTransform 3 ${std}/${str}.nii.gz ${workdir}/w_${str}.nii.gz -R ${workdir}/sub_av.nii.gz --use-NN -i ${workdir}/ind2temp0GenericAffine.mat ${workdir}/ind2temp1InverseWarp.nii.gz
-        fslmaths ${workdir}/w_${str}.nii.gz -mas ${workdir}/mask_ero.nii.gz ${workdir}/w_${str}_mas.nii.gz
-        fslstats -K ${workdir}/w_${str}_mas.nii.gz ${workdir}/cbf_mas.nii.gz -M -S > ${stats}/tmp_${str}.txt
-        fslstats -K ${workdir}/w_${str}_mas.nii.gz ${workdir}/cbf_mas.nii.gz -V > ${stats}/${str}_vox.txt
-        paste ${std}/${str}_label.txt -d ' ' ${stats}/tmp_${str}.txt ${stats}/${str}_vox.txt > ${stats}/cbf_${str}.txt #combine label with values
-    done
+    # The atlases and their label names come from one compiled, memory-mapped store
+    # (built into the image, this only checks it is up to date with ${std})
+    atlas_store="${ASLSCP_ATLAS_STORE:-${std}/atlas_store}"
+    py_step atlas_store build -std ${std} -out ${atlas_store}
 
-    # Original main processing loop with missing label filter
-    for str in "${list[@]}"
-        do
-        input_cbf="${stats}/cbf_${str}.txt"
-        output_cbf="${stats}/formatted_cbf_${str}.txt"
-        temp_dir="/flywheel/v0/work/temp_$(date +%s)"
-        mkdir -p "$temp_dir"
-
-        # Create temporary file with updated header
-        temp_file="$temp_dir/tmp_cbf_${str}.txt"
-        echo "Region | Mean CBF | Standard Deviation | Voxels | Volume" > "$temp_file"
-
-         while IFS= read -r line; do
-            [[ -z "$line" ]] && continue  # Skip empty lines
-
-            # Extract numeric values
-            mean_cbf=$(echo "$line" | awk '{print $(NF-3)}')
-            std_dev=$(echo "$line" | awk '{print $(NF-2)}')
-            voxels=$(echo "$line" | awk '{print $(NF-1)}')
-            volume=$(echo "$line" | awk '{print $NF}')
-
-            # Extract region name
-            region=$(echo "$line" | awk '{
-                for (i=1; i<=NF-4; i++)
-                printf "%s ", $i;
-            }' | sed 's/[[:space:]]$//')
-
-            # Skip lines with 'missing label' or bad entries
-            [[ -z "$region" || "$region" == "0" || "$region" == *"missing label"* || "$voxels" < "10" ]] && continue
-
-            # Format numeric values
-            formatted_mean=$(printf "%.1f" "$mean_cbf")
-            formatted_std=$(printf "%.1f" "$std_dev")
-            formatted_voxels=$(printf "%.1f" "$voxels")
-            formatted_volume=$(printf "%.1f" "$volume")
-
-            echo "$region | $formatted_mean | $formatted_std | $formatted_voxels | $formatted_volume" >> "$temp_file"
-        done < "$input_cbf"
-
-        # Format final output
-        column -t -s '|' -o '|' "$temp_file" > "$output_cbf"
-        rm -rf "$temp_dir"
-    done
+    # Template to subject (inverse warp): template CBF and every atlas
+    inverse_specs=("${std}/batsasl/bats_cbf.nii.gz:${workdir}/w_batscbf${ext}:linear")
+
+    # Subject to template (forward warp, deformation field smoothed by 5 mm): sub_av, CBF and qT1
+    #wt1: t1 relaxation time. common space.
+    forward_specs=("${workdir}/sub_av${ext}:${workdir}/s_ind2temp_warped${ext}:bspline" "${workdir}/cbf${ext}:${workdir}/wcbf${ext}:bspline")
+    if [ "$qt1_capable" = true ]; then
+        forward_specs+=("${workdir}/t1${ext}:${workdir}/wt1${ext}:bspline")
+    fi
+
+    # Each direction composes the affine and the warp into one sampling grid, applied to all images in one pass
+    py_step resample -affine ${workdir}/ind2temp0GenericAffine.mat \
+        -inverse_warp ${workdir}/ind2temp1InverseWarp.nii.gz -inverse_ref ${workdir}/sub_av${ext} -inverse "${inverse_specs[@]}" \
+        -atlas_store ${atlas_store} -atlases ${list[@]} -atlas_out ${workdir}/ \
+        -warp ${workdir}/ind2temp1Warp.nii.gz -warp_smooth 5 -forward_ref ${workdir}/ind2temp_warped${ext} -forward "${forward_specs[@]}"
+
+    # Mean, SD, voxels and volume for every label of every atlas in one pass
+    # Restricted to the eroded mask, writes the formatted_cbf_*.txt tables
+    # and weighted_rcbf.txt/weighted_table.txt for the composite regions of composite_rois.json,
+    # plus the same stats typed in stats.sqlite for cohort stores (stats_store.py merge)
+    py_step regional_stats -cbf ${workdir}/cbf${ext} -mask ${workdir}/mask_ero${ext} -seg_folder ${workdir}/ -seg ${list[@]} -atlas_store ${atlas_store} -out ${stats} \
+        -composites ${ASLSCP_COMPOSITES:-${exe_dir}/composite_rois.json} -db ${stats}/stats.sqlite -metadata ${workdir}/metadata.txt
 
     # Extract these regions to display as a general "AD" check
     target_regions=(
@@ -387,172 +501,48 @@ else
         done < "$source_file"
     done
 
-    # Calculate a weighted rCBF value
-    cortical="${stats}/formatted_cbf_cortical.txt"
-    subcortical="${stats}/formatted_cbf_subcortical.txt"
-    landau="${stats}/formatted_cbf_landau.txt"
-
-    pcc=$(grep "Cingulate_Gyrus,_posterior_division" "$cortical" | awk -F '|' '{print $2}' | xargs)
-    pcc_voxel=$(grep "Cingulate_Gyrus,_posterior_division" "$cortical" | awk -F '|' '{print $5}' | xargs)
-    precuneus=$(grep "Precuneous_Cortex" "$cortical" | awk -F '|' '{print $2}' | xargs)
-    precuneus_voxel=$(grep "Precuneous_Cortex" "$cortical" | awk -F '|' '{print $5}' | xargs)
-    hipp_left=$(grep "Left_Hippocampus" "$subcortical" | awk -F '|' '{print $2}' | xargs)
-    hipp_left_voxel=$(grep "Left_Hippocampus" "$subcortical" | awk -F '|' '{print $5}' | xargs)
-    hipp_right=$(grep "Right_Hippocampus" "$subcortical" | awk -F '|' '{print $2}' | xargs)
-    hipp_right_voxel=$(grep "Right_Hippocampus" "$subcortical" | awk -F '|' '{print $5}' | xargs)
-    grey_left=$(grep "Left_Cerebral_Cortex" "$subcortical" | awk -F '|' '{print $2}' | xargs)
-    grey_left_vox=$(grep "Left_Cerebral_Cortex" "$subcortical" | awk -F '|' '{print $5}' | xargs)
-    grey_right=$(grep "Right_Cerebral_Cortex" "$subcortical" | awk -F '|' '{print $2}' | xargs)
-    grey_right_vox=$(grep "Right_Cerebral_Cortex" "$subcortical" | awk -F '|' '{print $5}' | xargs)
-    white_left=$(grep "Left_Cerebral_White_Matter" "$subcortical" | awk -F '|' '{print $2}' | xargs)
-    white_left_vox=$(grep "Left_Cerebral_White_Matter" "$subcortical" | awk -F '|' '{print $5}' | xargs)
-    white_right=$(grep "Right_Cerebral_White_Matter" "$subcortical" | awk -F '|' '{print $2}' | xargs)
-    white_right_vox=$(grep "Right_Cerebral_White_Matter" "$subcortical" | awk -F '|' '{print $5}' | xargs)
-    putamen_left=$(grep "Left_Putamen" "$subcortical" | awk -F '|' '{print $2}' | xargs)
-    putamen_left_vox=$(grep "Left_Putamen" "$subcortical" | awk -F '|' '{print $5}' | xargs)
-    putamen_right=$(grep "Right_Putamen" "$subcortical" | awk -F '|' '{print $2}' | xargs)
-    putamen_right_vox=$(grep "Right_Putamen" "$subcortical" | awk -F '|' '{print $5}' | xargs)
-    landau_meta=$(grep "Landau_metaROI" "$landau" | awk -F '|' '{print $2}' | xargs)
-    landau_meta_vox=$(grep "Landau_metaROI" "$landau" | awk -F '|' '{print $5}' | xargs)
-
-    # Left and right grey matter
-    grey_matter_weighted=$(echo "scale=4; ($grey_left * $grey_left_vox + $grey_right * $grey_right_vox) / ($grey_left_vox + $grey_right_vox)" | bc -l)
-
-    # Left and right white matter
-    white_matter_weighted=$(echo "scale=4; ($white_left * $white_left_vox + $white_right * $white_right_vox) / ($white_left_vox + $white_right_vox)" | bc -l)
-
-    # Whole brain
-    whole_brain_weighted=$(echo "scale=4; ($grey_left * $grey_left_vox + $grey_right * $grey_right_vox + $white_left * $white_left_vox + $white_right * $white_right_vox) / ($grey_left_vox + $grey_right_vox + $white_left_vox + $white_right_vox)" | bc -l)
-    echo $whole_brain_weighted
-    # Left and right putamen
-    putamen_weighted=$(echo "scale=4; ($putamen_left * $putamen_left_vox + $putamen_right * $putamen_right_vox) / ($putamen_left_vox + $putamen_right_vox)" | bc -l)
-
-    # PCC+Precuneus calculation
-    pcc_precuneus_weighted=$(echo "scale=4; ($pcc * $pcc_voxel + $precuneus * $precuneus_voxel) / ($pcc_voxel + $precuneus_voxel)" | bc -l)
-
-    # Hippocampus calculation
-    hippocampus_weighted=$(echo "scale=4; ($hipp_left * $hipp_left_voxel + $hipp_right * $hipp_right_voxel) / ($hipp_left_voxel + $hipp_right_voxel)" | bc -l)
-
-    # Clear or create the output file
-    weighted_rcbf="${stats}/weighted_rcbf.txt"
-    : > $weighted_rcbf
-
-    # Overwrite or create the weighted_rCBF file in the same format as formatted_cbf_*.txt
-    echo "Region | CBF | Voxels" > $weighted_rcbf
-
-    # Whole brain
-    if [[ -n "$whole_brain_weighted" && "$whole_brain_weighted" =~ ^[0-9.]+$ ]]; then
-        whole_brain_vox=$(echo "scale=4; ($grey_left_vox + $grey_right_vox + $white_left_vox + $white_right_vox)" | bc -l)
-        echo "Whole brain | $whole_brain_weighted | $whole_brain_vox" >> $weighted_rcbf
-    else
-        echo "Whole brain CBF value is not a number"
-    fi
-
-    # Grey Matter
-    if [[ -n "$grey_matter_weighted" && "$grey_matter_weighted" =~ ^[0-9.]+$ ]]; then
-        grey_matter_vox=$(echo "$grey_right_vox + $grey_left_vox" | bc -l)
-        echo "Grey_Matter L+R | $grey_matter_weighted | $grey_matter_vox" >> $weighted_rcbf
-    else
-        echo "Grey_Matter_L+R value is not a number"
-    fi
-
-    # White Matter
-    if [[ -n "$white_matter_weighted" && "$white_matter_weighted" =~ ^[0-9.]+$ ]]; then
-        white_matter_vox=$(echo "$white_right_vox + $white_right_vox" | bc -l)
-        echo "White_Matter L+R | $white_matter_weighted | $white_matter_vox" >> $weighted_rcbf
-    else
-        echo "White_Matter_L+R value is not a number"
-    fi
-
-    # PCC+Precuneus row
-    if [[ -n "$pcc_precuneus_weighted" && "$pcc_precuneus_weighted" =~ ^[0-9.]+$ ]]; then
-        pcc_precuneus_vox=$(echo "$pcc_voxel + $precuneus_voxel" | bc -l)
-        echo "PCC+Precuneus | $pcc_precuneus_weighted | $pcc_precuneus_vox" >> $weighted_rcbf
-    else
-        echo "PCC+Precuneus value is not a number"
-    fi
-
-    # Hippocampus row
-    if [[ -n "$hippocampus_weighted" && "$hippocampus_weighted" =~ ^[0-9.]+$ ]]; then
-        hipp_vox=$(echo "$hipp_right_voxel + $hipp_left_voxel" | bc -l)
-        echo "Hippocampus L+R | $hippocampus_weighted | $hipp_vox" >> $weighted_rcbf
-    else
-        echo "Hippocampus_L+R value is not a number"
-    fi
-
-    cat $weighted_rcbf
-
-    # Calculate reference CBF values
-    wholebrain_cbf=$(sed -n 's/[^0-9]*\([0-9]\+\).*/\1/p; q' ${stats}/cbf_wholebrain.txt)
-
-    # Add ratio columns to extracted file
-    temp_file="${stats}/temp_ratio_calc.txt"
-    awk -F '|' -v put_cbf="$putamen_weighted" '
-    BEGIN {
-        OFS = " | "
-        print "Region | Mean | rCBF | Voxels"
-    }
-    {
-        # Skip empty lines
-        if (NF < 3 || $0 ~ /^Region/) next
-    
-        # Convert to numbers (handles any whitespace)
-        mean = $2 + 0
-        voxels = $3 + 0
-    
-        # Calculate rCBF putamen ratio
-        rCBF = (mean != 0) ? mean / put_cbf : "NA"
-    
-        printf "%s | %.0f | %.1f | %.0f\n", \
-            $1, mean, rCBF, voxels
-    }' "$weighted_rcbf" | column -t -s '|' -o '|' > "$temp_file"
-
-    weighted_table="${stats}/weighted_table.txt"
-    mv "$temp_file" "$weighted_table"
-
-    # Smoothing the deformation field of images obtained previously
-    fslmaths ${workdir}/ind2temp1Warp.nii.gz -s 5 ${workdir}/swarp.nii.gz
-    ${ANTSPATH}/WarpImageMultiTransform 3 ${workdir}/sub_av.nii.gz ${workdir}/s_ind2temp_warped.nii.gz -R ${workdir}/ind2temp_warped.nii.gz --use-BSpline ${workdir}/swarp.nii.gz ${workdir}/ind2temp0GenericAffine.mat
-    ${ANTSPATH}/WarpImageMultiTransform 3 ${workdir}/cbf.nii.gz ${workdir}/wcbf.nii.gz -R ${workdir}/ind2temp_warped.nii.gz --use-BSpline ${workdir}/swarp.nii.gz ${workdir}/ind2temp0GenericAffine.mat
-    #wt1: t1 relaxation time. common space. 
-
-    ### tSNR calculation
-    fslmaths ${workdir}/sub.nii.gz -Tmean ${workdir}/sub_mean.nii.gz
-    fslmaths ${workdir}/sub.nii.gz -Tstd ${workdir}/sub_std.nii.gz
-    fslmaths ${workdir}/sub_mean.nii.gz -div ${workdir}/sub_std.nii.gz ${workdir}/tSNR_map.nii.gz
-
     # New list of ROIs as we do not want to include the thalamus in the PDF output
     new_list=("arterial2" "cortical" "subcortical" "schaefer2018") ##list of ROIs - "landau" removed
+    seg_files=$(printf "${workdir}/w_%s${ext} " "${new_list[@]}")
 
-    # Smoothing for viz
-    ## Upsampling to 1mm and then smoothing to 2 voxels for nicer viz
-    flirt -in ${workdir}/cbf.nii.gz -ref ${workdir}/cbf.nii.gz -applyisoxfm 1.0 -nosearch -out ${workdir}/cbf_1mm.nii.gz -interp spline
-    flirt -in ${workdir}/mask.nii.gz -ref ${workdir}/mask.nii.gz -applyisoxfm 1.0 -nosearch -out ${workdir}/mask_1mm.nii.gz
-    fslmaths ${workdir}/cbf_1mm.nii.gz -s 2 ${workdir}/s_cbf_1mm.nii.gz
- 
     ### Visualizations
+    # viz upsamples (1 mm) and smooths (2 mm sigma) only the slices it draws from the native CBF
     # Check if vnumber is numeric, default to 0 or exit if not
     if [ "$qt1_capable" = true ]; then
         echo "Version is greater than 22. Generating viz with quantitative T1."
-        ${ANTSPATH}/WarpImageMultiTransform 3 ${workdir}/t1.nii.gz ${workdir}/wt1.nii.gz -R ${workdir}/ind2temp_warped.nii.gz --use-BSpline ${workdir}/swarp.nii.gz ${workdir}/ind2temp0GenericAffine.mat
-        python3 /flywheel/v0/workflows/viz.py -cbf ${workdir}/s_cbf_1mm.nii.gz -t1 ${workdir}/t1.nii.gz -out ${viz}/ -seg_folder ${workdir}/ -seg ${new_list[@]} -mask ${workdir}/mask_1mm.nii.gz
-    ### Create PDF file and output data into it for easy viewing
-        python3 /flywheel/v0/workflows/pdf.py -viz ${viz} -stats ${stats}/ -out ${workdir}/ -seg_folder ${workdir}/ -seg ${new_list[@]}
+        cached_stage viz "${workdir}/cbf${ext} ${workdir}/t1${ext} ${workdir}/mask${ext} ${seg_files}" "${viz}/*.png" \
+            py_step viz -cbf ${workdir}/cbf${ext} -t1 ${workdir}/t1${ext} -out ${viz}/ -seg_folder ${workdir}/ -seg ${new_list[@]} -mask ${workdir}/mask${ext}
+        report_qt1=(-qt1)
     else
         echo "Version is 22 or lower. Cannot generate viz with quantitative T1."
-        python3 /flywheel/v0/workflows/not1_viz.py -cbf ${workdir}/s_cbf_1mm.nii.gz -out ${viz}/ -seg_folder ${workdir}/ -seg ${new_list[@]} -mask ${workdir}/mask_1mm.nii.gz
-    ### Create PDF file and output data into it for easy viewing
-        python3 /flywheel/v0/workflows/not1_pdf.py -viz ${viz} -stats ${stats}/ -out ${workdir}/ -seg_folder ${workdir}/ -seg ${new_list[@]}
+        cached_stage not1_viz "${workdir}/cbf${ext} ${workdir}/mask${ext} ${seg_files}" "${viz}/*.png" \
+            py_step not1_viz -cbf ${workdir}/cbf${ext} -out ${viz}/ -seg_folder ${workdir}/ -seg ${new_list[@]} -mask ${workdir}/mask${ext}
+        report_qt1=()
     fi
 
-    python3 /flywheel/v0/workflows/qc.py -viz ${viz} -out ${workdir} -seg_folder ${workdir}/ -seg ${new_list[@]}
+    # Timings so far go into the QC report, the final stats/timings.json is written after the zips
+    if [ -n "$ASLSCP_TRACE" ]; then
+        py_step timings report -out ${stats}/timings.json
+        qc_timings=(-timings ${stats}/timings.json)
+    fi
+    ### Create output.pdf and qc.pdf for easy viewing, in one pass over the stats tables and mosaics
+    py_step report -viz ${viz} -stats ${stats}/ -out ${workdir}/ -seg ${new_list[@]} "${report_qt1[@]}" "${qc_timings[@]}" -jobs 2
 
     ## Move all files we want easy access to into the output directory
-    find ${workdir} -maxdepth 1 \( -name "cbf.nii.gz" -o -name "viz" -o -name "stats" -o -name "t1.nii.gz" -o -name "tSNR_map.nii.gz" -o -name "output.pdf" -o -name "qc.pdf" \) -print0 | xargs -0 -I {} mv {} ${export_dir}/
-    mv ${export_dir}/stats/tmp* ${workdir}/ 
+    # The images are gzipped in parallel on the way out (already compressed ones are moved)
+    py_step export -out ${export_dir} -files ${workdir}/cbf${ext} ${workdir}/t1${ext} ${workdir}/tSNR_map${ext}
+    find ${workdir} -maxdepth 1 \( -name "viz" -o -name "stats" -o -name "output.pdf" -o -name "qc.pdf" \) -print0 | xargs -0 -I {} mv {} ${export_dir}/
 
     ## Zip the output directory for easy download
     ## Also zip work dir so people can look at the intermediate data to troubleshoot
-    zip -q -r ${export_dir}/final_output.zip ${export_dir}
-    zip -q -r ${export_dir}/work_dir.zip ${workdir}
+    # What goes into each archive is set by the policy file (ASLSCP_ARCHIVE_POLICY overrides it);
+    # compressed files are stored as is, the rest is deflated in parallel, checksums go to archive_manifest.json
+    py_step archive -policy ${ASLSCP_ARCHIVE_POLICY:-${exe_dir}/archive_policy.json} -export ${export_dir} -work ${workdir}
+
+    if [ -n "$ASLSCP_TRACE" ]; then
+        py_step timings report -out ${stats}/timings.json
+    fi
+
+    # Keep the stage cache bounded (ASLSCP_CACHE_MAX_DAYS / ASLSCP_CACHE_MAX_GB)
+    [ -n "$ASLSCP_NO_CACHE" ] || python3 ${exe_dir}/stage_cache.py prune
 fi
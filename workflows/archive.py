@@ -0,0 +1,251 @@
+import os
+import sys
+import json
+import stat
+import time
+import zlib
+import struct
+import fnmatch
+import hashlib
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import threads
+
+# Default policy: which files go into which archive (see archive_policy.json)
+POLICY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive_policy.json')
+MANIFEST = 'archive_manifest.json'
+
+LEVEL = 6
+# Members are deflated in chunks of this size on a thread pool (zlib releases the GIL)
+CHUNK = 4 << 20
+
+ZIP64_LIMIT = 0xFFFFFFFF
+UTF8_FLAG = 0x800
+
+
+def load_policy(path):
+    """Archive policy: {"store": [extensions], "archives": [{name, root, members, dedupe}]}.
+
+    `members` are "+ pattern" / "- pattern" rules on paths relative to the
+    archive root; the last rule that matches a path decides.
+    """
+    with open(path, 'r') as f:
+        policy = json.load(f)
+    for archive in policy.get("archives", []):
+        for rule in archive.get("members", []):
+            if rule[:2] not in ("+ ", "- "):
+                raise ValueError(f"{path}: member rule must start with '+ ' or '- ': {rule!r}")
+    return policy
+
+
+def selected(relpath, rules):
+    keep = False
+    for rule in rules:
+        if fnmatch.fnmatchcase(relpath, rule[2:]):
+            keep = rule[0] == "+"
+    return keep
+
+
+def select_files(root, rules, skip=()):
+    # Regular files under `root` chosen by the rules, in sorted order (FIFOs, sockets etc. are never archived)
+    files = []
+    skip = {os.path.abspath(p) for p in skip}
+    for folder, dirs, names in os.walk(root):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(folder, name)
+            rel = os.path.relpath(path, root).replace(os.sep, '/')
+            if os.path.abspath(path) in skip or not selected(rel, rules):
+                continue
+            try:
+                if stat.S_ISREG(os.stat(path).st_mode):
+                    files.append((rel, path))
+            except OSError:
+                continue
+    return files
+
+
+def _deflate(chunk, last, level):
+    # Raw deflate of one chunk; sync-flushed chunks concatenate into one valid stream
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return c.compress(chunk) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def _dos_time(mtime):
+    t = time.localtime(mtime)
+    year = max(t.tm_year, 1980)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class ZipWriter:
+    """Minimal streaming ZIP (zip64 when needed) writer whose members can be deflated in parallel."""
+
+    def __init__(self, path, pool, level=LEVEL, window=8):
+        self.f = open(path, 'wb')
+        self.pool = pool
+        self.level = level
+        # Chunks in flight per member, bounds the memory held by compressed data not yet written
+        self.window = window
+        self.entries = []
+
+    def add(self, path, arcname, deflate):
+        """Write one member; returns (size, compressed size, sha256)."""
+        st = os.stat(path)
+        name = arcname.encode('utf-8')
+        method = 8 if deflate else 0
+        # Sizes are only known afterwards; big members get zip64 fields up front so the header can be patched
+        zip64 = st.st_size >= ZIP64_LIMIT // 2
+        offset = self.f.tell()
+        dos_time, dos_date = _dos_time(st.st_mtime)
+        header = self._local_header(name, method, dos_time, dos_date, 0, 0, 0, zip64)
+        self.f.write(header)
+
+        crc = 0
+        size = 0
+        digest = hashlib.sha256()
+        with open(path, 'rb') as src:
+            if deflate:
+                pending = deque()
+                chunk = src.read(CHUNK)
+                while True:
+                    following = src.read(CHUNK) if chunk else b''
+                    crc = zlib.crc32(chunk, crc)
+                    digest.update(chunk)
+                    size += len(chunk)
+                    pending.append(self.pool.submit(_deflate, chunk, not following, self.level))
+                    if len(pending) >= self.window:
+                        self.f.write(pending.popleft().result())
+                    if not following:
+                        break
+                    chunk = following
+                while pending:
+                    self.f.write(pending.popleft().result())
+            else:
+                for chunk in iter(lambda: src.read(CHUNK), b''):
+                    crc = zlib.crc32(chunk, crc)
+                    digest.update(chunk)
+                    size += len(chunk)
+                    self.f.write(chunk)
+
+        end = self.f.tell()
+        compressed = end - offset - len(header)
+        if size >= ZIP64_LIMIT and not zip64:
+            raise ValueError(f"{path} grew past the zip64 limit while it was archived")
+        self.f.seek(offset)
+        self.f.write(self._local_header(name, method, dos_time, dos_date, crc, compressed, size, zip64))
+        self.f.seek(end)
+        self.entries.append((name, method, dos_time, dos_date, crc, compressed, size, offset, st.st_mode))
+        return size, compressed, digest.hexdigest()
+
+    @staticmethod
+    def _local_header(name, method, dos_time, dos_date, crc, compressed, size, zip64):
+        extra = struct.pack('<HHQQ', 1, 16, size, compressed) if zip64 else b''
+        sizes = (ZIP64_LIMIT, ZIP64_LIMIT) if zip64 else (compressed, size)
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, UTF8_FLAG, method, dos_time, dos_date,
+                           crc, *sizes, len(name), len(extra)) + name + extra
+
+    def close(self):
+        start = self.f.tell()
+        for name, method, dos_time, dos_date, crc, compressed, size, offset, mode in self.entries:
+            fields = []
+            if size >= ZIP64_LIMIT:
+                fields.append(size)
+            if compressed >= ZIP64_LIMIT:
+                fields.append(compressed)
+            if offset >= ZIP64_LIMIT:
+                fields.append(offset)
+            extra = struct.pack('<HH', 1, 8 * len(fields)) + struct.pack(f'<{len(fields)}Q', *fields) if fields else b''
+            self.f.write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 45, 45 if fields else 20, UTF8_FLAG,
+                                     method, dos_time, dos_date, crc, min(compressed, ZIP64_LIMIT),
+                                     min(size, ZIP64_LIMIT), len(name), len(extra), 0, 0, 0, (mode & 0xFFFF) << 16,
+                                     min(offset, ZIP64_LIMIT)) + name + extra)
+        end = self.f.tell()
+        count = len(self.entries)
+        if count >= 0xFFFF or start >= ZIP64_LIMIT or end - start >= ZIP64_LIMIT:
+            self.f.write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0, count, count,
+                                     end - start, start))
+            self.f.write(struct.pack('<IIQI', 0x07064b50, 0, end, 1))
+        self.f.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                                 min(end - start, ZIP64_LIMIT), min(start, ZIP64_LIMIT), 0))
+        self.f.close()
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_archives(policy, roots, out_dir, jobs=None, level=LEVEL):
+    """Write every archive of the policy into `out_dir`; returns the manifest.
+
+    Files with a `store` extension are stored as they are, everything else is
+    deflated chunk-wise in parallel. Archives with "dedupe" leave out files
+    whose content is already in an earlier archive and list them instead.
+    """
+    store = tuple(policy.get("store", []))
+    targets = [os.path.join(out_dir, a["name"]) for a in policy.get("archives", [])]
+    archived = {}
+    manifest = {"archives": []}
+    jobs = jobs or threads.budget()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for archive, target in zip(policy.get("archives", []), targets):
+            root = roots[archive["root"]]
+            tmp = target + '.tmp'
+            entry = {"name": archive["name"], "root": archive["root"], "members": [], "duplicates": []}
+            writer = ZipWriter(tmp, pool, level, window=2 * jobs)
+            try:
+                for rel, path in select_files(root, archive.get("members", []), skip=targets + [tmp]):
+                    size = os.path.getsize(path)
+                    if archive.get("dedupe") and size in archived:
+                        sha = file_sha256(path)
+                        if sha in archived[size]:
+                            entry["duplicates"].append({"path": rel, "sha256": sha, "same_as": archived[size][sha]})
+                            continue
+                    deflate = not rel.lower().endswith(store)
+                    size, compressed, sha = writer.add(path, rel, deflate)
+                    archived.setdefault(size, {}).setdefault(sha, f"{archive['name']}:{rel}")
+                    entry["members"].append({"path": rel, "size": size, "compressed": compressed, "sha256": sha,
+                                             "method": "deflate" if deflate else "store"})
+            finally:
+                writer.close()
+            os.replace(tmp, target)
+            entry["size"] = os.path.getsize(target)
+            entry["sha256"] = file_sha256(target)
+            manifest["archives"].append(entry)
+            print(f"Archived {len(entry['members'])} files into {target} "
+                  f"({len(entry['duplicates'])} duplicates left out)")
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Archive the outputs and work directory according to a policy file.')
+    parser.add_argument('-policy', type=str, default=POLICY, help="The archive policy (JSON).")
+    parser.add_argument('-export', type=str, help="The export directory (root \"export\"), archives are written here.")
+    parser.add_argument('-work', type=str, help="The work directory (root \"work\").")
+    parser.add_argument('-jobs', type=int, default=threads.budget(), help="Number of compression threads.")
+    parser.add_argument('-level', type=int, default=LEVEL, help="Deflate level.")
+    args = parser.parse_args(argv)
+
+    try:
+        policy = load_policy(args.policy)
+    except (OSError, ValueError) as e:
+        sys.exit(f"Cannot read the archive policy: {e}")
+    roots = {"export": args.export, "work": args.work}
+    for archive in policy.get("archives", []):
+        if not roots.get(archive.get("root")):
+            sys.exit(f"Archive {archive.get('name')} needs the {archive.get('root')!r} directory")
+
+    manifest = build_archives(policy, roots, args.export, args.jobs, args.level)
+    out_file = os.path.join(args.export, MANIFEST)
+    with open(out_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Archive manifest written to {out_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+import os
+import re
+import sys
+import json
+import mmap
+import struct
+import zipfile
+import argparse
+
+from stage_cache import default_cache_dir
+
+# Acquisition parameters the pipeline reads from the Siemens WIP memory block
+PARAMS = {"ld": ("alFree", 0), "pld": ("alFree", 1), "nbs": ("alFree", 11), "m0_scale": ("alFree", 20)}
+
+# Files of a series whose protocols are parsed and compared (first, middle and last)
+SAMPLE_FILES = 3
+
+ASCCONV_BEGIN = b"### ASCCONV BEGIN"
+ASCCONV_END = b"### ASCCONV END"
+WIP_ENTRY = re.compile(rb"^[ \t]*sWipMemBlock\.(alFree|adFree)\[(\d+)\][ \t]*=[ \t]*([-+0-9.eE]+)", re.MULTILINE)
+
+# DICOM element layout (explicit VR little endian unless the transfer syntax says otherwise)
+LONG_VRS = {b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV", b"UC", b"UN", b"UR", b"UT", b"UV"}
+UNDEFINED = 0xFFFFFFFF
+ITEM_END = (0xFFFE, 0xE00D)
+SEQ_END = (0xFFFE, 0xE0DD)
+IMPLICIT_LE = b"1.2.840.10008.1.2"
+SERIES_UID = (0x0020, 0x000E)
+# Tag bytes of the pixel data element, where reading a zip member stops if no ASCCONV block was met
+PIXEL_DATA = b"\xe0\x7f\x10\x00"
+# Zip members are decompressed this much at a time
+CHUNK = 1 << 16
+# Separates a zip archive from the member in the names dicom_files() returns
+ZIP_MEMBER = '::'
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def _element(buf, pos, implicit):
+    # (group, element, value start, value length) of the element at `pos`
+    group, elem = struct.unpack_from('<HH', buf, pos)
+    if group == 0xFFFE or (implicit and group != 0x0002):
+        (length,) = struct.unpack_from('<I', buf, pos + 4)
+        return group, elem, pos + 8, length
+    if bytes(buf[pos + 4:pos + 6]) in LONG_VRS:
+        (length,) = struct.unpack_from('<I', buf, pos + 8)
+        return group, elem, pos + 12, length
+    (length,) = struct.unpack_from('<H', buf, pos + 6)
+    return group, elem, pos + 8, length
+
+
+def _skip(buf, pos, implicit, until):
+    # Walk nested elements up to the delimiter `until`, return the position after it
+    while True:
+        group, elem, start, length = _element(buf, pos, implicit)
+        if (group, elem) == until:
+            return start
+        pos = _next(buf, group, start, length, implicit)
+
+
+def _next(buf, group, start, length, implicit):
+    if length != UNDEFINED:
+        return start + length
+    # Undefined length: an item runs to its item delimiter, a sequence to its sequence delimiter
+    return _skip(buf, start, implicit, ITEM_END if group == 0xFFFE else SEQ_END)
+
+
+def series_uid(buf):
+    """SeriesInstanceUID of a DICOM file (mapped in `buf`), or None if it cannot be read.
+
+    Only the top-level elements up to group 0x0020 are walked, sequences are
+    skipped, so UIDs of referenced series are never picked up.
+    """
+    if bytes(buf[128:132]) != b"DICM":
+        return None
+    pos = 132
+    implicit = False
+    try:
+        while pos < len(buf):
+            group, elem, start, length = _element(buf, pos, implicit)
+            if (group, elem) == (0x0002, 0x0010):
+                implicit = bytes(buf[start:start + length]).rstrip(b"\0 ") == IMPLICIT_LE
+            elif (group, elem) == SERIES_UID:
+                return bytes(buf[start:start + length]).rstrip(b"\0 ").decode('ascii')
+            elif group > SERIES_UID[0]:
+                return None
+            pos = _next(buf, group, start, length, implicit)
+    except (struct.error, UnicodeDecodeError, RecursionError):
+        pass
+    return None
+
+
+def parse_wip_block(buf):
+    """All sWipMemBlock alFree/adFree entries of the first ASCCONV block in `buf`.
+
+    Returns {"alFree": {index: int}, "adFree": {index: float}}, or None if the
+    buffer has no ASCCONV block.
+    """
+    begin = buf.find(ASCCONV_BEGIN)
+    if begin < 0:
+        return None
+    end = buf.find(ASCCONV_END, begin)
+    block = buf[begin:end if end >= 0 else len(buf)]
+    wip = {"alFree": {}, "adFree": {}}
+    for array, index, value in WIP_ENTRY.findall(block):
+        array = array.decode()
+        try:
+            wip[array][int(index)] = int(value) if array == "alFree" else float(value)
+        except ValueError:
+            continue
+    return wip
+
+
+def read_header(f):
+    """The start of a DICOM stream up to the end of its ASCCONV block.
+
+    Decompresses a chunk at a time and stops at the end of the block, or at the
+    pixel data when there is no block, so large multi-frame members are not
+    inflated whole. The series UID comes before both.
+    """
+    buf = bytearray()
+    while True:
+        chunk = f.read(CHUNK)
+        if not chunk:
+            return bytes(buf)
+        # Markers may straddle chunks
+        start = max(0, len(buf) - len(ASCCONV_BEGIN))
+        buf += chunk
+        begin = buf.find(ASCCONV_BEGIN)
+        if begin >= 0:
+            if buf.find(ASCCONV_END, max(begin, start)) >= 0:
+                return bytes(buf)
+        elif buf.find(PIXEL_DATA, start) >= 0:
+            return bytes(buf)
+
+
+def read_protocol(path):
+    # (series UID, WIP block) of one file, read through a memory map so only the header pages are touched;
+    # a zip member is read as far as its ASCCONV block
+    if ZIP_MEMBER in path:
+        archive, member = path.split(ZIP_MEMBER, 1)
+        with zipfile.ZipFile(archive) as zf, zf.open(member) as f:
+            buf = read_header(f)
+        return series_uid(buf), parse_wip_block(buf)
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return None, None
+        with buf:
+            return series_uid(buf), parse_wip_block(buf)
+
+
+def dicom_files(folder):
+    # Every file carrying the DICOM preamble, in sorted order (the pipeline also keeps .nii/.json here).
+    # Members of a zip archive are named <archive>::<member> and read without extracting it
+    if os.path.isfile(folder) and zipfile.is_zipfile(folder):
+        found = []
+        with zipfile.ZipFile(folder) as zf:
+            for name in sorted(info.filename for info in zf.infolist() if not info.is_dir()):
+                with zf.open(name) as f:
+                    if f.read(132)[128:] == b"DICM":
+                        found.append(folder + ZIP_MEMBER + name)
+        return found
+    if os.path.isfile(folder):
+        return [folder]
+    found = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(('.nii', '.nii.gz', '.json')):
+                continue
+            path = os.path.join(root, name)
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(128)
+                    if f.read(4) == b"DICM":
+                        found.append(path)
+            except OSError:
+                continue
+    return found
+
+
+def sample(files, n=SAMPLE_FILES):
+    if len(files) <= n:
+        return files
+    picks = sorted({round(i * (len(files) - 1) / (n - 1)) for i in range(n)})
+    return [files[i] for i in picks]
+
+
+def _cache_file(cache_dir, uid):
+    return os.path.join(cache_dir, 'ascconv', f"{uid}.json")
+
+
+def _load_cached(cache_dir, uid):
+    try:
+        with open(_cache_file(cache_dir, uid), 'r') as f:
+            cached = json.load(f)
+        return {array: {int(k): v for k, v in cached[array].items()} for array in ("alFree", "adFree")}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _store_cached(cache_dir, uid, wip):
+    path = _cache_file(cache_dir, uid)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(dict(wip, series_uid=uid), f, indent=2)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Could not cache the protocol of {uid} in {cache_dir}: {e}", file=sys.stderr)
+
+
+def series_protocol(folder, cache_dir=None, n_files=SAMPLE_FILES):
+    """WIP block of the series in `folder`, checked across a sample of its files.
+
+    Raises ProtocolError if there is no DICOM with an ASCCONV block, if the
+    sampled files belong to different series or if their WIP blocks differ.
+    Results are cached per SeriesInstanceUID.
+    """
+    files = dicom_files(folder)
+    if not files:
+        raise ProtocolError(f"No DICOM files in {folder}")
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+
+    picks = sample(files, n_files)
+    protocols = [(path, *read_protocol(path)) for path in picks]
+    uids = {uid for _, uid, _ in protocols}
+    if len(uids) > 1:
+        raise ProtocolError(f"Files of several series in {folder}: {', '.join(sorted(u or '?' for u in uids))}")
+    uid = uids.pop()
+    if uid:
+        cached = _load_cached(cache_dir, uid)
+        if cached is not None:
+            return cached
+
+    missing = [path for path, _, wip in protocols if wip is None]
+    if missing:
+        raise ProtocolError(f"No ASCCONV protocol in {', '.join(missing)}")
+    first_path, _, wip = protocols[0]
+    for path, _, other in protocols[1:]:
+        for array in ("alFree", "adFree"):
+            differ = sorted(i for i in set(wip[array]) | set(other[array]) if wip[array].get(i) != other[array].get(i))
+            if differ:
+                raise ProtocolError(f"{array}{differ} differ between {first_path} and {path}")
+
+    if uid:
+        _store_cached(cache_dir, uid, wip)
+    return wip
+
+
+def pipeline_params(wip):
+    # The PARAMS that are present in the WIP block, as {name: value}
+    return {name: wip[array][index] for name, (array, index) in PARAMS.items() if index in wip[array]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Read the ASL parameters from the Siemens ASCCONV protocol in one pass.')
+    parser.add_argument('-dcm', type=str, help="The DICOM folder, zip archive or file of the series.")
+    parser.add_argument('-out', type=str, help="Shell file with the name=value assignments for the pipeline.")
+    parser.add_argument('-files', type=int, default=SAMPLE_FILES, help="Number of files of the series to compare.")
+    parser.add_argument('-cache', type=str, default=None, help="Directory for the per-series protocol cache.")
+    args = parser.parse_args(argv)
+
+    try:
+        wip = series_protocol(args.dcm, args.cache, args.files)
+    except ProtocolError as e:
+        sys.exit(f"ASCCONV: {e}")
+
+    params = pipeline_params(wip)
+    lines = [f"{name}={value}" for name, value in params.items()]
+    if args.out:
+        # Values are parsed numbers, so the file is safe to source
+        tmp = args.out + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, args.out)
+    for line in lines:
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import sys
+import argparse
+from contextlib import nullcontext
+import numpy as np
+import nibabel as nib
+
+import images
+
+# Volume order of each label/control pair (asl_file --iaf)
+ORDERS = ("tc", "ct")
+
+
+def pair_order(nbs):
+    # Data from the old nbs == 3 protocol has the control first
+    return "ct" if int(nbs) == 3 else "tc"
+
+
+class RunningStats:
+    """Per-voxel mean and variance updated one volume at a time (Welford)."""
+
+    def __init__(self, shape):
+        self.n = 0
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+
+    def add(self, volume):
+        self.n += 1
+        delta = volume - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (volume - self.mean)
+
+    def std(self):
+        # Sample standard deviation (N - 1), as fslmaths -Tstd
+        if self.n < 2:
+            return np.zeros_like(self.m2)
+        return np.sqrt(self.m2 / (self.n - 1))
+
+
+def subtract(asl_img, order="tc", diff_file=None):
+    """Control - label differences of a 4D ASL series in one streaming pass.
+
+    Volumes are read in pairs, the difference series is written to
+    `diff_file` as it goes (if given) and its temporal mean and SD are
+    accumulated. Returns (mean, std) as float64 arrays.
+    """
+    if order not in ORDERS:
+        raise ValueError(f"Unknown pair order {order}")
+    shape = asl_img.shape
+    n_pairs = shape[3] // 2
+    if shape[3] % 2:
+        print(f"Odd number of ASL volumes ({shape[3]}), the last one is ignored", file=sys.stderr)
+    if n_pairs == 0:
+        raise ValueError("The ASL series needs at least one label/control pair")
+
+    label_first = order == "tc"
+    stats = RunningStats(shape[:3])
+    writer = images.VolumeWriter(diff_file, asl_img.header, shape[:3] + (n_pairs,)) if diff_file else None
+    with writer or nullcontext():
+        for pair in range(n_pairs):
+            first = np.asarray(asl_img.dataobj[..., 2 * pair], dtype=np.float64)
+            second = np.asarray(asl_img.dataobj[..., 2 * pair + 1], dtype=np.float64)
+            diff = second - first if label_first else first - second
+            stats.add(diff)
+            if writer:
+                writer.write(diff)
+    return stats.mean, stats.std()
+
+
+def tsnr(mean, std):
+    # mean / std, 0 where the SD is 0 (as fslmaths -div)
+    return np.divide(mean, std, out=np.zeros_like(mean), where=std > 0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Subtract label/control pairs and compute the mean and tSNR in one pass.')
+    parser.add_argument('-asl', type=str, help="The motion-corrected 4D ASL series.")
+    parser.add_argument('-order', type=str, choices=ORDERS, help="Pair order, label first (tc) or control first (ct).")
+    parser.add_argument('-nbs', type=int, help="Number of background suppressions, picks the order if -order is not given.")
+    parser.add_argument('-out', type=str, help="The output directory (sub, sub_av and tSNR_map).")
+    args = parser.parse_args(argv)
+
+    if args.order:
+        order = args.order
+    elif args.nbs is not None:
+        order = pair_order(args.nbs)
+    else:
+        parser.error("Give -order or -nbs")
+
+    # The series is streamed from disk; keeping the file open lets each volume continue where the last one ended
+    asl_img = nib.load(args.asl, keep_file_open=True)
+    mean, std = subtract(asl_img, order, images.work_file(args.out, 'sub'))
+
+    header = asl_img.header.copy()
+    header.set_data_shape(asl_img.shape[:3])
+    header.set_data_dtype(np.float32)
+    images.save(nib.Nifti1Image(mean.astype(np.float32), asl_img.affine, header), images.work_file(args.out, 'sub_av'))
+    images.save(nib.Nifti1Image(tsnr(mean, std).astype(np.float32), asl_img.affine, header),
+                images.work_file(args.out, 'tSNR_map'))
+    print(f"Subtracted {asl_img.shape[3] // 2} pairs ({order}) from {args.asl}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import os
+import re
+import json
+import hashlib
+import argparse
+import numpy as np
+import nibabel as nib
+
+from stage_cache import hash_path
+
+# Bump when the layout of the store changes so old stores are rebuilt
+STORE_VERSION = 1
+# Atlases the pipeline extracts regional CBF for; their eroded (_ero) variants go in too when present
+ATLASES = ("arterial2", "cortical", "subcortical", "thalamus", "landau", "schaefer2018")
+# "idx r g b name" rows of colour tables (Schaefer, FreeSurfer LUTs)
+COLOUR_ROW = re.compile(r'^\s*(\d+)\s+([-+.\deE]+)\s+([-+.\deE]+)\s+([-+.\deE]+)\s+(\S.*?)\s*$')
+
+
+def default_store_dir(std_dir):
+    return os.environ.get('ASLSCP_ATLAS_STORE', os.path.join(std_dir, 'atlas_store'))
+
+
+def label_file(std_dir, atlas):
+    # <atlas>_label.txt, eroded variants share the labels of their atlas
+    path = os.path.join(std_dir, f"{atlas}_label.txt")
+    if not os.path.exists(path) and atlas.endswith('_ero'):
+        path = os.path.join(std_dir, f"{atlas[:-4]}_label.txt")
+    return path
+
+
+def read_label_file(path):
+    """Labels of an atlas as [(id, name, colour or None)], whatever the file's format.
+
+    Colour tables give the id of every row; plain and tab-padded name lists
+    name label n on line n. Names have their whitespace collapsed, trailing
+    empty lines are ignored and an empty line in between leaves its id unnamed.
+    """
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+    while lines and not lines[-1].strip():
+        lines.pop()
+    rows = [COLOUR_ROW.match(line) for line in lines if line.strip()]
+    labels = []
+    if rows and all(rows):
+        colours = np.array([[float(c) for c in m.group(2, 3, 4)] for m in rows])
+        # 0-255 tables are brought to the 0-1 range of the others
+        if colours.max() > 1:
+            colours /= 255
+        labels = [(int(m.group(1)), " ".join(m.group(5).split()), [round(float(c), 6) for c in colour])
+                  for m, colour in zip(rows, colours)]
+    else:
+        labels = [(n, " ".join(line.split()), None) for n, line in enumerate(lines, start=1) if line.strip()]
+    ids = [label[0] for label in labels]
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"{path}: duplicate label ids")
+    return labels
+
+
+def names_by_id(labels):
+    # Names indexed by label value - 1, "" for unnamed values (what regional_stats tables iterate over)
+    names = [""] * max((label[0] for label in labels), default=0)
+    for label_id, name, _ in labels:
+        names[label_id - 1] = name
+    return names
+
+
+def validate(atlas, labels, counts):
+    """Check an atlas' labels against the voxel counts of its volume.
+
+    Every label value in the volume needs a name; named labels without voxels
+    are reported and kept. Returns the index records of the atlas.
+    """
+    present = set(np.flatnonzero(counts[1:]) + 1)
+    named = {label[0] for label in labels}
+    unnamed = sorted(present - named)
+    if unnamed:
+        raise ValueError(f"{atlas}: label values {unnamed} have voxels but no name")
+    empty = sorted(named - present)
+    if empty:
+        print(f"{atlas}: labels {empty} are named but have no voxels")
+    return [{"atlas": atlas, "id": label_id, "name": name, "colour": colour,
+             "voxels": int(counts[label_id]) if label_id < len(counts) else 0}
+            for label_id, name, colour in labels]
+
+
+def source_files(std_dir, atlases):
+    # (atlas, volume, label file) of the atlases present in std_dir
+    sources = []
+    for atlas in atlases:
+        for name in (atlas, atlas + '_ero'):
+            volume = os.path.join(std_dir, f"{name}.nii.gz")
+            if os.path.exists(volume):
+                sources.append((name, volume, label_file(std_dir, name)))
+            elif name == atlas:
+                raise FileNotFoundError(f"Missing atlas {volume}")
+    return sources
+
+
+def sources_key(sources):
+    h = hashlib.sha256(f"v{STORE_VERSION}\0".encode())
+    for name, volume, labels in sources:
+        h.update(f"\0{name}\0".encode())
+        hash_path(volume, h)
+        hash_path(labels, h)
+    return h.hexdigest()
+
+
+def _replace(path, write):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def build(std_dir, out_dir, atlases=ATLASES, force=False):
+    """Compile the atlases into one uint16 array per voxel grid plus index.json.
+
+    The arrays are (x, y, z, channel) .npy files, so a store is opened with
+    np.load(mmap_mode='r') and a voxel's labels in every atlas sit next to each
+    other. Nothing is rebuilt when the index was made from the same sources.
+    Returns the index.
+    """
+    sources = source_files(std_dir, atlases)
+    key = sources_key(sources)
+    if not force:
+        try:
+            return AtlasStore(out_dir, key).index
+        except (OSError, ValueError, KeyError):
+            pass
+
+    grids = []
+    records = []
+    for name, volume, labels_path in sources:
+        img = nib.load(volume)
+        data = np.asanyarray(img.dataobj)
+        if data.ndim != 3:
+            raise ValueError(f"{volume}: expected a 3D label volume, got shape {data.shape}")
+        values = np.rint(data).astype(np.int64)
+        if not np.array_equal(values, data) or values.min() < 0 or values.max() > np.iinfo(np.uint16).max:
+            raise ValueError(f"{volume}: label values must be integers from 0 to 65535")
+        records += validate(name, read_label_file(labels_path), np.bincount(values.ravel()))
+        # Atlases on the same grid (shape and affine) share an array
+        grid = next((g for g in grids if g["shape"] == list(data.shape) and np.allclose(g["affine"], img.affine)), None)
+        if grid is None:
+            grid = {"file": f"grid{len(grids)}.npy", "shape": list(data.shape), "affine": img.affine.tolist(),
+                    "channels": [], "volumes": []}
+            grids.append(grid)
+        grid["channels"].append(name)
+        grid["volumes"].append(values.astype(np.uint16))
+
+    os.makedirs(out_dir, exist_ok=True)
+    for grid in grids:
+        stack = np.stack(grid.pop("volumes"), axis=-1)
+
+        def write(tmp, stack=stack):
+            with open(tmp, 'wb') as f:
+                np.save(f, stack)
+        _replace(os.path.join(out_dir, grid["file"]), write)
+
+    index = {"version": STORE_VERSION, "sources": key, "grids": grids, "labels": records}
+
+    def write_index(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=1)
+    # index.json goes last: a reader only trusts the arrays it describes
+    _replace(os.path.join(out_dir, 'index.json'), write_index)
+    return index
+
+
+class AtlasStore:
+    """Read side of a store made by build(): memory-mapped label arrays and the label index.
+
+    Pass `key` to only accept a store built from those sources.
+    """
+
+    def __init__(self, folder, key=None):
+        self.folder = folder
+        with open(os.path.join(folder, 'index.json'), 'r') as f:
+            self.index = json.load(f)
+        if self.index.get("version") != STORE_VERSION or (key and self.index.get("sources") != key):
+            raise ValueError(f"{folder} is out of date")
+        self._grids = {}
+        for grid in self.index["grids"]:
+            expected = tuple(grid["shape"]) + (len(grid["channels"]),)
+            if np.load(os.path.join(folder, grid["file"]), mmap_mode='r').shape != expected:
+                raise ValueError(f"{folder}: {grid['file']} does not match the index")
+
+    @property
+    def atlases(self):
+        return [name for grid in self.index["grids"] for name in grid["channels"]]
+
+    def _grid(self, atlas):
+        for grid in self.index["grids"]:
+            if atlas in grid["channels"]:
+                return grid
+        raise KeyError(f"No atlas {atlas} in {self.folder}")
+
+    def grid_image(self, atlas):
+        """4D image of the memory-mapped array holding `atlas`, and the atlas' channel in it."""
+        grid = self._grid(atlas)
+        if grid["file"] not in self._grids:
+            data = np.load(os.path.join(self.folder, grid["file"]), mmap_mode='r')
+            self._grids[grid["file"]] = nib.Nifti1Image(data, np.asarray(grid["affine"]))
+        return self._grids[grid["file"]], grid["channels"].index(atlas)
+
+    def image(self, atlas):
+        img, channel = self.grid_image(atlas)
+        return nib.Nifti1Image(np.asanyarray(img.dataobj)[..., channel], img.affine)
+
+    def labels(self, atlas):
+        return [r for r in self.index["labels"] if r["atlas"] == atlas]
+
+    def label_names(self, atlas):
+        return names_by_id([(r["id"], r["name"], r["colour"]) for r in self.labels(atlas)])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compile the atlases into a memory-mappable label store.')
+    parser.add_argument('command', choices=('build', 'show'),
+                        help="build: (re)compile the store if its sources changed; show: list its atlases and labels.")
+    parser.add_argument('-std', type=str, help="The atlas directory (<atlas>.nii.gz and <atlas>_label.txt).")
+    parser.add_argument('-out', type=str, help="The store directory (default: <std>/atlas_store or $ASLSCP_ATLAS_STORE).")
+    parser.add_argument('-atlases', type=str, nargs='+', default=list(ATLASES), help="Atlases to compile.")
+    parser.add_argument('-force', action='store_true', help="Rebuild even if the store is up to date.")
+    args = parser.parse_args(argv)
+
+    out_dir = args.out or default_store_dir(args.std)
+    if args.command == 'build':
+        index = build(args.std, out_dir, args.atlases, args.force)
+        print(f"Atlas store {out_dir}: " + ", ".join(name for g in index["grids"] for name in g["channels"]))
+    else:
+        store = AtlasStore(out_dir)
+        for atlas in store.atlases:
+            labels = store.labels(atlas)
+            print(f"{atlas}: {len(labels)} labels")
+            for r in labels:
+                print(f"  {r['id']:>5}  {r['name']}  ({r['voxels']} voxels)")
+
+
+if __name__ == "__main__":
+    main()
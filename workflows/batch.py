@@ -0,0 +1,153 @@
+import os
+import re
+import csv
+import json
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import threads
+import atlas_store
+import stats_store
+from atlas_store import ATLASES
+from regional_stats import read_table
+from flywheel_context import write_metadata
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPELINE = os.path.join(REPO_DIR, 'pipeline_singlePLD.sh')
+STD_DIR = os.path.join(REPO_DIR, 'input', 'std')
+
+SUMMARY_COLUMNS = ("session", "subject", "status", "table", "region",
+                   "mean_cbf", "std_dev", "voxels", "volume", "rcbf")
+
+
+def read_manifest(path):
+    """Sessions to process, from a CSV (session,asl,m0[,params][,subject]) or a JSON list."""
+    if path.endswith('.json'):
+        with open(path, 'r') as f:
+            sessions = json.load(f)
+    else:
+        with open(path, 'r', newline='') as f:
+            sessions = list(csv.DictReader(f))
+
+    base = os.path.dirname(os.path.abspath(path))
+    for s in sessions:
+        for key in ("session", "asl", "m0"):
+            if not s.get(key):
+                raise ValueError(f"Manifest entry {s} is missing '{key}'")
+        # Relative input paths are taken relative to the manifest
+        for key in ("asl", "m0", "params"):
+            if s.get(key):
+                s[key] = os.path.join(base, s[key])
+    return sessions
+
+
+def check_std(std_dir, atlases=ATLASES):
+    # Validate the shared atlas/template directory once, before any session starts
+    required = []
+    for atlas in atlases:
+        required += [f"{atlas}.nii.gz", f"{atlas}_label.txt"]
+    missing = [r for r in required if not os.path.exists(os.path.join(std_dir, r))]
+    if missing:
+        raise FileNotFoundError(f"Missing from {std_dir}: {', '.join(missing)}")
+
+
+def session_dir_name(session):
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', session)
+
+
+def prepare_session(session, session_dir):
+    # Per-session config and metadata so the pipeline does not need Flywheel
+    work = os.path.join(session_dir, 'work')
+    os.makedirs(work, exist_ok=True)
+
+    config = os.path.join(session_dir, 'config.json')
+    with open(config, 'w') as f:
+        json.dump({"config": {"ge": False}, "inputs": {}}, f, indent=2)
+
+    write_metadata(work, {"subject_label": session.get('subject') or 'Unknown', "session_label": session['session']})
+    return config, work
+
+
+def run_session(session, out_dir, std_dir, session_threads=None):
+    session_dir = os.path.join(out_dir, session_dir_name(session['session']))
+    config, work = prepare_session(session, session_dir)
+    output = os.path.join(session_dir, 'output')
+
+    cmd = ['bash', PIPELINE, '-c', config, '-a', session['asl'], '-m', session['m0'],
+           '-w', work, '-o', output, '-t', std_dir]
+    if session.get('params'):
+        cmd += ['-j', session['params']]
+
+    with open(os.path.join(session_dir, 'pipeline.log'), 'w') as log:
+        env = dict(os.environ, **({threads.BUDGET_ENV: str(session_threads)} if session_threads else {}))
+        proc = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT, cwd=session_dir, env=env)
+    return session, output, proc.returncode
+
+
+def summary_rows(session, output, returncode):
+    stats = os.path.join(output, 'stats')
+    tables = {atlas: read_table(os.path.join(stats, f"formatted_cbf_{atlas}.txt")) for atlas in ATLASES}
+    tables["weighted"] = read_table(os.path.join(stats, 'weighted_table.txt'))
+
+    base = {"session": session['session'], "subject": session.get('subject', '')}
+    if returncode != 0 or not any(tables.values()):
+        return [dict(base, status="failed")]
+
+    rows = []
+    for table, entries in tables.items():
+        for e in entries:
+            rows.append(dict(
+                base, status="ok", table=table, region=e.get("Region", ""),
+                mean_cbf=e.get("Mean CBF", e.get("Mean", "")), std_dev=e.get("Standard Deviation", ""),
+                voxels=e.get("Voxels", ""), volume=e.get("Volume", ""), rcbf=e.get("rCBF", ""),
+            ))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the single-PLD pipeline over many sessions.')
+    parser.add_argument('-manifest', type=str, required=True, help="CSV or JSON list of sessions (session, asl, m0, params, subject).")
+    parser.add_argument('-out', type=str, required=True, help="The batch output directory.")
+    parser.add_argument('-std', type=str, default=STD_DIR, help="The shared atlas/template directory.")
+    parser.add_argument('-jobs', type=int, default=threads.budget(), help="Number of sessions run at once.")
+    args = parser.parse_args(argv)
+
+    sessions = read_manifest(args.manifest)
+    std_dir = os.path.abspath(args.std)
+    check_std(std_dir)
+    # Compiled once here, so the sessions only find it up to date and share it
+    atlas_store.build(std_dir, atlas_store.default_store_dir(std_dir))
+    out_dir = os.path.abspath(args.out)
+    os.makedirs(out_dir, exist_ok=True)
+
+    rows = []
+    merged = []
+    # Each session is its own pipeline process, the pool only bounds how many run at once;
+    # the sessions running together share the thread budget
+    session_threads = max(1, threads.budget() // max(1, min(args.jobs, len(sessions))))
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(run_session, s, out_dir, std_dir, session_threads) for s in sessions]
+        for future in as_completed(futures):
+            session, output, returncode = future.result()
+            print(f"{session['session']}: {'ok' if returncode == 0 else f'failed ({returncode})'}")
+            rows += summary_rows(session, output, returncode)
+            if returncode == 0 and os.path.exists(os.path.join(output, stats_store.SESSION_FILE)):
+                merged.append(output)
+
+    rows.sort(key=lambda r: r["session"])
+    summary = os.path.join(out_dir, 'summary.csv')
+    with open(summary, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_COLUMNS, restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Summary written to {summary}")
+
+    # Merged in session order from the main thread, the sessions never write the cohort store
+    cohort = os.path.join(out_dir, 'cohort.sqlite')
+    n = stats_store.merge(cohort, sorted(merged))
+    print(f"{n} sessions merged into {cohort}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+import os
+import sys
+import json
+import glob
+import shutil
+import argparse
+import platform
+import tempfile
+import numpy as np
+import nibabel as nib
+
+import images
+import timings
+import threads
+import atlas_store
+import cbf_calc
+import multidelay
+import t1fit
+import regional_stats
+import viz
+import pdf
+
+# Acquisition of the synthetic session (ld/pld in microseconds, as read from the DICOM header)
+LD = 1800000
+PLD = 1800000
+NBS = 4
+SCALE = 10.0
+# Delays of the multi-delay series (us), the volumes cycle through them
+MD_PLDS = (500000, 1000000, 1500000, 2000000, 2500000)
+FOV_MM = 240.0
+
+# Ground truth of the two phantom tissues
+TISSUES = {"grey": {"label": 1, "cbf": 60.0, "t1": 1300.0, "att": 1200.0},
+           "white": {"label": 2, "cbf": 20.0, "t1": 800.0, "att": 1600.0}}
+M0 = 1000.0
+NOISE = 0.02
+# Sectors of the parcellation atlas (azimuth x elevation)
+PARCELS = (10, 10)
+
+STAGES = ("cbf_calc", "cbf_score", "multidelay", "t1fit", "regional_stats", "regional_stats_store", "viz", "pdf")
+# Stages that run a step with other options than its own name's stage (cbf_score: the pipeline's -score path,
+# regional_stats_store: label names from the atlas store)
+STAGE_MODULES = {"cbf_score": "cbf_calc", "regional_stats_store": "regional_stats"}
+DEFAULT_SIZES = ("64x8", "128x8")
+
+# Relative difference allowed between a result and its baseline
+RESULT_RTOL = 1e-3
+
+
+def parse_size(spec):
+    # "<matrix>x<repetitions>", e.g. 128x8 for a 128^3 volume with 8 label/control pairs
+    try:
+        n, reps = (int(v) for v in spec.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected <matrix>x<repetitions>, got {spec}")
+    return n, reps
+
+
+def make_phantom(n, reps, folder, seed=0):
+    """Write a synthetic session of an n^3 matrix into `folder`.
+
+    An ellipsoidal brain with a grey matter shell and a white matter core, a
+    4D ASL difference series of `reps` repetitions, a multi-delay series of
+    `reps` repetitions of MD_PLDS, M0, an M0/IR pair and two
+    label maps ("tissue" and "parcels") with their label files, also
+    compiled into an atlas store.
+    Returns the ground-truth tissue label map.
+    """
+    rng = np.random.default_rng(seed)
+    zoom = FOV_MM / n
+    affine = np.diag([zoom, zoom, zoom, 1.0])
+    affine[:3, 3] = -zoom * (n - 1) / 2
+
+    x, y, z = (np.indices((n, n, n), dtype=np.float32) - (n - 1) / 2) / (n / 2)
+    r = np.sqrt((x / 0.8) ** 2 + (y / 0.9) ** 2 + (z / 0.7) ** 2)
+    tissue = np.zeros((n, n, n), dtype=np.uint8)
+    tissue[r < 1] = TISSUES["grey"]["label"]
+    tissue[r < 0.75] = TISSUES["white"]["label"]
+    brain = tissue > 0
+
+    cbf = np.zeros(tissue.shape, dtype=np.float32)
+    t1 = np.zeros(tissue.shape, dtype=np.float32)
+    att = np.zeros(tissue.shape, dtype=np.float32)
+    for values in TISSUES.values():
+        cbf[tissue == values["label"]] = values["cbf"]
+        t1[tissue == values["label"]] = values["t1"]
+        att[tissue == values["label"]] = values["att"]
+
+    m0 = np.where(brain, M0, 0).astype(np.float32)
+    m0 += rng.normal(0, NOISE * M0, m0.shape).astype(np.float32)
+
+    # Invert the quantification so cbf_calc recovers the ground truth
+    factor = cbf_calc.cbf_factor(LD, PLD, NBS)
+    diff = cbf * M0 * SCALE / factor
+    asl = np.repeat(diff[..., None], reps, axis=3)
+    asl += rng.normal(0, NOISE * diff.max(), asl.shape).astype(np.float32)
+
+    # Same for the multi-delay fit, through the kinetic model
+    curves = multidelay.kinetic_curve(att[brain] / 1000, np.array(MD_PLDS) / 10**6, LD / 10**6, NBS)
+    md = np.zeros(tissue.shape + (len(MD_PLDS),), dtype=np.float32)
+    md[brain] = cbf[brain, None] * curves * M0 * SCALE
+    md = np.tile(md, (1, 1, 1, reps))
+    md += rng.normal(0, NOISE * diff.max(), md.shape).astype(np.float32)
+
+    ir = np.zeros_like(m0)
+    ir[brain] = M0 * t1fit.z_curve(t1[brain].astype(np.float64))
+    ir += rng.normal(0, NOISE * M0, ir.shape).astype(np.float32)
+
+    # Parcels: azimuth x elevation sectors of the brain
+    n_az, n_el = PARCELS
+    az = np.floor((np.arctan2(y, x) + np.pi) / (2 * np.pi) * n_az).clip(0, n_az - 1)
+    el = np.floor((z + 1) / 2 * n_el).clip(0, n_el - 1)
+    parcels = np.where(brain, 1 + az + n_az * el, 0).astype(np.uint16)
+
+    def save(data, name, dtype=np.float32):
+        img = nib.Nifti1Image(data.astype(dtype), affine)
+        img.header.set_zooms((zoom,) * 3 + (1.0,) * (data.ndim - 3))
+        nib.save(img, images.work_file(folder, name))
+
+    save(m0, 'm0')
+    save(asl, 'asl')
+    save(md, 'asl_md')
+    save(np.stack([m0, ir], axis=3), 'm0_ir')
+    save(brain, 'mask', np.uint8)
+    save(tissue, 'w_tissue', np.uint8)
+    save(parcels, 'w_parcels', np.uint16)
+
+    labels = os.path.join(folder, 'labels')
+    os.makedirs(labels, exist_ok=True)
+    with open(os.path.join(labels, 'tissue_label.txt'), 'w') as f:
+        f.write("Grey_Matter\nWhite_Matter\n")
+    with open(os.path.join(labels, 'parcels_label.txt'), 'w') as f:
+        f.write("".join(f"Parcel_{i}\n" for i in range(1, n_az * n_el + 1)))
+    # The label folder doubles as the atlas directory the store is compiled from
+    for name, data in (('tissue', tissue), ('parcels', parcels)):
+        nib.save(nib.Nifti1Image(data, affine), os.path.join(labels, f'{name}.nii.gz'))
+    atlas_store.build(labels, os.path.join(folder, 'atlas_store'), ('tissue', 'parcels'))
+    for sub in ('stats', 'viz', 'cache', 'multidelay'):
+        os.makedirs(os.path.join(folder, sub), exist_ok=True)
+    return tissue
+
+
+def stage_argv(stage, folder, jobs):
+    d = folder + '/'
+    ext = images.work_ext()
+    segs = ['tissue', 'parcels']
+    return {
+        "cbf_calc": ['-m0', d + 'm0' + ext, '-asl', d + 'asl' + ext, '-m', d + 'mask' + ext, '-ld', str(LD),
+                     '-pld', str(PLD), '-nbs', str(NBS), '-scale', str(SCALE), '-out', folder, '-slab', '16'],
+        "cbf_score": ['-m0', d + 'm0' + ext, '-asl', d + 'asl' + ext, '-m', d + 'mask' + ext, '-ld', str(LD),
+                      '-pld', str(PLD), '-nbs', str(NBS), '-scale', str(SCALE), '-out', folder, '-slab', '16',
+                      '-score', d + 'stats/cbf_score.json'],
+        "multidelay": ['-asl', d + 'asl_md' + ext, '-m0', d + 'm0' + ext, '-m', d + 'mask' + ext,
+                       '-plds', *map(str, MD_PLDS), '-ld', str(LD), '-nbs', str(NBS), '-scale', str(SCALE),
+                       '-out', d + 'multidelay'],
+        "t1fit": ['-m0_ir', d + 'm0_ir' + ext, '-m', d + 'mask' + ext, '-out', folder, '-stats', d + 'stats',
+                  '-cache', d + 'cache'],
+        "regional_stats": ['-cbf', d + 'cbf' + ext, '-mask', d + 'mask' + ext, '-seg_folder', d, '-seg', *segs,
+                           '-labels', d + 'labels', '-out', d + 'stats'],
+        "regional_stats_store": ['-cbf', d + 'cbf' + ext, '-mask', d + 'mask' + ext, '-seg_folder', d, '-seg', *segs,
+                                 '-atlas_store', d + 'atlas_store', '-out', d + 'stats'],
+        "viz": ['-cbf', d + 'cbf' + ext, '-t1', d + 't1' + ext, '-mask', d + 'mask' + ext, '-seg_folder', d,
+                '-seg', *segs, '-out', d + 'viz/', '-jobs', str(jobs)],
+        "pdf": ['-viz', d + 'viz', '-stats', d + 'stats/', '-out', folder, '-seg', *segs],
+    }[stage]
+
+
+def stage_results(stage, folder, tissue):
+    # Numbers checked against the baseline, read back from the stage outputs
+    def tissue_means(name, sub=''):
+        data = nib.load(images.work_file(os.path.join(folder, sub), name)).get_fdata(dtype=np.float32)
+        return {t: round(float(data[tissue == v["label"]].mean()), 4) for t, v in TISSUES.items()}
+
+    if stage == "cbf_calc":
+        return tissue_means('cbf')
+    if stage == "cbf_score":
+        with open(os.path.join(folder, 'stats', 'cbf_score.json'), 'r') as f:
+            return dict(tissue_means('cbf'), kept_pairs=len(json.load(f)["kept"]))
+    if stage == "multidelay":
+        return {**{f"{t}_cbf": v for t, v in tissue_means('cbf', 'multidelay').items()},
+                **{f"{t}_att": v for t, v in tissue_means('att', 'multidelay').items()}}
+    if stage == "t1fit":
+        return tissue_means('t1')
+    if stage in ("regional_stats", "regional_stats_store"):
+        results = {}
+        for seg in ('tissue', 'parcels'):
+            rows = regional_stats.read_table(os.path.join(folder, 'stats', f'formatted_cbf_{seg}.txt'))
+            results[f"{seg}_regions"] = len(rows)
+            results[f"{seg}_mean"] = round(float(np.mean([float(r["Mean CBF"]) for r in rows])), 4) if rows else 0.0
+        return results
+    if stage == "viz":
+        return {"figures": len(glob.glob(os.path.join(folder, 'viz', '*.png')))}
+    return {"pdf": int(os.path.getsize(os.path.join(folder, 'output.pdf')) > 0)}
+
+
+def run_stage(stage, folder, jobs, repeat, n_voxels):
+    """Best-of-`repeat` wall time, CPU, peak RSS and throughput of one stage."""
+    module = sys.modules[STAGE_MODULES.get(stage, stage)]
+    log = os.path.join(folder, 'trace.jsonl')
+    best = None
+    for _ in range(repeat):
+        # Every run reads its inputs from disk, like a fresh pipeline step
+        images.clear()
+        with timings.measure(stage, log=log) as outcome:
+            try:
+                module.main(stage_argv(stage, folder, jobs))
+            except SystemExit as e:
+                outcome["status"] = e.code or 0
+        rec = timings.read_trace(log)[-1]
+        if rec["status"]:
+            raise RuntimeError(f"{stage} failed with status {rec['status']}")
+        if best is None or rec["wall_s"] < best["wall_s"]:
+            peak = max(rec["peak_rss_mb"], best["peak_rss_mb"] if best else 0)
+            best = dict(rec, peak_rss_mb=peak)
+        else:
+            best["peak_rss_mb"] = max(best["peak_rss_mb"], rec["peak_rss_mb"])
+    return {
+        "wall_s": best["wall_s"],
+        "cpu_s": round(best["user_s"] + best["sys_s"], 3),
+        "peak_rss_mb": best["peak_rss_mb"],
+        "mvox_per_s": round(n_voxels / max(best["wall_s"], 1e-6) / 1e6, 2),
+    }
+
+
+def run_size(n, reps, stages, jobs, repeat, keep_dir=None):
+    folder = tempfile.mkdtemp(prefix=f'aslbench_{n}x{reps}_', dir=keep_dir)
+    try:
+        tissue = make_phantom(n, reps, folder)
+        results = {}
+        for stage in stages:
+            # The quantification reads every repetition, the other stages one volume
+            n_voxels = n ** 3 * {"cbf_calc": reps, "cbf_score": reps, "multidelay": reps * len(MD_PLDS)}.get(stage, 1)
+            results[stage] = run_stage(stage, folder, jobs, repeat, n_voxels)
+            results[stage]["results"] = stage_results(stage, folder, tissue)
+        return results
+    finally:
+        images.clear()
+        if keep_dir is None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+def compare(report, baseline, tolerance):
+    """Problems found against a baseline report: changed results and slowdowns."""
+    problems = []
+    for size, stages in report["sizes"].items():
+        for stage, current in stages.items():
+            base = baseline.get("sizes", {}).get(size, {}).get(stage)
+            if base is None:
+                continue
+            for key, value in current["results"].items():
+                expected = base["results"].get(key)
+                if expected is None or not np.isclose(value, expected, rtol=RESULT_RTOL, atol=1e-6):
+                    problems.append(f"{size} {stage}: {key} = {value}, baseline {expected}")
+            ratio = current["wall_s"] / max(base["wall_s"], 1e-6)
+            current["vs_baseline"] = round(ratio, 2)
+            if ratio > 1 + tolerance:
+                problems.append(f"{size} {stage}: {current['wall_s']:.3f}s is {ratio:.2f}x the baseline {base['wall_s']:.3f}s")
+    return problems
+
+
+def print_report(report):
+    print(f"{'size':<10} {'stage':<22} {'wall (s)':>9} {'cpu (s)':>9} {'rss (MB)':>9} {'Mvox/s':>9} {'vs base':>8}")
+    for size, stages in report["sizes"].items():
+        for stage, r in stages.items():
+            ratio = f"{r['vs_baseline']:.2f}x" if "vs_baseline" in r else "-"
+            print(f"{size:<10} {stage:<22} {r['wall_s']:>9.3f} {r['cpu_s']:>9.3f} {r['peak_rss_mb']:>9.0f} "
+                  f"{r['mvox_per_s']:>9.2f} {ratio:>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Python workflow steps on synthetic phantoms.')
+    parser.add_argument('-sizes', type=parse_size, nargs='+', default=[parse_size(s) for s in DEFAULT_SIZES],
+                        help="Phantoms as <matrix>x<repetitions>, e.g. 64x8 128x8 256x16.")
+    parser.add_argument('-stages', type=str, nargs='+', choices=STAGES, default=list(STAGES), help="Stages to run.")
+    parser.add_argument('-repeat', type=int, default=3, help="Runs per stage, the fastest is reported.")
+    parser.add_argument('-jobs', type=int, default=threads.budget(), help="Figures rendered in parallel by viz.")
+    parser.add_argument('-baseline', type=str, help="A report saved by -save to compare against.")
+    parser.add_argument('-tolerance', type=float, default=0.25, help="Allowed slowdown against the baseline (0.25 = 25%%).")
+    parser.add_argument('-save', type=str, help="Write this run's report (JSON) here, e.g. as the next baseline.")
+    parser.add_argument('-keep', type=str, help="Keep the phantoms and outputs under this directory.")
+    parser.add_argument('-ext', type=str, choices=('.nii', '.nii.gz'), default=images.work_ext(),
+                        help="Format of the phantom and intermediate images (the pipeline uses .nii).")
+    args = parser.parse_args(argv)
+    os.environ[images.WORK_EXT_ENV] = args.ext
+
+    # Stages depend on the outputs of the ones before them
+    stages = [s for s in STAGES if s in args.stages]
+    if args.keep:
+        os.makedirs(args.keep, exist_ok=True)
+
+    report = {"host": {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+                       "cpus": os.cpu_count(), "threads": threads.budget()},
+              "ext": args.ext,
+              "sizes": {}}
+    for n, reps in args.sizes:
+        print(f"Running {n}^3 x {reps} repetitions", flush=True)
+        report["sizes"][f"{n}x{reps}"] = run_size(n, reps, stages, args.jobs, args.repeat, args.keep)
+
+    problems = []
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            problems = compare(report, json.load(f), args.tolerance)
+
+    print_report(report)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.save}")
+
+    for problem in problems:
+        print(f"REGRESSION {problem}", file=sys.stderr)
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,53 +1,277 @@
 import os
+import json
 import numpy as np
 import nibabel as nib
-import subprocess
 import argparse
-import sys
 
-parser = argparse.ArgumentParser(description='get dcm parameters from the pipeline script')
+import images
 
-# Set up parser for the parameters extracted from the dicom header
-parser.add_argument('-m0', type=str, help="The path to the m0 file.")
-parser.add_argument('-asl', type=str, help="The path to the ASL file.")
-parser.add_argument('-m', type=str, help="The path to the mask file.")
-parser.add_argument('-ld',  type=int, help='An integer number.')
-parser.add_argument('-pld', type=int, help='An integer number.')
-parser.add_argument('-nbs', type=int, help='An integer number.')
-parser.add_argument('-scale',type=float, help='An integer number.')
-parser.add_argument('-out',type=str, help='The output directory.')
-args = parser.parse_args()
+# Quantification constants (single-PLD pCASL, white paper model)
+ALPHA = 0.8      # labeling efficiency
+LMBDA = 0.9      # blood-brain partition coefficient (mL/g)
+T1B = 1.6        # T1 of arterial blood (s)
 
-nameref = args.m0
-ref_data = nib.load(nameref).get_fdata().astype(np.float64)
+# SCORE: pairs whose mean GM CBF is this many SDs from the median are rejected before the iterative step
+SCORE_THRESHOLD = 2.5
+# Robust averaging never keeps fewer pairs than this
+SCORE_MIN_PAIRS = 2
+# Voxels per block when SCORE sums the per-pair products of a class
+GRAM_BLOCK = 1 << 15
 
-nameasl = args.asl
-asl_data = nib.load(nameasl).get_fdata().astype(np.float64)
 
-namemask = args.m
-mask_data = nib.load(namemask).get_fdata().astype(np.float64)
-####
+def cbf_factor(ld, pld, nbs):
+    # Scalar converting ASL/M0 into mL/100g/min, ld and pld in microseconds
+    abs_val = 0.95 ** nbs
+    ld = ld / 10**6
+    pld = pld / 10**6
+    return (6000 * LMBDA * np.exp(pld / T1B)) / ((2 * ALPHA * abs_val * T1B) * (1 - np.exp(-ld / T1B)))
 
-m0 = ref_data * args.scale
-a = 0.8
-abs_val = 0.95 ** args.nbs
-lmbda = 0.9
-t1b = 1.6
-ld = args.ld/10**6
-pld = args.pld/10**6
 
-cbf = (asl_data / m0) * (6000 * lmbda * np.exp(pld / t1b)) / ((2 * a * abs_val * t1b) * (1 - np.exp(-ld / t1b)))
-cbf[np.isinf(cbf) | np.isnan(cbf)] = 0
+def quantify(asl, m0, mask, scale, factor):
+    """CBF in float32, computed only over mask voxels.
 
-cbf = cbf * mask_data
+    `asl` may be 3D or 4D (x, y, z, repetitions); a 4D input is averaged over
+    repetitions per voxel. Non-finite values and voxels outside the mask are 0.
+    """
+    inside = np.asarray(mask) > 0
+    cbf = np.zeros(inside.shape, dtype=np.float32)
+    if not inside.any():
+        return cbf
 
-modified_img = nib.Nifti1Image(cbf, nib.load(namemask).affine, nib.load(namemask).header)
+    m0_vox = np.asarray(m0[inside], dtype=np.float32)
+    if m0_vox.ndim == 2:
+        m0_vox = m0_vox[:, 0]
+    m0_vox = m0_vox * np.float32(scale)
+    asl_vox = np.asarray(asl[inside], dtype=np.float32)
+    if asl_vox.ndim == 2:
+        asl_vox = asl_vox.mean(axis=1, dtype=np.float32)
 
-out_dir = args.out
-print(out_dir)
-nameout = os.path.join(out_dir, 'cbf.nii.gz')
-nib.save(modified_img, nameout)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vox = asl_vox / m0_vox
+    vox *= np.float32(factor)
+    vox[~np.isfinite(vox)] = 0
+    cbf[inside] = vox
+    return cbf
 
 
+def quantify_pairs(asl, m0, mask, scale, factor):
+    """CBF of every repetition of a 4D difference series, as (mask voxels, repetitions) float32.
 
+    One broadcast over the in-mask voxels of all repetitions; non-finite values are 0.
+    """
+    inside = np.asarray(mask) > 0
+    m0_vox = np.asarray(m0[inside], dtype=np.float32)
+    if m0_vox.ndim == 2:
+        m0_vox = m0_vox[:, 0]
+    asl_vox = np.asarray(asl[inside], dtype=np.float32).reshape(len(m0_vox), -1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        series = asl_vox / (m0_vox[:, None] * np.float32(scale))
+    series *= np.float32(factor)
+    series[~np.isfinite(series)] = 0
+    return series
 
+
+def perfusion_classes(series):
+    # Without a segmentation, voxels above the median CBF stand in for GM and the rest for WM/CSF.
+    # Voxels are ranked by their median over pairs, so an outlier pair does not pick the classes it is judged on
+    level = np.median(series, axis=1)
+    gm = level > np.median(level)
+    return gm, ~gm
+
+
+def pooled_variance(w, sizes, sums, grams):
+    """Pooled within-class spatial variance of the mean CBF over the pairs in `w` (0/1 per pair).
+
+    Returns the variance of the current mean and, per pair, of the mean without it.
+    """
+    n = w.sum()
+    current = 0.0
+    loo = np.zeros(len(w))
+    for size, s, g in zip(sizes, sums, grams):
+        if size == 0:
+            continue
+        gw = g @ w
+        ss, sm = w @ gw, s @ w
+        current += (ss / size - (sm / size) ** 2) / n ** 2 * size
+        loo += ((ss - 2 * gw + np.diag(g)) / size - ((sm - s) / size) ** 2) / (n - 1) ** 2 * size
+    total = sum(sizes)
+    return current / total, loo / total
+
+
+def score(series, classes, threshold=SCORE_THRESHOLD, min_pairs=SCORE_MIN_PAIRS):
+    """SCORE-style robust averaging of per-pair CBF (Dolui et al., 2017).
+
+    Pairs whose mean GM CBF (voxels of classes[0]) deviates from the median
+    by more than `threshold` SDs are rejected first. Then the pair whose
+    removal lowers the pooled within-class spatial variance of the mean CBF
+    the most is rejected, as long as that variance goes down. Each class'
+    variance is a function of its per-pair sums and Gram matrix, both worked out
+    once, so every iteration scores all the remaining pairs in a few vector operations.
+    Returns (kept mask over pairs, [(pair, reason)] in rejection order).
+    """
+    n_pairs = series.shape[1]
+    kept = np.ones(n_pairs, dtype=bool)
+    rejected = []
+
+    gm_cbf = series[classes[0]].mean(axis=0, dtype=np.float64)
+    sd = gm_cbf.std(ddof=1) if n_pairs > 1 else 0.0
+    deviation = np.abs(gm_cbf - np.median(gm_cbf))
+    for pair in np.argsort(-deviation)[:max(0, n_pairs - min_pairs)]:
+        if sd == 0 or deviation[pair] <= threshold * sd:
+            break
+        kept[pair] = False
+        rejected.append((int(pair), "gm_outlier"))
+
+    sizes, sums, grams = [], [], []
+    for c in classes:
+        rows = np.flatnonzero(c)
+        sizes.append(len(rows))
+        sums.append(np.zeros(n_pairs))
+        grams.append(np.zeros((n_pairs, n_pairs)))
+        # In blocks of rows, so no float64 copy of the class is made
+        for b in range(0, len(rows), GRAM_BLOCK):
+            x = series[rows[b:b + GRAM_BLOCK]].astype(np.float64)
+            sums[-1] += x.sum(axis=0)
+            grams[-1] += x.T @ x
+    if sum(sizes) == 0:
+        return kept, rejected
+
+    while kept.sum() > min_pairs:
+        current, loo = pooled_variance(kept.astype(np.float64), sizes, sums, grams)
+        loo[~kept] = np.inf
+        pair = int(np.argmin(loo))
+        if loo[pair] >= current:
+            break
+        kept[pair] = False
+        rejected.append((pair, "variance"))
+    return kept, rejected
+
+
+def write_score(path, gm_cbf, kept, rejected):
+    # Which pairs went into the CBF map, and why the others did not
+    report = {"pairs": len(kept), "kept": [int(i) for i in np.flatnonzero(kept)],
+              "rejected": [{"pair": pair, "reason": reason} for pair, reason in rejected],
+              "gm_cbf": [round(float(v), 3) for v in gm_cbf]}
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp, path)
+
+
+def slab_ranges(n_z, slab):
+    # (z0, z1) of the z-slabs, one slab of the whole volume if slab is 0
+    slab = slab if slab > 0 else n_z
+    return [(z0, min(z0 + slab, n_z)) for z0 in range(0, n_z, slab)]
+
+
+def quantify_slabs(asl_img, m0_img, mask_img, scale, factor, slab=16):
+    # Stream the inputs from disk in z-slabs so only one slab is in memory at a time
+    shape = mask_img.shape[:3]
+    cbf = np.zeros(shape, dtype=np.float32)
+    for z0, z1 in slab_ranges(shape[2], slab):
+        mask = np.asanyarray(mask_img.dataobj[:, :, z0:z1])
+        # Slabs without brain are never read from the ASL/M0 files
+        if not (mask > 0).any():
+            continue
+        m0 = np.asarray(m0_img.dataobj[:, :, z0:z1], dtype=np.float32)
+        asl = np.asarray(asl_img.dataobj[:, :, z0:z1], dtype=np.float32)
+        cbf[:, :, z0:z1] = quantify(asl, m0, mask, scale, factor)
+    return cbf
+
+
+def quantify_pair_slabs(asl_img, m0_img, mask_img, scale, factor, slab=16):
+    """Per-pair CBF of the mask voxels, streamed from disk in z-slabs.
+
+    Only the in-mask rows of each slab are kept, so the largest arrays are
+    one slab of the series and the (mask voxels, pairs) result. Returns the
+    result and the [(z0, z1, slab mask)] that scatter_slabs puts rows back with.
+    """
+    full_mask = np.asanyarray(mask_img.dataobj) > 0
+    n_pairs = asl_img.shape[3] if len(asl_img.shape) > 3 else 1
+    # Filled in place, slab by slab
+    series = np.zeros((int(full_mask.sum()), n_pairs), dtype=np.float32)
+    slabs = []
+    start = 0
+    for z0, z1 in slab_ranges(full_mask.shape[2], slab):
+        mask = full_mask[:, :, z0:z1]
+        n = int(mask.sum())
+        if n == 0:
+            continue
+        m0 = np.asarray(m0_img.dataobj[:, :, z0:z1], dtype=np.float32)
+        asl = np.asarray(asl_img.dataobj[:, :, z0:z1], dtype=np.float32)
+        series[start:start + n] = quantify_pairs(asl, m0, mask, scale, factor).reshape(n, n_pairs)
+        slabs.append((z0, z1, mask))
+        start += n
+    return series, slabs
+
+
+def scatter_slabs(values, slabs, shape):
+    # Volume of per-voxel values in the row order of quantify_pair_slabs, 0 outside the mask
+    volume = np.zeros(shape, dtype=np.float32)
+    start = 0
+    for z0, z1, mask in slabs:
+        n = int(mask.sum())
+        volume[:, :, z0:z1][mask] = values[start:start + n]
+        start += n
+    return volume
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='get dcm parameters from the pipeline script')
+
+    # Set up parser for the parameters extracted from the dicom header
+    parser.add_argument('-m0', type=str, help="The path to the m0 file.")
+    parser.add_argument('-asl', type=str, help="The path to the ASL file.")
+    parser.add_argument('-m', type=str, help="The path to the mask file.")
+    parser.add_argument('-ld',  type=int, help='An integer number.')
+    parser.add_argument('-pld', type=int, help='An integer number.')
+    parser.add_argument('-nbs', type=int, help='An integer number.')
+    parser.add_argument('-scale',type=float, help='An integer number.')
+    parser.add_argument('-out',type=str, help='The output directory.')
+    parser.add_argument('-slab', type=int, default=0, help='Stream the volumes in slabs of this many z slices (0 loads them whole).')
+    parser.add_argument('-score', type=str, help='With a 4D difference series as -asl: quantify every pair, average them '
+                                                 'with SCORE outlier rejection and write the kept/rejected pairs to this JSON file.')
+    args = parser.parse_args(argv)
+
+    # Shared with earlier steps of the process and memory-mapped, so slabs only page in what they read
+    ref_img = images.load(args.m0)
+    asl_img = images.load(args.asl)
+    mask_img = images.load(args.m)
+
+    factor = cbf_factor(args.ld, args.pld, args.nbs)
+
+    if args.score:
+        # Per-pair CBF (cbf_pairs) and the robust mean of the pairs SCORE keeps; -slab streams the inputs
+        series, slabs = quantify_pair_slabs(asl_img, ref_img, mask_img, args.scale, factor, args.slab)
+        classes = perfusion_classes(series)
+        kept, rejected = score(series, classes)
+        write_score(args.score, series[classes[0]].mean(axis=0, dtype=np.float64), kept, rejected)
+        print(f"SCORE kept {kept.sum()} of {len(kept)} pairs, rejected {[pair for pair, _ in rejected]}")
+
+        shape = mask_img.shape[:3]
+        # A product rather than series[:, kept].mean() avoids copying the kept columns
+        cbf = scatter_slabs(series @ (kept / kept.sum()).astype(np.float32), slabs, shape)
+        # cbf_pairs is written a volume at a time
+        with images.VolumeWriter(images.work_file(args.out, 'cbf_pairs'), mask_img.header,
+                                 shape + (series.shape[1],)) as writer:
+            for pair in range(series.shape[1]):
+                writer.write(scatter_slabs(series[:, pair], slabs, shape))
+    elif args.slab > 0:
+        cbf = quantify_slabs(asl_img, ref_img, mask_img, args.scale, factor, args.slab)
+    else:
+        cbf = quantify(np.asarray(asl_img.dataobj, dtype=np.float32),
+                       np.asarray(ref_img.dataobj, dtype=np.float32),
+                       np.asanyarray(mask_img.dataobj), args.scale, factor)
+
+    header = mask_img.header.copy()
+    header.set_data_dtype(np.float32)
+    modified_img = nib.Nifti1Image(cbf, mask_img.affine, header)
+
+    out_dir = args.out
+    print(out_dir)
+    nameout = images.work_file(out_dir, 'cbf')
+    images.save(modified_img, nameout)
+
+
+if __name__ == "__main__":
+    main()
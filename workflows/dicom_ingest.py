@@ -0,0 +1,296 @@
+import io
+import os
+import re
+import sys
+import json
+import zipfile
+import argparse
+from functools import partial
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+
+import images
+import threads
+
+# DICOM patient coordinates are LPS, NIfTI affines RAS
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+# Slice positions closer than this (mm) are the same slice
+POSITION_TOL = 1e-3
+# Sequence file of the Siemens protocol, what dcm2niix reports as PulseSequenceDetails
+SEQUENCE_FILE = re.compile(rb'tSequenceFileName\s*=\s*"+([^"\r\n]*)"+')
+# Header fields copied to the JSON sidecar under their DICOM keywords (BIDS names where they differ)
+SIDECAR_FIELDS = ("Modality", "Manufacturer", "ManufacturerModelName", "MagneticFieldStrength", "SeriesDescription",
+                  "ProtocolName", "SeriesNumber", "SequenceName", "ImageType", "AcquisitionTime", "SliceThickness",
+                  "FlipAngle", "SeriesInstanceUID", "SoftwareVersions")
+
+
+class IngestError(Exception):
+    pass
+
+
+@contextmanager
+def source_files(source):
+    """(name, read) of every file of a zip archive or a folder tree, in name order.
+
+    `read()` returns the file's bytes; zip members are decompressed in memory,
+    nothing is extracted to disk.
+    """
+    if os.path.isfile(source) and zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as zf:
+            names = sorted(info.filename for info in zf.infolist() if not info.is_dir())
+            yield [(name, partial(zf.read, name)) for name in names]
+        return
+
+    def read(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    if os.path.isfile(source):
+        yield [(source, partial(read, source))]
+        return
+    files = []
+    for root, dirs, names in os.walk(source):
+        dirs.sort()
+        files += [(os.path.join(root, name), partial(read, os.path.join(root, name))) for name in sorted(names)]
+    yield files
+
+
+def _value(item, keyword, default=None):
+    value = getattr(item, keyword, None) if item is not None else None
+    return default if value is None or value == '' else value
+
+
+def _plain(value):
+    # Header values as JSON types (pydicom's DS/IS subclass float/int, multi-values are sequences)
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, bytes):
+        return value.decode('latin-1').strip()
+    try:
+        return [_plain(v) for v in value]
+    except TypeError:
+        return str(value)
+
+
+def _functional(group, shared, sequence):
+    # Item of a functional group macro, per frame if present else shared
+    for item in (group, shared):
+        if item is not None and sequence in item:
+            return item[sequence].value[0]
+    return None
+
+
+def pulse_sequence(data):
+    """The protocol's sequence file as dcm2niix reports it, None if the file has no Siemens protocol."""
+    sequence = SEQUENCE_FILE.search(data)
+    if sequence is None:
+        return None
+    # The protocol doubles backslashes; dcm2niix writes them once
+    return sequence.group(1).decode('latin-1').replace('\\\\', '\\')
+
+
+def read_frames(name, read):
+    """Header and pixel frames of one DICOM file, None if it is not a DICOM image.
+
+    Each frame is (position, orientation, spacing, thickness, slope, intercept,
+    order, pixels), from the file itself or, in enhanced multi-frame files, from
+    its functional groups. Runs in the ingest's worker threads.
+    """
+    data = read()
+    if data[128:132] != b"DICM":
+        return None
+    import pydicom
+    try:
+        ds = pydicom.dcmread(io.BytesIO(data))
+    except Exception as e:
+        raise IngestError(f"{name}: {e}")
+    if "PixelData" not in ds:
+        return None
+    if "MOSAIC" in [str(v).upper() for v in _value(ds, "ImageType", [])]:
+        raise IngestError(f"{name}: Siemens mosaic images are not supported")
+    try:
+        pixels = ds.pixel_array
+    except Exception as e:
+        raise IngestError(f"{name}: cannot decode pixel data ({ds.file_meta.TransferSyntaxUID}): {e}")
+
+    frames = []
+    if "PerFrameFunctionalGroupsSequence" in ds:
+        shared = ds.SharedFunctionalGroupsSequence[0] if "SharedFunctionalGroupsSequence" in ds else None
+        pixels = pixels.reshape((-1,) + pixels.shape[-2:])
+        for index, group in enumerate(ds.PerFrameFunctionalGroupsSequence):
+            plane = _functional(group, shared, "PlanePositionSequence")
+            orientation = _functional(group, shared, "PlaneOrientationSequence")
+            measures = _functional(group, shared, "PixelMeasuresSequence")
+            scaling = _functional(group, shared, "PixelValueTransformationSequence")
+            content = _functional(group, shared, "FrameContentSequence")
+            order = (int(_value(content, "TemporalPositionIndex", 0)), int(_value(content, "FrameAcquisitionNumber", 0)), index)
+            frames.append((_value(plane, "ImagePositionPatient"), _value(orientation, "ImageOrientationPatient"),
+                           _value(measures, "PixelSpacing"), _value(measures, "SliceThickness"),
+                           _value(scaling, "RescaleSlope", 1), _value(scaling, "RescaleIntercept", 0), order, pixels[index]))
+    else:
+        order = (int(_value(ds, "AcquisitionNumber", 0)), int(_value(ds, "InstanceNumber", 0)), 0)
+        frames.append((_value(ds, "ImagePositionPatient"), _value(ds, "ImageOrientationPatient"), _value(ds, "PixelSpacing"),
+                       _value(ds, "SliceThickness"), _value(ds, "RescaleSlope", 1), _value(ds, "RescaleIntercept", 0),
+                       order, pixels))
+    for frame in frames:
+        if frame[0] is None or frame[1] is None or frame[2] is None:
+            raise IngestError(f"{name}: no image position, orientation or pixel spacing")
+
+    header = {key: _plain(_value(ds, key)) for key in SIDECAR_FIELDS + ("RepetitionTime", "EchoTime")}
+    sequence = pulse_sequence(data)
+    if sequence:
+        header["PulseSequenceDetails"] = sequence
+    return str(ds.SeriesInstanceUID), header, frames
+
+
+def assemble(frames):
+    """(data, affine, slope, intercept) of a series from its frames.
+
+    Frames are grouped into slices by their position along the slice normal
+    and each slice's frames are put in acquisition order, one per volume.
+    """
+    orientation = np.asarray(frames[0][1], dtype=np.float64)
+    if any(not np.allclose(f[1], orientation, atol=1e-4) for f in frames):
+        raise IngestError("Frames of the series have different orientations")
+    row, col = orientation[:3], orientation[3:]
+    normal = np.cross(row, col)
+    positions = np.array([np.asarray(f[0], dtype=np.float64) for f in frames])
+    along = positions @ normal
+
+    slice_of = np.zeros(len(frames), dtype=np.int64)
+    order = np.argsort(along, kind='stable')
+    slice_of[order[1:]] = np.cumsum(np.diff(along[order]) > POSITION_TOL)
+    n_slices = int(slice_of.max()) + 1
+    counts = np.bincount(slice_of)
+    if np.any(counts != counts[0]):
+        raise IngestError(f"Slices have different numbers of frames ({counts.min()} to {counts.max()})")
+    n_volumes = int(counts[0])
+
+    # Frame index of every (slice, volume)
+    layout = [sorted(np.flatnonzero(slice_of == k), key=lambda i: frames[i][6]) for k in range(n_slices)]
+    slopes = {(float(f[4]), float(f[5])) for f in frames}
+    rows, cols = frames[0][7].shape
+    # Frames scaled differently are brought to real values here, otherwise the scaling goes in the header
+    dtype = np.float32 if len(slopes) > 1 else np.result_type(*{f[7].dtype for f in frames})
+    data = np.empty((cols, rows, n_slices, n_volumes), dtype=dtype)
+    for k, members in enumerate(layout):
+        for t, i in enumerate(members):
+            if len(slopes) > 1:
+                data[:, :, k, t] = frames[i][7].T * np.float32(frames[i][4]) + np.float32(frames[i][5])
+            else:
+                data[:, :, k, t] = frames[i][7].T
+    slope, intercept = slopes.pop() if len(slopes) == 1 else (1.0, 0.0)
+
+    # Voxel (i, j, k): i runs along a row (column index), j down the columns (row index)
+    first = positions[order[0]]
+    last = positions[order[-1]]
+    spacing = np.asarray(frames[0][2], dtype=np.float64)
+    if n_slices > 1:
+        step = (last - first) / (n_slices - 1)
+    else:
+        step = normal * float(frames[0][3] or 1.0)
+    affine = np.eye(4)
+    affine[:3, 0] = row * spacing[1]
+    affine[:3, 1] = col * spacing[0]
+    affine[:3, 2] = step
+    affine[:3, 3] = first
+
+    if n_volumes == 1:
+        data = data[..., 0]
+    return data, LPS_TO_RAS @ affine, slope, intercept
+
+
+def series_name(header):
+    # dcm2niix -f %d: the series description with characters unsafe in file names replaced
+    description = str(header.get("SeriesDescription") or header.get("ProtocolName") or "series")
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', description).strip('_') or "series"
+
+
+def sidecar(header, n_volumes):
+    # BIDS-style sidecar: times in seconds like dcm2niix writes them
+    fields = {key: header[key] for key in SIDECAR_FIELDS if header.get(key) is not None}
+    for key in ("RepetitionTime", "EchoTime"):
+        if header.get(key) is not None:
+            fields[key] = header[key] / 1000
+    if header.get("PulseSequenceDetails"):
+        fields["PulseSequenceDetails"] = header["PulseSequenceDetails"]
+    fields["Volumes"] = n_volumes
+    fields["ConversionSoftware"] = "aslscp dicom_ingest"
+    return fields
+
+
+def write_series(out_dir, name, header, data, affine, slope, intercept):
+    img = nib.Nifti1Image(data, affine)
+    img.header.set_xyzt_units('mm', 'sec')
+    if header.get("RepetitionTime") is not None and data.ndim == 4:
+        zooms = img.header.get_zooms()
+        img.header.set_zooms(zooms[:3] + (header["RepetitionTime"] / 1000,))
+    img.set_qform(affine, code=1)
+    img.set_sform(affine, code=1)
+    img.header.set_slope_inter(slope, intercept)
+    nii = os.path.join(out_dir, name + '.nii')
+    images.save(img, nii)
+
+    path = os.path.join(out_dir, name + '.json')
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(sidecar(header, data.shape[3] if data.ndim == 4 else 1), f, indent=2)
+    os.replace(tmp, path)
+    return nii
+
+
+def ingest(source, out_dir, jobs=None):
+    """Write every image series of a DICOM zip or folder as <series description>.nii and .json.
+
+    Files are decoded in parallel threads straight from the archive. Series are
+    written in SeriesInstanceUID order; a description used by several series
+    gets the series number appended, so the names do not depend on timing.
+    Returns the written NIfTI paths.
+    """
+    jobs = max(1, jobs or threads.budget())
+    with source_files(source) as files:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = [r for r in pool.map(lambda f: read_frames(*f), files) if r is not None]
+    if not results:
+        raise IngestError(f"No DICOM images in {source}")
+
+    series = {}
+    for uid, header, frames in results:
+        entry = series.setdefault(uid, {"header": header, "frames": []})
+        entry["frames"] += frames
+        if not entry["header"].get("PulseSequenceDetails") and header.get("PulseSequenceDetails"):
+            entry["header"]["PulseSequenceDetails"] = header["PulseSequenceDetails"]
+
+    names = {uid: series_name(entry["header"]) for uid, entry in series.items()}
+    written = []
+    os.makedirs(out_dir, exist_ok=True)
+    for uid in sorted(series):
+        name = names[uid]
+        if list(names.values()).count(name) > 1:
+            name = f"{name}_{series[uid]['header'].get('SeriesNumber') or uid.rsplit('.', 1)[-1]}"
+        data, affine, slope, intercept = assemble(series[uid]["frames"])
+        written.append(write_series(out_dir, name, series[uid]["header"], data, affine, slope, intercept))
+        print(f"Series {uid}: {data.shape} -> {written[-1]}")
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert the DICOM series of a zip or folder to NIfTI and JSON in memory.')
+    parser.add_argument('-in', dest='source', type=str, help="The DICOM zip archive or folder.")
+    parser.add_argument('-out', type=str, help="The output directory (<series description>.nii/.json).")
+    parser.add_argument('-jobs', type=int, default=threads.budget(), help="Files decoded in parallel.")
+    args = parser.parse_args(argv)
+
+    try:
+        ingest(args.source, args.out, args.jobs)
+    except (IngestError, ImportError) as e:
+        sys.exit(f"DICOM ingest: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import os
+import sys
+import gzip
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import threads
+
+# zlib level of the exported images (gzip's default) and the chunk size fed to it
+LEVEL = 6
+CHUNK = 4 << 20
+
+
+def compress(src, dst, level=LEVEL):
+    # zlib releases the GIL while it compresses a chunk, so files compress in parallel threads.
+    # mtime=0 keeps the output identical for identical input.
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    with open(src, 'rb') as fin, open(tmp, 'wb') as raw, \
+            gzip.GzipFile(filename='', mode='wb', compresslevel=level, fileobj=raw, mtime=0) as fout:
+        shutil.copyfileobj(fin, fout, CHUNK)
+    os.replace(tmp, dst)
+
+
+def export_file(src, out_dir, level=LEVEL):
+    """Move a work image into `out_dir` as .nii.gz, compressing a plain .nii on the way."""
+    name = os.path.basename(src)
+    if name.endswith('.nii'):
+        dst = os.path.join(out_dir, name + '.gz')
+        compress(src, dst, level)
+        os.remove(src)
+    else:
+        dst = os.path.join(out_dir, name)
+        shutil.move(src, dst)
+    return dst
+
+
+def export_all(files, out_dir, jobs=None, level=LEVEL):
+    files = [f for f in files if os.path.exists(f)]
+    jobs = max(1, min(jobs or threads.budget(), len(files) or 1))
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(lambda f: export_file(f, out_dir, level), files))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export work images to the output directory, gzipping them in parallel.')
+    parser.add_argument('-out', type=str, help="The output directory.")
+    parser.add_argument('-files', type=str, nargs='+', help="The images to export (missing ones are skipped).")
+    parser.add_argument('-jobs', type=int, default=threads.budget(), help="Number of files compressed at once.")
+    parser.add_argument('-level', type=int, default=LEVEL, help="gzip compression level.")
+    args = parser.parse_args(argv)
+
+    for src in args.files:
+        if not os.path.exists(src):
+            print(f"Not exporting {src}: no such file", file=sys.stderr)
+    for dst in export_all(args.files, args.out, args.jobs, args.level):
+        print(f"Exported {dst}")
+
+
+if __name__ == "__main__":
+    main()
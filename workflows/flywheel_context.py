@@ -1,123 +1,246 @@
-import sys
 import os
-import logging
-import flywheel
 import json
-import glob
-import shutil
+import time
+import logging
+import argparse
+import threading
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-print(sys.path)
+import stage_cache
 
-# logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('aslscp')
-logger.info("=======: ASL gear :=======")
-
-with flywheel.GearContext() as context:
-    # Setup basic logging
-    context.init_logging()
-    config = context.config
-    analysis_id = context.destination['id']
-    gear_output_dir = context.output_dir
-    
-    # Fix the working directory path issue
-    working_dir = Path(gear_output_dir).resolve().parent / f"{Path(gear_output_dir).name}_work"
-    working_dir.mkdir(parents=True, exist_ok=True)
-    
-    # Set workdir for compatibility
-    workdir = str(working_dir)
-
-    # Get relevant container objects
-    fw = flywheel.Client(context.get_input('api_key')['key'])
-    analysis_container = fw.get(analysis_id)
-    project_container = fw.get(analysis_container.parents['project'])
-    session_container = fw.get(analysis_container.parent['id'])
-    subject_container = fw.get(session_container.parents['subject'])
-
-    # Get subject, session, and project labels
-    session_label = session_container.label
-    subject_label = subject_container.label
-    project_label = project_container.label
-    
-    # Get current runtime timestamp
-    gear_run_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    # Extract scan date from session label
-    # Expected format: ${subject label}x${scan date}x3Tx${studyname}
-    scan_date = "Unknown"
-    try:
-        session_parts = session_label.split('x')
-        if len(session_parts) >= 3:
-            # Second element should be the scan date
-            scan_date = session_parts[1]
-            logger.info(f"Extracted scan date: {scan_date} from session label: {session_label}")
-        else:
-            logger.warning(f"Session label format unexpected: {session_label}")
-            logger.warning("Expected format: subjectxScanDatex3TxStudyName")
-    except Exception as e:
-        logger.warning(f"Could not parse scan date from session label '{session_label}': {e}")
-        scan_date = "Unknown"
-    
-    # Get acquisition label - need to determine which acquisition this analysis belongs to
-    acquisition_label = "Unknown"
+
+# Bump when the cached fields change so old entries are refetched
+CACHE_VERSION = 1
+# A fixture file here (or -fake) replaces the Flywheel API with FakeClient
+FAKE_ENV = 'ASLSCP_FLYWHEEL_FAKE'
+# Fields of metadata.txt, in order, with their labels
+FIELDS = (("project_label", "Project"), ("subject_label", "Subject"), ("session_label", "Session"),
+          ("acquisition_label", "Acquisition"), ("analysis_id", "Analysis ID"), ("scan_date", "Scan Date"),
+          ("gear_run_datetime", "Gear Run Date/Time"))
+
+RETRIES = 4
+
+
+class FakeContainer:
+    """Container of a FakeClient: id, type, label, parent and parents like the SDK models."""
+
+    def __init__(self, client, cid, record):
+        self._client = client
+        self.id = cid
+        self.container_type = record.get("type")
+        self.label = record.get("label")
+        self.parent = record.get("parent", {})
+        self.parents = record.get("parents", {})
+
+    @property
+    def acquisitions(self):
+        return FakeFinder([c for c in self._client.containers()
+                           if c.container_type == "acquisition" and c.parent.get("id") == self.id])
+
+
+class FakeFinder:
+    def __init__(self, items):
+        self.items = items
+
+    def __call__(self):
+        return list(self.items)
+
+    def find_first(self):
+        return self.items[0] if self.items else None
+
+
+class FakeClient:
+    """Offline stand-in for flywheel.Client, serving containers from a JSON fixture.
+
+    The fixture is {"destination": analysis id, "containers": {id: {"type",
+    "label", "parent", "parents"}}}; `calls` counts the get() round trips.
+    """
+
+    def __init__(self, fixture):
+        with open(fixture, 'r') as f:
+            data = json.load(f)
+        self.destination = data.get("destination")
+        self._records = data.get("containers", {})
+        self.calls = 0
+        # resolve() calls get() from several threads
+        self._lock = threading.Lock()
+
+    def containers(self):
+        return [FakeContainer(self, cid, record) for cid, record in self._records.items()]
+
+    def get(self, cid):
+        with self._lock:
+            self.calls += 1
+        if cid not in self._records:
+            raise LookupError(f"No container {cid} in the fixture")
+        return FakeContainer(self, cid, self._records[cid])
+
+
+def _parent(container, key):
+    # Parent id from the SDK's ContainerParents (or a fixture dict), None if absent
     try:
-        # If this is an acquisition-level analysis, get the acquisition
-        if 'acquisition' in analysis_container.parent:
-            acquisition_container = fw.get(analysis_container.parent['id'])
-            acquisition_label = acquisition_container.label
-        else:
-            # If session-level analysis, you might want to get a specific acquisition
-            # or list all acquisitions in the session
-            acquisitions = session_container.acquisitions()
-            if acquisitions:
-                # Take the first acquisition or implement logic to select the right one
-                acquisition_label = acquisitions[0].label
-                logger.info(f"Multiple acquisitions found, using: {acquisition_label}")
-    except Exception as e:
-        logger.warning(f"Could not determine acquisition label: {e}")
-        acquisition_label = "Unknown"
-
-    subjects = [subject_container.label]
-    sessions = [session_container.label]
-
-    # Define the output file path
-    INFO_OUT = os.path.join(workdir, "metadata.txt")
-    
-    # Create metadata dictionary
-    metadata = {
-        "project_label": project_label,
-        "subject_label": subject_label,
-        "session_label": session_label,
-        "acquisition_label": acquisition_label,
+        return container.parents[key]
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+
+def fetch(fw, cid):
+    # fw.get with backoff when the API rate-limits us (HTTP 429) or is briefly unavailable
+    for attempt in range(RETRIES):
+        try:
+            return fw.get(cid)
+        except Exception as e:
+            if getattr(e, 'status', None) not in (429, 502, 503) or attempt == RETRIES - 1:
+                raise
+            delay = 0.5 * 2 ** attempt
+            logger.warning(f"Flywheel returned {e.status} for {cid}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def acquisition_label(fw, analysis, session):
+    # Acquisition-level analyses know their acquisition; session-level ones take the first one
+    # without listing them all
+    if analysis.parent['type'] == 'acquisition':
+        return fetch(fw, analysis.parent['id']).label
+    first = session.acquisitions.find_first()
+    if first is not None:
+        logger.info(f"Session-level analysis, using acquisition: {first.label}")
+        return first.label
+    return "Unknown"
+
+
+def resolve(fw, analysis_id):
+    """Labels of the analysis' project, subject, session and acquisition.
+
+    The analysis lists all its parents, so everything after it is fetched in parallel.
+    """
+    analysis = fetch(fw, analysis_id)
+    session_id = _parent(analysis, 'session') or analysis.parent['id']
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        project = pool.submit(fetch, fw, _parent(analysis, 'project'))
+        session = pool.submit(fetch, fw, session_id)
+        subject_id = _parent(analysis, 'subject')
+        subject = pool.submit(fetch, fw, subject_id) if subject_id else None
+        acquisition = None
+        if analysis.parent['type'] == 'acquisition':
+            acquisition = pool.submit(acquisition_label, fw, analysis, None)
+
+        session = session.result()
+        subject = subject.result() if subject else fetch(fw, _parent(session, 'subject'))
+        try:
+            acquisition = acquisition.result() if acquisition else acquisition_label(fw, analysis, session)
+        except Exception as e:
+            logger.warning(f"Could not determine acquisition label: {e}")
+            acquisition = "Unknown"
+        project = project.result()
+
+    return {
+        "project_label": project.label,
+        "subject_label": subject.label,
+        "session_label": session.label,
+        "acquisition_label": acquisition,
         "analysis_id": analysis_id,
-        "scan_date": scan_date,
-        "gear_run_datetime": gear_run_datetime
+        "scan_date": scan_date(session.label),
     }
-    
-    # Write metadata to text file
-    try:
-        with open(INFO_OUT, 'w') as f:
-            f.write("=== Flywheel Metadata ===\n")
-            f.write(f"Project: {project_label}\n")
-            f.write(f"Subject: {subject_label}\n")
-            f.write(f"Session: {session_label}\n")
-            f.write(f"Acquisition: {acquisition_label}\n")
-            f.write(f"Analysis ID: {analysis_id}\n")
-            f.write(f"Scan Date: {scan_date}\n")
-            f.write(f"Gear Run Date/Time: {gear_run_datetime}\n")
-            f.write("========================\n")
-            
-            # Also write as JSON for machine readability
-            f.write("\nJSON Format:\n")
-            json.dump(metadata, f, indent=2)
-            f.write("\n")
-        
-        logger.info(f"Metadata written to: {INFO_OUT}")
-        logger.info(f"Metadata content: {metadata}")
-        
-    except Exception as e:
-        logger.error(f"Failed to write metadata file: {e}")
-        raise
 
+
+def scan_date(session_label):
+    # Expected format: ${subject label}x${scan date}x3Tx${studyname}
+    session_parts = session_label.split('x')
+    if len(session_parts) >= 3:
+        logger.info(f"Extracted scan date: {session_parts[1]} from session label: {session_label}")
+        return session_parts[1]
+    logger.warning(f"Session label format unexpected: {session_label}")
+    logger.warning("Expected format: subjectxScanDatex3TxStudyName")
+    return "Unknown"
+
+
+def cache_file(cache_dir, analysis_id):
+    return os.path.join(cache_dir, 'flywheel', f"{analysis_id}.json")
+
+
+def cached_resolve(fw, analysis_id, cache_dir=None):
+    """resolve() through a disk cache keyed by analysis ID (an analysis never changes parents)."""
+    path = cache_file(cache_dir, analysis_id) if cache_dir else None
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+            if entry.get("version") == CACHE_VERSION:
+                logger.info(f"Flywheel metadata for {analysis_id} from cache: {path}")
+                return entry["labels"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    labels = resolve(fw, analysis_id)
+    if path:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({"version": CACHE_VERSION, "labels": labels}, f, indent=2)
+        os.replace(tmp, path)
+    return labels
+
+
+def write_metadata(workdir, metadata):
+    """metadata.txt ("Key: Value" lines, shown in output.pdf) and metadata.json for the other steps."""
+    lines = ["=== Flywheel Metadata ==="]
+    lines += [f"{label}: {metadata[key]}" for key, label in FIELDS if metadata.get(key) is not None]
+    lines.append("========================")
+    for name, text in (("metadata.txt", "\n".join(lines) + "\n"), ("metadata.json", json.dumps(metadata, indent=2))):
+        path = os.path.join(workdir, name)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    return os.path.join(workdir, "metadata.txt")
+
+
+def gear_context(args):
+    # (client, analysis id, workdir) from the gear context, or from the fixture when running offline
+    fake = args.fake or os.environ.get(FAKE_ENV)
+    if fake:
+        fw = FakeClient(fake)
+        return fw, args.analysis or fw.destination, args.workdir or os.getcwd()
+
+    import flywheel
+    with flywheel.GearContext() as context:
+        context.init_logging()
+        analysis_id = args.analysis or context.destination['id']
+        workdir = args.workdir
+        if not workdir:
+            gear_output_dir = context.output_dir
+            workdir = str(Path(gear_output_dir).resolve().parent / f"{Path(gear_output_dir).name}_work")
+        fw = flywheel.Client(context.get_input('api_key')['key'])
+    return fw, analysis_id, workdir
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write metadata.txt/metadata.json for the analysis from Flywheel.')
+    parser.add_argument('-workdir', type=str, help="Where the metadata files go (default: <gear output>_work).")
+    parser.add_argument('-analysis', type=str, help="The analysis ID (default: the gear destination).")
+    parser.add_argument('-fake', type=str, help=f"Container fixture for the offline client (or ${FAKE_ENV}).")
+    parser.add_argument('-cache', type=str, default=stage_cache.default_cache_dir(),
+                        help="Cache directory, metadata is kept under flywheel/<analysis id>.json.")
+    parser.add_argument('-no_cache', action='store_true', help="Always query Flywheel.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    logger.info("=======: ASL gear :=======")
+
+    fw, analysis_id, workdir = gear_context(args)
+    os.makedirs(workdir, exist_ok=True)
+    cache_dir = None if args.no_cache or os.environ.get('ASLSCP_NO_CACHE') else args.cache
+    metadata = dict(cached_resolve(fw, analysis_id, cache_dir))
+    metadata["gear_run_datetime"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    out_file = write_metadata(workdir, metadata)
+    logger.info(f"Metadata written to: {out_file}")
+    logger.info(f"Metadata content: {metadata}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import os
+from collections import OrderedDict
+import numpy as np
+import nibabel as nib
+
+# Images kept in memory between workflow steps that run in the same process (see orchestrator.py).
+# Entries are keyed by path, mtime and size, so a file rewritten by an external tool is re-read.
+BUDGET = int(os.environ.get('ASLSCP_IMAGE_CACHE_MB', 2048)) * 2**20
+
+# Extension of the intermediate images in the work directory. The pipeline keeps them as
+# plain .nii, so they are memory-mapped instead of decompressed; only deliverables are gzipped.
+WORK_EXT_ENV = 'ASLSCP_WORK_EXT'
+
+_cache = OrderedDict()
+
+
+def work_ext():
+    return os.environ.get(WORK_EXT_ENV) or '.nii.gz'
+
+
+def work_file(folder, stem):
+    # Path of an intermediate image, e.g. work_file(workdir, 'cbf') -> <workdir>/cbf.nii
+    return os.path.join(folder, stem + work_ext())
+
+
+def _tmp_path(path):
+    # Sibling temporary name with the same extension, so nibabel writes the same format
+    base, ext = (path[:-7], '.nii.gz') if path.endswith('.nii.gz') else os.path.splitext(path)
+    return f"{base}.{os.getpid()}.tmp{ext}"
+
+
+def _key(path):
+    st = os.stat(path)
+    return os.path.realpath(path), st.st_mtime_ns, st.st_size
+
+
+def _put(key, img):
+    # Drop older versions of the same file, then the least recently used images over budget
+    for old in [k for k in _cache if k[0] == key[0]]:
+        del _cache[old]
+    _cache[key] = img
+    total = sum(i.dataobj.nbytes for i in _cache.values())
+    while total > BUDGET and len(_cache) > 1:
+        _, evicted = _cache.popitem(last=False)
+        total -= evicted.dataobj.nbytes
+
+
+def load(path):
+    """NIfTI image with its data loaded, shared with earlier steps of this process.
+
+    Uncompressed files are memory-mapped rather than read into memory.
+
+    Callers must not modify the returned array or header in place.
+    """
+    key = _key(path)
+    img = _cache.get(key)
+    if img is not None:
+        _cache.move_to_end(key)
+        return img
+    on_disk = nib.load(path)
+    img = nib.Nifti1Image(np.asanyarray(on_disk.dataobj), on_disk.affine, on_disk.header)
+    _put(key, img)
+    return img
+
+
+def save(img, path):
+    # Write the image and keep it for the next step, if its data is already in memory.
+    # The file is replaced rather than rewritten, so memory maps of the old one stay valid.
+    tmp = _tmp_path(path)
+    nib.save(img, tmp)
+    os.replace(tmp, path)
+    if isinstance(img.dataobj, np.ndarray):
+        _put(_key(path), img)
+
+
+def clear():
+    _cache.clear()
+
+
+class VolumeWriter:
+    """Writes a 4D NIfTI one 3D volume at a time, so the series is never held in memory.
+
+    `header` provides the geometry; the data shape and dtype are set from
+    `shape` and `dtype`. Volumes must be written in order, then close() the writer.
+    """
+
+    def __init__(self, path, header, shape, dtype=np.float32):
+        self.path = path
+        self._tmp = _tmp_path(path)
+        self.dtype = np.dtype(dtype)
+        self.n_volumes = shape[3]
+        self.written = 0
+        hdr = nib.Nifti1Header.from_header(header)
+        hdr.extensions.clear()
+        hdr.set_data_shape(shape)
+        hdr.set_data_dtype(self.dtype)
+        hdr.set_slope_inter(1, 0)
+        hdr.set_data_offset(352)
+        self._file = nib.openers.Opener(self._tmp, 'wb')
+        hdr.write_to(self._file)
+        # Pad to the data offset after the header and the empty extension flag
+        self._file.write(b'\0' * (352 - self._file.tell()))
+
+    def write(self, volume):
+        if self.written >= self.n_volumes:
+            raise ValueError(f"{self.path} already has {self.n_volumes} volumes")
+        self._file.write(np.asarray(volume, dtype=self.dtype).tobytes(order='F'))
+        self.written += 1
+
+    def close(self):
+        self._file.close()
+        if self.written != self.n_volumes:
+            os.remove(self._tmp)
+            raise ValueError(f"{self.path}: wrote {self.written} of {self.n_volumes} volumes")
+        os.replace(self._tmp, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._tmp)
@@ -0,0 +1,167 @@
+import numpy as np
+import nibabel as nib
+from collections import namedtuple
+from scipy import ndimage
+from concurrent.futures import ProcessPoolExecutor
+
+# Mosaic layout: one row per orientation, N_CUTS slices per row (like nilearn's 'mosaic' mode)
+N_CUTS = 8
+# Row order and the (horizontal, vertical) voxel axes shown for each sliced axis
+ROWS = ((0, (1, 2)), (1, (0, 2)), (2, (0, 1)))
+
+# Shape and affine of a display grid that only exists plane by plane (what sample_planes needs of a reference)
+Grid = namedtuple('Grid', 'shape affine')
+
+
+def cut_indices(data, n_cuts=N_CUTS):
+    """Evenly spaced slice indices through the non-zero extent of `data`, per axis."""
+    nonzero = np.argwhere(data != 0)
+    cuts = {}
+    for axis in range(3):
+        if nonzero.size:
+            lo, hi = nonzero[:, axis].min(), nonzero[:, axis].max()
+        else:
+            lo, hi = 0, data.shape[axis] - 1
+        # Leave out the first and last plane of the extent, they are mostly empty
+        cuts[axis] = np.linspace(lo, hi, n_cuts + 2)[1:-1].round().astype(int)
+    return cuts
+
+
+def resample_matrix(n, zoom, step, order=3, smooth=0.0):
+    """1D operator (m, n) from `n` samples `zoom` mm apart to a `step` mm grid over the same field of view.
+
+    Spline interpolation of the given order (like flirt -applyisoxfm), then a
+    Gaussian of `smooth` mm sigma on the new grid (like fslmaths -s). Both are
+    separable, so a 3D resample-and-smooth is one of these per axis.
+    """
+    m = max(1, int(round(n * zoom / step)))
+    x = np.arange(m) * step / zoom
+    # Interpolating the identity at the new positions gives the weights of every input sample
+    coords = np.stack(np.broadcast_arrays(x[:, None], np.arange(n)[None, :]))
+    op = ndimage.map_coordinates(np.eye(n), coords, order=order, mode='nearest')
+    if smooth > 0:
+        op = ndimage.gaussian_filter1d(op, smooth / step, axis=0, mode='constant')
+    return op
+
+
+def display_grid(img, step):
+    # Grid of `step` mm voxels over the field of view of `img` (voxel 0 centres coincide)
+    zooms = np.asarray(img.header.get_zooms()[:3], dtype=np.float64)
+    shape = tuple(max(1, int(round(n * z / step))) for n, z in zip(img.shape[:3], zooms))
+    return Grid(shape, img.affine @ np.diag(list(step / zooms) + [1]))
+
+
+def display_planes(img, mask_img, step, smooth=0.0, n_cuts=N_CUTS):
+    """Masked planes of `img` resampled to `step` mm and smoothed, computed for the drawn cuts only.
+
+    Returns (grid, cuts, planes) with the cuts on the display grid. Every plane
+    is the per-axis operators of resample_matrix applied to the native slice
+    stack: the operator row of the cut weighs the native slices into one plane,
+    the in-plane operators upsample it. The mask is interpolated linearly and
+    kept where it is above 0, as when it was resampled with flirt.
+    """
+    img = nib.as_closest_canonical(img)
+    mask_img = nib.as_closest_canonical(mask_img)
+    data = img.get_fdata(dtype=np.float32)
+    mask = (np.asanyarray(mask_img.dataobj) > 0).astype(np.float32)
+    if data.shape[:3] != mask.shape[:3]:
+        raise ValueError(f"Shape mismatch: image {data.shape} vs mask {mask.shape}")
+    zooms = img.header.get_zooms()[:3]
+    grid = display_grid(img, step)
+    ops = [resample_matrix(n, z, step, 3, smooth) for n, z in zip(data.shape, zooms)]
+    mask_ops = [resample_matrix(n, z, step, 1) for n, z in zip(data.shape, zooms)]
+
+    # Cuts through the extent of the resampled mask, where an axis' operator reaches a masked slice
+    cuts = {}
+    for axis in range(3):
+        others = tuple(a for a in range(3) if a != axis)
+        inside = np.flatnonzero(mask_ops[axis] @ mask.any(axis=others) > 1e-6)
+        lo, hi = (inside.min(), inside.max()) if inside.size else (0, grid.shape[axis] - 1)
+        cuts[axis] = np.linspace(lo, hi, n_cuts + 2)[1:-1].round().astype(int)
+
+    planes = {}
+    for axis, idx in cuts.items():
+        h, v = [a for a in range(3) if a != axis]
+        planes[axis] = []
+        for k in idx:
+            plane = ops[h] @ np.tensordot(ops[axis][k], data, axes=(0, axis)) @ ops[v].T
+            inside = mask_ops[h] @ np.tensordot(mask_ops[axis][k], mask, axes=(0, axis)) @ mask_ops[v].T
+            planes[axis].append(np.where(inside > 1e-6, plane, 0).astype(np.float32))
+    return grid, cuts, planes
+
+
+def extract_planes(data, cuts):
+    # {axis: [2D plane, ...]} for the given cut indices
+    return {axis: [np.take(data, k, axis=axis) for k in idx] for axis, idx in cuts.items()}
+
+
+def plane_voxels(ref_img, axis, k):
+    # Voxel coordinates (3, h, v) of one plane of the reference grid
+    shape = list(ref_img.shape[:3])
+    h, v = [a for a in range(3) if a != axis]
+    grid = np.zeros((3, shape[h], shape[v]))
+    grid[axis] = k
+    grid[h], grid[v] = np.meshgrid(np.arange(shape[h]), np.arange(shape[v]), indexing='ij')
+    return grid
+
+
+def sample_planes(img, ref_img, cuts):
+    """Nearest-neighbour planes of `img` on the reference planes, without resampling the volume."""
+    data = np.asanyarray(img.dataobj)
+    ref_to_img = np.linalg.inv(img.affine) @ ref_img.affine
+    planes = {}
+    for axis, idx in cuts.items():
+        planes[axis] = []
+        for k in idx:
+            grid = plane_voxels(ref_img, axis, k)
+            flat = grid.reshape(3, -1)
+            vox = np.floor(ref_to_img[:3, :3] @ flat + ref_to_img[:3, 3:4] + 0.5).astype(int)
+            inside = np.all((vox >= 0) & (vox < np.asarray(data.shape[:3])[:, None]), axis=0)
+            plane = np.zeros(flat.shape[1], dtype=data.dtype)
+            plane[inside] = data[tuple(vox[:, inside])]
+            planes[axis].append(plane.reshape(grid.shape[1:]))
+    return planes
+
+
+def render(job):
+    """Draw one mosaic PNG from pre-extracted planes (runs in a worker process)."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    planes = job["planes"]
+    overlay = job.get("overlay")
+    zooms = job["zooms"]
+    n_cuts = len(planes[0])
+
+    fig, axes = plt.subplots(3, n_cuts, figsize=(2 * n_cuts, 7), facecolor='black')
+    image = None
+    for row, (axis, (h, v)) in enumerate(ROWS):
+        for col in range(n_cuts):
+            ax = axes[row, col]
+            ax.set_facecolor('black')
+            ax.axis('off')
+            plane = np.ma.masked_equal(planes[axis][col], 0).T
+            image = ax.imshow(plane, origin='lower', cmap=job["cmap"], vmin=job["vmin"], vmax=job["vmax"],
+                              aspect=zooms[v] / zooms[h], interpolation='nearest')
+            if overlay is not None:
+                labels = np.ma.masked_equal(overlay[axis][col], 0).T
+                ax.imshow(labels, origin='lower', cmap=job.get("overlay_cmap", 'prism'), alpha=job.get("alpha", 0.5),
+                          vmin=0, vmax=job.get("overlay_max"), aspect=zooms[v] / zooms[h], interpolation='nearest')
+
+    fig.suptitle(job["title"], color='white')
+    if job.get("colorbar"):
+        cbar = fig.colorbar(image, ax=axes.ravel().tolist(), fraction=0.02, pad=0.01, format=job.get("cbar_format", "%i"))
+        cbar.ax.yaxis.set_tick_params(color='white', labelcolor='white')
+    fig.savefig(job["output_file"], facecolor='black')
+    plt.close(fig)
+    return job["output_file"]
+
+
+def render_all(jobs, n_jobs=1):
+    # Independent figures are drawn in parallel worker processes
+    if n_jobs <= 1 or len(jobs) <= 1:
+        return [render(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(jobs))) as pool:
+        return list(pool.map(render, jobs))
+
@@ -0,0 +1,151 @@
+import numpy as np
+import nibabel as nib
+import argparse
+
+import images
+from cbf_calc import ALPHA, LMBDA, T1B
+
+# Arterial transit time grid searched by the fit (s): start, stop, step
+ATT_GRID = (0.1, 4.0, 0.01)
+# In-mask voxels fitted at once, bounds the (voxels x grid) working arrays
+CHUNK = 4096
+
+
+def kinetic_curve(att, plds, lds, nbs):
+    """Buxton pCASL difference signal over M0 per unit CBF (mL/100g/min), T1app = T1 of blood.
+
+    `att` (s) has shape (n,), `plds` and `lds` (s) shape (p,); returns (n, p).
+    Past the bolus tail this is the single-PLD white paper model cbf_calc inverts.
+    """
+    att = np.asarray(att, dtype=np.float64)[:, None]
+    plds = np.asarray(plds, dtype=np.float64)[None, :]
+    lds = np.broadcast_to(np.asarray(lds, dtype=np.float64), plds.shape)
+    scale = 2 * ALPHA * 0.95 ** nbs * T1B / (6000 * LMBDA)
+    t = lds + plds
+    arriving = scale * np.exp(-att / T1B) * (1 - np.exp(-(t - att) / T1B))
+    arrived = scale * np.exp(-plds / T1B) * (1 - np.exp(-lds / T1B))
+    return np.where(t <= att, 0.0, np.where(t < att + lds, arriving, arrived))
+
+
+def group_delays(plds, lds, n_volumes):
+    """Unique (pld, ld) pairs and the index of each volume's pair.
+
+    `plds` is one PLD per volume, or a shorter list the volumes cycle through.
+    """
+    plds = np.asarray(plds, dtype=np.float64)
+    lds = np.broadcast_to(np.asarray(lds, dtype=np.float64), plds.shape)
+    if n_volumes % len(plds):
+        raise ValueError(f"{n_volumes} volumes do not match {len(plds)} PLDs")
+    pairs = np.tile(np.stack([plds, lds], axis=1), (n_volumes // len(plds), 1))
+    unique, index = np.unique(pairs, axis=0, return_inverse=True)
+    return unique[:, 0], unique[:, 1], index.ravel()
+
+
+def fit_voxels(signal, curves, grid):
+    """Least-squares CBF and ATT of each row of `signal` (voxels x delays).
+
+    CBF is linear in the model, so for every grid ATT it has a closed form and
+    the residual reduces to |y|^2 - (g.y)^2 / |g|^2: one matrix product covers
+    all voxels and grid points. The best grid point is refined with a parabola
+    through its neighbours' residuals. Voxels without a positive fit get 0.
+    """
+    gg = np.einsum('ap,ap->a', curves, curves)
+    inv_gg = np.divide(1, gg, out=np.zeros_like(gg), where=gg > 0)
+    # (g.y)|g.y|/|g|^2 ranks grid points like the residual and leaves negative fits at the bottom
+    score = signal @ curves.T
+    score *= np.abs(score)
+    score *= inv_gg
+    best = np.argmax(score, axis=1)
+    rows = np.arange(len(signal))
+    fitted = score[rows, best] > 0
+
+    # Parabolic refinement on -score (the part of the residual that depends on ATT)
+    inner = fitted & (best > 0) & (best < len(grid) - 1)
+    lo, mid, hi = (score[rows, np.clip(best + k, 0, len(grid) - 1)] for k in (-1, 0, 1))
+    curvature = lo - 2 * mid + hi
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shift = np.where(inner & (lo > 0) & (hi > 0) & (curvature < 0), 0.5 * (lo - hi) / curvature, 0.0)
+    step = grid[1] - grid[0]
+    att = grid[best] + np.clip(shift, -0.5, 0.5) * step
+    return att, fitted
+
+
+def fit(asl, m0, mask, plds, lds, nbs, scale, grid=ATT_GRID, chunk=CHUNK):
+    """CBF (mL/100g/min) and ATT (ms) maps in float32 from a 4D difference series.
+
+    `plds` and `lds` are in microseconds, as read from the DICOM header.
+    Repeats of a delay are averaged and weighted by their count. ATT is only
+    determined where it is longer than the shortest PLD.
+    """
+    inside = np.asarray(mask) > 0
+    cbf = np.zeros(inside.shape, dtype=np.float32)
+    att = np.zeros(inside.shape, dtype=np.float32)
+    if not inside.any():
+        return cbf, att
+
+    pld_s, ld_s, index = group_delays(np.asarray(plds) / 10**6, np.asarray(lds) / 10**6, asl.shape[-1])
+    counts = np.bincount(index, minlength=len(pld_s)).astype(np.float64)
+    weights = np.sqrt(counts)
+    att_grid = np.arange(*grid)
+    curves = kinetic_curve(att_grid, pld_s, ld_s, nbs) * weights
+    # Volumes x delays, averages the repeats of each delay in one product
+    averaging = np.zeros((len(index), len(pld_s)))
+    averaging[np.arange(len(index)), index] = 1 / counts[index]
+
+    m0_vox = np.asarray(m0[inside], dtype=np.float64)
+    if m0_vox.ndim == 2:
+        m0_vox = m0_vox[:, 0]
+    m0_vox *= scale
+    asl_vox = asl[inside]
+    cbf_vox = np.zeros(len(m0_vox), dtype=np.float32)
+    att_vox = np.zeros(len(m0_vox), dtype=np.float32)
+    for start in range(0, len(m0_vox), chunk):
+        stop = start + chunk
+        # Mean difference per delay over M0, weighted like the model curves
+        means = np.asarray(asl_vox[start:stop], dtype=np.float64) @ averaging
+        with np.errstate(divide='ignore', invalid='ignore'):
+            signal = means / m0_vox[start:stop, None] * weights
+        signal[~np.isfinite(signal)] = 0
+
+        t, fitted = fit_voxels(signal, curves, att_grid)
+        g = kinetic_curve(t, pld_s, ld_s, nbs) * weights
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f = np.einsum('vp,vp->v', g, signal) / np.einsum('vp,vp->v', g, g)
+        ok = fitted & np.isfinite(f)
+        cbf_vox[start:stop] = np.where(ok, f, 0)
+        att_vox[start:stop] = np.where(ok, t * 1000, 0)
+
+    cbf[inside] = cbf_vox
+    att[inside] = att_vox
+    return cbf, att
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fit CBF and arterial transit time to multi-delay pCASL data.')
+    parser.add_argument('-asl', type=str, help="The 4D label-control difference series.")
+    parser.add_argument('-m0', type=str, help="The path to the m0 file.")
+    parser.add_argument('-m', type=str, help="The path to the mask file.")
+    parser.add_argument('-plds', type=int, nargs='+', help="PLDs (us), one per volume or a list the volumes cycle through.")
+    parser.add_argument('-ld', type=int, nargs='+', help="Labeling duration (us), one or one per PLD.")
+    parser.add_argument('-nbs', type=int, help="Number of background suppression pulses.")
+    parser.add_argument('-scale', type=float, default=1.0, help="M0 scale.")
+    parser.add_argument('-out', type=str, help="The output directory (cbf and att).")
+    parser.add_argument('-chunk', type=int, default=CHUNK, help="Voxels fitted at once.")
+    args = parser.parse_args(argv)
+
+    if len(args.ld) not in (1, len(args.plds)):
+        parser.error("-ld takes one value or one per PLD")
+
+    asl_img = nib.load(args.asl)
+    mask_img = images.load(args.m)
+    cbf, att = fit(np.asanyarray(asl_img.dataobj), np.asanyarray(nib.load(args.m0).dataobj),
+                   np.asanyarray(mask_img.dataobj), args.plds, args.ld, args.nbs, args.scale, chunk=args.chunk)
+
+    header = mask_img.header.copy()
+    header.set_data_dtype(np.float32)
+    for name, data in (('cbf', cbf), ('att', att)):
+        images.save(nib.Nifti1Image(data, mask_img.affine, header), images.work_file(args.out, name))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import os
+import sys
+import argparse
+import importlib
+import traceback
+
+import threads
+import timings
+
+# Workflow steps that can run inside the orchestrator, each a module with main(argv).
+# Modules are imported on first use, so a run only pays for the libraries it needs.
+STEPS = ("flywheel_context", "dicom_ingest", "ascconv", "asl_subtract", "cbf_calc", "multidelay", "t1fit",
+         "transform_store", "atlas_store", "resample", "regional_stats", "stats_store", "viz", "not1_viz", "pdf",
+         "not1_pdf", "qc", "report", "export", "archive", "timings")
+
+# Field separator of the FIFO protocol (never appears in paths or arguments)
+SEP = '\x1f'
+
+
+def run_step(step, argv):
+    """Run one step in this process and return its exit status.
+
+    The step is traced (see timings.py) when $ASLSCP_TRACE is set and runs
+    with its thread budget (see threads.py).
+    """
+    if step not in STEPS:
+        print(f"Unknown workflow step: {step}", file=sys.stderr)
+        return 2
+    with timings.measure(step) as outcome, threads.limited(step):
+        outcome["status"] = _call(step, argv)
+    return outcome["status"]
+
+
+def _call(step, argv):
+    try:
+        importlib.import_module(step).main(argv)
+        return 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+def serve(fifo_dir):
+    """Answer step requests from the pipeline until it closes the request FIFO.
+
+    Each request is one line on `requests` holding the caller's working
+    directory, the step and its arguments, each followed by SEP; the exit
+    status is written back as one line on `replies`. Images written by one
+    step stay in memory for the next (see images.py).
+    """
+    with open(os.path.join(fifo_dir, 'requests'), 'r') as requests, \
+            open(os.path.join(fifo_dir, 'replies'), 'w') as replies:
+        for line in requests:
+            fields = line.rstrip('\n').split(SEP)[:-1]
+            if len(fields) < 2:
+                continue
+            cwd, step, *argv = fields
+            try:
+                # Relative paths resolve as they would in the calling shell
+                os.chdir(cwd)
+                status = run_step(step, argv)
+            except OSError as e:
+                print(f"Cannot run {step} in {cwd}: {e}", file=sys.stderr)
+                status = 1
+            replies.write(f"{status}\n")
+            replies.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the Python workflow steps in one long-lived process.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    serve_parser = sub.add_parser('serve', help="Serve step requests over FIFOs.")
+    serve_parser.add_argument('-fifo', type=str, required=True, help="Directory holding the requests/replies FIFOs.")
+    run_parser = sub.add_parser('run', help="Run steps given as 'step args... ;' groups.")
+    run_parser.add_argument('steps', nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        serve(args.fifo)
+        return
+
+    # One-shot mode: several steps separated by ';' in one process
+    status = 0
+    group = []
+    for token in args.steps + [';']:
+        if token != ';':
+            group.append(token)
+            continue
+        if group:
+            status = run_step(group[0], group[1:])
+            if status:
+                sys.exit(status)
+        group = []
+
+
+if __name__ == "__main__":
+    main()
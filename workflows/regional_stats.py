@@ -0,0 +1,261 @@
+import os
+import json
+import argparse
+import numpy as np
+
+import images
+import stats_store
+from atlas_store import AtlasStore, read_label_file, names_by_id
+
+# Header of the formatted_cbf_*.txt tables read by report.py
+HEADER = ("Region", "Mean CBF", "Standard Deviation", "Voxels", "Volume")
+
+# Regions with fewer voxels than this are left out of the tables
+MIN_VOXELS = 10
+
+# Composite regions (unions of atlas labels) of weighted_rcbf.txt and weighted_table.txt
+COMPOSITES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'composite_rois.json')
+
+
+def read_label_names(label_file):
+    # Names indexed by label value - 1, from any of the label file formats atlas_store reads
+    return names_by_id(read_label_file(label_file))
+
+
+def regional_stats(cbf, mask, label_maps, voxel_volume):
+    """Mean, SD, voxel count and volume of every label of every atlas.
+
+    All atlases are reduced together with one set of bincount calls over the
+    voxels that are inside `mask` and non-zero in `cbf` (what `fslstats -K`
+    reported). Returns {atlas: {"mean", "sd", "voxels", "volume"}} with arrays
+    indexed by label value.
+    """
+    valid = (mask > 0) & np.isfinite(cbf) & (cbf != 0)
+    values = cbf[valid].astype(np.float64)
+
+    # Give each atlas its own block of bins so one bincount covers all of them
+    keys = []
+    blocks = {}
+    offset = 0
+    for name, labels in label_maps.items():
+        lab = np.rint(labels[valid]).astype(np.int64)
+        lab[lab < 0] = 0
+        n_bins = int(lab.max()) + 1 if lab.size else 1
+        blocks[name] = (offset, n_bins)
+        keys.append(lab + offset)
+        offset += n_bins
+
+    keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+    weights = np.tile(values, len(label_maps))
+
+    count = np.bincount(keys, minlength=offset)
+    total = np.bincount(keys, weights=weights, minlength=offset)
+    mean = np.divide(total, count, out=np.zeros(offset), where=count > 0)
+    # Second pass on the deviations keeps the SD stable for large CBF values
+    ssd = np.bincount(keys, weights=(weights - mean[keys]) ** 2, minlength=offset)
+    sd = np.sqrt(np.divide(ssd, count - 1, out=np.zeros(offset), where=count > 1))
+
+    results = {}
+    for name, (start, n_bins) in blocks.items():
+        sl = slice(start, start + n_bins)
+        results[name] = {
+            "mean": mean[sl],
+            "sd": sd[sl],
+            "voxels": count[sl],
+            "volume": count[sl] * voxel_volume,
+        }
+    return results
+
+
+def load_composites(path):
+    """Composite region config: {"reference": region, "regions": [region, ...]}.
+
+    A region is {"name", "members": {atlas: [label names]}}; its voxels are the
+    union of the member labels. rCBF is relative to the reference region.
+    Returns (regions, reference or None).
+    """
+    with open(path, 'r') as f:
+        config = json.load(f)
+    regions = config.get("regions", [])
+    reference = config.get("reference")
+    for region in regions + ([reference] if reference else []):
+        if not region.get("name") or not isinstance(region.get("members"), dict):
+            raise ValueError(f"{path}: every region needs a name and a members mapping")
+    if len(regions) > 63:
+        raise ValueError(f"{path}: at most 63 regions and the reference")
+    return regions, reference
+
+
+def composite_stats(cbf, mask, label_maps, label_names, regions, min_voxels=MIN_VOXELS):
+    """Voxel-weighted mean CBF and voxel count of every composite region.
+
+    Each atlas maps its labels to a bit set of the regions they belong to, so
+    one lookup per atlas tags every voxel with all its regions at once, and a
+    voxel that is in several member labels is only counted once. Member labels
+    with fewer than `min_voxels` voxels are left out, as they are from the tables.
+    Returns [(name, mean, voxels)] in the order of `regions`.
+    """
+    valid = (mask > 0) & np.isfinite(cbf) & (cbf != 0)
+    values = cbf[valid].astype(np.float64)
+    bits = np.zeros(values.size, dtype=np.uint64)
+    for atlas in sorted({a for r in regions for a in r["members"]}):
+        if atlas not in label_maps:
+            raise ValueError(f"Composite regions use atlas {atlas}, which was not extracted")
+        names = label_names[atlas]
+        lut = np.zeros(len(names) + 1, dtype=np.uint64)
+        for i, region in enumerate(regions):
+            for name in region["members"].get(atlas, []):
+                if name not in names:
+                    raise ValueError(f"{region['name']}: no label {name!r} in atlas {atlas}")
+                lut[names.index(name) + 1] |= np.uint64(1 << i)
+        lab = np.rint(label_maps[atlas][valid]).astype(np.int64)
+        lab[(lab < 0) | (lab >= len(lut))] = 0
+        lut[np.bincount(lab, minlength=len(lut)) < min_voxels] = 0
+        bits |= lut[lab]
+
+    results = []
+    for i, region in enumerate(regions):
+        inside = (bits & np.uint64(1 << i)) != 0
+        count = int(inside.sum())
+        results.append((region["name"], float(values[inside].mean()) if count else 0.0, count))
+    return results
+
+
+def write_composites(out_dir, results, reference):
+    # weighted_rcbf.txt (mean CBF and voxel count) and weighted_table.txt (rounded, with rCBF to the reference)
+    rows = [r for r in results if r[2] > 0]
+    ref_mean = reference[1] if reference else 0.0
+    write_table(os.path.join(out_dir, 'weighted_rcbf.txt'), ("Region", "CBF", "Voxels"),
+                [(name, f"{mean:.4f}", str(count)) for name, mean, count in rows])
+    write_table(os.path.join(out_dir, 'weighted_table.txt'), ("Region", "Mean", "rCBF", "Voxels"),
+                [(name, f"{mean:.0f}", f"{mean / ref_mean:.1f}" if ref_mean else "NA", str(count))
+                 for name, mean, count in rows])
+
+
+def table_labels(names, stats, min_voxels=MIN_VOXELS):
+    # (label, region) of the table rows, skipping unnamed, missing and tiny regions
+    for label, region in enumerate(names, start=1):
+        if not region or region == "0" or "missing label" in region:
+            continue
+        if label >= len(stats["voxels"]) or stats["voxels"][label] < min_voxels:
+            continue
+        yield label, region
+
+
+def format_rows(names, stats, min_voxels=MIN_VOXELS):
+    # Rows for the formatted table
+    return [(
+        region,
+        f"{stats['mean'][label]:.1f}",
+        f"{stats['sd'][label]:.1f}",
+        f"{float(stats['voxels'][label]):.1f}",
+        f"{stats['volume'][label]:.1f}",
+    ) for label, region in table_labels(names, stats, min_voxels)]
+
+
+def store_rows(label_names, results, composites, reference, voxel_volume):
+    """Typed rows of the session's stats store (stats_store.REGION_COLUMNS).
+
+    The atlas regions of the formatted tables, then the composite regions as
+    atlas "weighted" without a label. rCBF is relative to the reference region,
+    None without one.
+    """
+    ref_mean = reference[1] if reference and reference[2] > 0 else 0.0
+    rows = []
+    for atlas, names in label_names.items():
+        stats = results[atlas]
+        for label, region in table_labels(names, stats):
+            mean = float(stats["mean"][label])
+            rows.append((atlas, label, region, mean, float(stats["sd"][label]), int(stats["voxels"][label]),
+                         float(stats["volume"][label]), mean / ref_mean if ref_mean else None))
+    for region, mean, count in composites:
+        if count > 0:
+            rows.append(("weighted", None, region, mean, None, count, count * voxel_volume,
+                         mean / ref_mean if ref_mean else None))
+    return rows
+
+
+def write_table(path, header, rows):
+    # Pipe-delimited table with padded columns, like `column -t -s '|' -o '|'`
+    lines = [tuple(header)] + [tuple(r) for r in rows]
+    widths = [max(len(str(line[i])) for line in lines) for i in range(len(header))]
+    with open(path, 'w') as f:
+        for line in lines:
+            cells = [str(c).ljust(w) for c, w in zip(line[:-1], widths[:-1])]
+            f.write(" | ".join(cells + [str(line[-1])]) + "\n")
+
+
+def read_table(path):
+    # Rows of a pipe-delimited stats table as dicts keyed by its header
+    try:
+        with open(path, 'r') as f:
+            lines = [line for line in f.read().splitlines() if line.strip()]
+    except FileNotFoundError:
+        return []
+    if not lines:
+        return []
+    header = [h.strip() for h in lines[0].split('|')]
+    rows = []
+    for line in lines[1:]:
+        parts = [p.strip() for p in line.split('|')]
+        if len(parts) == len(header):
+            rows.append(dict(zip(header, parts)))
+    return rows
+
+
+def load_label_maps(seg_folder, seg_list):
+    return {
+        seg: np.asanyarray(images.load(images.work_file(seg_folder, 'w_' + seg)).dataobj)
+        for seg in seg_list
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Extract regional CBF statistics for each warped atlas.')
+    parser.add_argument('-cbf', type=str, help="The path to the CBF file.")
+    parser.add_argument('-mask', type=str, help="The path to the (eroded) brain mask.")
+    parser.add_argument('-seg_folder', type=str, help="The path to the warped segmentation files.")
+    parser.add_argument('-seg', type=str, nargs='+', help="The list of segmentations to extract.")
+    parser.add_argument('-labels', type=str, help="The folder with the <seg>_label.txt files.")
+    parser.add_argument('-atlas_store', type=str, help="Atlas store to take the label names from instead of -labels.")
+    parser.add_argument('-out', type=str, help="The stats output directory.")
+    parser.add_argument('-composites', type=str, help=f"Composite region config for the weighted tables (e.g. {os.path.basename(COMPOSITES)}).")
+    parser.add_argument('-db', type=str, help="Also write the stats as a typed session store (SQLite, see stats_store.py).")
+    parser.add_argument('-metadata', type=str, help="metadata.txt of the session, for the session columns of -db.")
+    args = parser.parse_args(argv)
+
+    cbf_nii = images.load(args.cbf)
+    cbf = cbf_nii.get_fdata(dtype=np.float32)
+    mask = np.asanyarray(images.load(args.mask).dataobj)
+    voxel_volume = float(np.prod(cbf_nii.header.get_zooms()[:3]))
+
+    label_maps = load_label_maps(args.seg_folder, args.seg)
+    results = regional_stats(cbf, mask, label_maps, voxel_volume)
+
+    store = AtlasStore(args.atlas_store) if args.atlas_store else None
+    label_names = {}
+    for seg in args.seg:
+        if store is not None:
+            label_names[seg] = store.label_names(seg)
+        else:
+            label_names[seg] = read_label_names(os.path.join(args.labels, seg + '_label.txt'))
+        out_file = os.path.join(args.out, f"formatted_cbf_{seg}.txt")
+        write_table(out_file, HEADER, format_rows(label_names[seg], results[seg]))
+        print(f"Regional stats written to {out_file}")
+
+    composites, reference = [], None
+    if args.composites:
+        regions, reference = load_composites(args.composites)
+        composites = composite_stats(cbf, mask, label_maps, label_names, regions + ([reference] if reference else []))
+        reference = composites.pop() if reference else None
+        write_composites(args.out, composites, reference)
+        print(f"Composite regions written to {os.path.join(args.out, 'weighted_table.txt')}")
+
+    if args.db:
+        session = stats_store.session_metadata(args.metadata) if args.metadata else {}
+        stats_store.write_session(args.db, session, store_rows(label_names, results, composites, reference, voxel_volume))
+        print(f"Session stats store written to {args.db}")
+
+
+if __name__ == "__main__":
+    main()
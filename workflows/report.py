@@ -0,0 +1,283 @@
+import io
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from reportlab.lib.pagesizes import letter
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Image, Paragraph, Spacer, PageBreak
+from reportlab.lib import colors
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+
+from timings import summary_rows
+
+# Resolution the mosaics are downsampled to for their size on the page (points)
+DISPLAY_DPI = 150
+MOSAIC_SIZE = (400, 157)
+SEG_SIZE = (400, 200)
+
+# Documents the engine can build, and their file names
+REPORTS = {"output": "output.pdf", "qc": "qc.pdf"}
+
+
+def read_formatted_file(file_path):
+    # Rows of a formatted stats table (4 columns for weighted_table.txt, 5 for formatted_cbf_*.txt)
+    try:
+        with open(file_path, 'r') as file:
+            content = file.read().strip().split('\n')
+    except FileNotFoundError:
+        return []
+    data = []
+    for line in content[1:]:  # Skip header line
+        parts = [p.strip() for p in line.split('|')]
+        if len(parts) in (4, 5):
+            data.append(tuple(parts))
+    return data
+
+
+def read_metadata(meta_file):
+    # "Key: Value" lines of metadata.txt
+    if not meta_file or not os.path.exists(meta_file):
+        return []
+    rows = []
+    with open(meta_file, 'r') as f:
+        for line in f.read().strip().splitlines():
+            # Skip the "=== Flywheel Metadata ===" banner lines
+            if line.strip() and not line.startswith('='):
+                key, _, value = line.strip().partition(":")
+                rows.append((key.strip(), value.strip()))
+    return rows
+
+
+def display_image(path, size, dpi=DISPLAY_DPI):
+    """PNG bytes of `path` decoded once and downsampled to `size` points at `dpi`, None if missing.
+
+    reportlab embeds images as raw flate-compressed pixels, so the mosaics are
+    cut down to what the page can show: nearest-neighbour (no ringing on the
+    slice edges), no alpha when it is opaque, and a palette when <= 256 colours.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    from PIL import Image as PILImage
+    with PILImage.open(path) as img:
+        img.load()
+    target = (round(size[0] / 72 * dpi), round(size[1] / 72 * dpi))
+    if img.width > target[0] or img.height > target[1]:
+        img = img.resize(target, PILImage.NEAREST)
+    if img.mode in ('RGBA', 'LA') and img.getextrema()[-1][0] == 255:
+        img = img.convert('RGB')
+    if img.mode == 'RGB' and img.getcolors(256) is not None:
+        img = img.quantize(256, method=PILImage.Quantize.FASTOCTREE)
+    out = io.BytesIO()
+    img.save(out, format='PNG', optimize=True)
+    return out.getvalue()
+
+
+def load_report_data(viz_path, stats_path, seg_list, meta_file=None, qt1=True, timings_file=None):
+    """Everything both reports show, parsed and decoded once.
+
+    Tables are parsed from the stats folder, mosaics are downsampled to their
+    display size; the result is plain data shared by (and picklable for) the builders.
+    """
+    tables = {}
+    for seg in seg_list:
+        rows = read_formatted_file(os.path.join(stats_path, f"formatted_cbf_{seg}.txt"))
+        if rows:
+            tables[seg] = rows
+
+    timing_rows = []
+    if timings_file:
+        try:
+            with open(timings_file, 'r') as f:
+                timing_rows = summary_rows(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    return {
+        "metadata": read_metadata(meta_file),
+        "weighted": read_formatted_file(os.path.join(stats_path, 'weighted_table.txt')),
+        "tables": tables,
+        "mean_cbf": display_image(os.path.join(viz_path, "meanCBF_mosaic.png"), MOSAIC_SIZE),
+        "mean_cbf_bw": display_image(os.path.join(viz_path, "meanCBF_bw.png"), MOSAIC_SIZE),
+        "qt1": display_image(os.path.join(viz_path, "qT1_mosaic.png"), MOSAIC_SIZE) if qt1 else None,
+        "seg_images": {seg: display_image(os.path.join(viz_path, f"w_{seg}_meanCBF_80_mosaic_prism.png"), SEG_SIZE)
+                       for seg in seg_list},
+        "timings": timing_rows,
+    }
+
+
+def _image(png, size):
+    return Image(io.BytesIO(png), width=size[0], height=size[1])
+
+
+def _styles():
+    styles = getSampleStyleSheet()
+    # Wrapped title for long strings and wrapped table headers
+    styles.add(ParagraphStyle('TitleWrap', parent=styles['Title'], wordWrap='CJK'))
+    styles.add(ParagraphStyle('TableHeaderWrap', parent=styles['BodyText'], fontName='Helvetica-Bold', alignment=1,
+                              wordWrap='CJK'))
+    return styles
+
+
+def metadata_panel(rows, styles):
+    # Single-column bordered panel with the bold key and its value
+    table = Table([[Paragraph(f"<b>{key}</b>: {value}", styles["BodyText"])] for key, value in rows], hAlign="LEFT")
+    table.setStyle(TableStyle([
+        ('ALIGN', (0,0), (0,-1), 'LEFT'),
+        ("FONTNAME", (0,0), (-1,-1), "Helvetica"),
+        ("FONTSIZE", (0,0), (-1,-1), 10),
+        ("LEADING", (0,0), (-1,-1), 12),
+        ("LEFTPADDING", (0,0), (-1,-1), 8),
+        ("RIGHTPADDING", (0,0), (-1,-1), 8),
+        ("TOPPADDING", (0,0), (-1,-1), 6),
+        ("BOTTOMPADDING", (0,0), (-1,-1), 6),
+        ("BOX", (0,0), (-1,-1), 0.75, colors.grey),
+        ("BACKGROUND", (0,0), (-1,-1), colors.whitesmoke),
+    ]))
+    return table
+
+
+def weighted_table(rows, styles):
+    header = styles['TableHeaderWrap']
+    table_data = [[Paragraph('Region', header), Paragraph('Mean CBF (mL/100g/min)', header),
+                   Paragraph('rCBF', header), Paragraph('Voxels (count)', header)]]
+    for region, mean, rcbf, voxels in (r[:4] for r in rows):
+        table_data.append([Paragraph(str(region), styles['BodyText']), mean, rcbf, voxels])
+    table = Table(table_data, repeatRows=1)
+    table.setStyle(TableStyle([
+        ('ALIGN', (0,0), (0,-1), 'LEFT'),
+        ('BACKGROUND', (0,0), (-1,0), colors.lightgrey),
+        ('TEXTCOLOR', (0,0), (-1,0), colors.black),
+        ('ALIGN', (0,0), (-1,-1), 'CENTER'),
+        ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+        ('BOTTOMPADDING', (0,0), (-1,0), 12),
+        ('GRID', (0,0), (-1,-1), 1, colors.black),
+    ]))
+    return table
+
+
+def region_table(rows, styles, width):
+    header = styles['TableHeaderWrap']
+    table_data = [[Paragraph('Region', header), Paragraph('Mean CBF (mL/100g/min)', header),
+                   Paragraph('Standard Deviation', header), Paragraph('Voxels (count)', header),
+                   Paragraph('Volume (mm^3)', header)]]
+    for region, mean_cbf, std_dev, vox, vol in (r for r in rows if len(r) == 5):
+        table_data.append([Paragraph(str(region), styles['BodyText']), mean_cbf, std_dev, vox, vol])
+    widths = [int(width * 0.38), int(width * 0.19), int(width * 0.19), int(width * 0.12)]
+    table = Table(table_data, colWidths=widths + [width - sum(widths)], repeatRows=1)
+    table.setStyle(TableStyle([
+        ('BACKGROUND', (0,0), (-1,0), colors.lightgrey),
+        ('TEXTCOLOR', (0,0), (-1,0), colors.black),
+        ('ALIGN', (0,0), (-1,-1), 'CENTER'),
+        ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+        ('BOTTOMPADDING', (0,0), (-1,0), 8),
+        ('GRID', (0,0), (-1,-1), 1, colors.black),
+    ]))
+    return table
+
+
+def timing_table(rows):
+    # Slowest stages of this run (stats/timings.json)
+    table = Table([("Stage", "Wall (s)", "CPU (s)", "Peak RSS (MB)", "Read (MB)", "Written (MB)")] + list(rows),
+                  repeatRows=1)
+    table.setStyle(TableStyle([
+        ('BACKGROUND', (0,0), (-1,0), colors.lightgrey),
+        ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+        ('FONTNAME', (0,-1), (-1,-1), 'Helvetica-Bold'),
+        ('ALIGN', (1,0), (-1,-1), 'RIGHT'),
+        ('GRID', (0,0), (-1,-1), 0.5, colors.grey),
+    ]))
+    return table
+
+
+def output_elements(data, styles, width):
+    """Flowables of output.pdf: metadata, mosaics, AD regions and the per-atlas tables."""
+    elements = [Paragraph("ASL self-contained processing pipeline output", styles['TitleWrap']), Spacer(1, 24)]
+    if data["metadata"]:
+        elements += [metadata_panel(data["metadata"], styles), Spacer(1, 18)]
+
+    for key, title, gap in (("mean_cbf", "Mean CBF", 12), ("mean_cbf_bw", "Mean CBF", 12), ("qt1", "qT1 mosaic", 24)):
+        if data[key]:
+            elements += [Paragraph(title, styles['Heading2']), _image(data[key], MOSAIC_SIZE), Spacer(1, gap)]
+
+    if data["weighted"]:
+        elements += [PageBreak(), Paragraph("CBF and rCBF values for AD Regions", styles['Heading2']), Spacer(1, 12),
+                     weighted_table(data["weighted"], styles), Spacer(1, 36)]
+
+    # Segmentation tables, each on a new page
+    for idx, (seg, rows) in enumerate(data["tables"].items()):
+        if idx != 0:
+            elements.append(PageBreak())
+        elements += [Paragraph(f"{seg.capitalize()} CBF values extracted from segmentations", styles['Heading2']),
+                     Spacer(1, 12)]
+        if data["seg_images"].get(seg):
+            elements += [_image(data["seg_images"][seg], SEG_SIZE), Spacer(1, 12)]
+        elements += [region_table(rows, styles, width), Spacer(1, 24)]
+    return elements
+
+
+def qc_elements(data, styles, width):
+    """Flowables of qc.pdf: the mean CBF, every segmentation overlay and the processing time."""
+    elements = [Paragraph("ASL self-contained processing QC", styles['Title']), Spacer(1, 24)]
+    if data["mean_cbf_bw"]:
+        elements += [Paragraph("Mean CBF", styles['Heading2']), _image(data["mean_cbf_bw"], MOSAIC_SIZE),
+                     Spacer(1, 12)]
+    for seg, png in data["seg_images"].items():
+        if png:
+            elements += [Paragraph(f"Segmentation: {seg}", styles['Heading2']), _image(png, SEG_SIZE), Spacer(1, 12)]
+    if data["timings"]:
+        elements += [PageBreak(), Paragraph("Processing time", styles['Heading2']), Spacer(1, 12),
+                     timing_table(data["timings"])]
+    return elements
+
+
+BUILDERS = {"output": output_elements, "qc": qc_elements}
+
+
+def build(job):
+    # One document from the shared data; flowables are made per document since building consumes them
+    kind, data, path = job
+    doc = SimpleDocTemplate(path, pagesize=letter)
+    doc.build(BUILDERS[kind](data, _styles(), doc.width))
+    print(f"PDF generated and saved at {path}")
+    return path
+
+
+def build_reports(data, targets, n_jobs=1):
+    """Build {kind: path} documents, in parallel worker processes if n_jobs > 1."""
+    jobs = [(kind, data, path) for kind, path in targets.items()]
+    if n_jobs <= 1 or len(jobs) <= 1:
+        return [build(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(jobs))) as pool:
+        return list(pool.map(build, jobs))
+
+
+def parse_args(argv, description, reports=None):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-viz', type=str, help="The path to the viz folder.")
+    parser.add_argument('-stats', type=str, default='', help="The path to the stats folder.")
+    parser.add_argument('-out', type=str, help="The output path.")
+    parser.add_argument('-seg', type=str, nargs='+', help="The list of segmentations to display.")
+    parser.add_argument('-metadata', type=str, help="The metadata.txt shown in output.pdf (default: <out>/metadata.txt).")
+    parser.add_argument('-timings', type=str, help="The stats/timings.json summarised in qc.pdf.")
+    parser.add_argument('-jobs', type=int, default=1, help="Number of documents built in parallel.")
+    if reports is None:
+        parser.add_argument('-qt1', action='store_true', help="Include the qT1 mosaic.")
+        parser.add_argument('-reports', type=str, nargs='+', choices=list(REPORTS), default=list(REPORTS),
+                            help="The documents to build.")
+    return parser.parse_args(argv)
+
+
+def run(args, reports, qt1):
+    meta_file = args.metadata or os.path.join(args.out, "metadata.txt")
+    data = load_report_data(args.viz, args.stats, args.seg, meta_file, qt1, args.timings if "qc" in reports else None)
+    targets = {kind: os.path.join(args.out, REPORTS[kind]) for kind in reports}
+    return build_reports(data, targets, args.jobs)
+
+
+def main(argv=None):
+    args = parse_args(argv, 'Build output.pdf and qc.pdf from the pipeline outputs in one pass.')
+    run(args, args.reports, args.qt1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import argparse
+import numpy as np
+import nibabel as nib
+from scipy import io as sio
+from scipy import ndimage
+
+import images
+from atlas_store import AtlasStore
+
+# ITK/ANTs work in LPS physical space, NIfTI affines are RAS
+LPS = np.diag([-1.0, -1.0, 1.0])
+
+# Interpolation name -> spline order for map_coordinates
+ORDERS = {"nn": 0, "linear": 1, "bspline": 3}
+
+
+def load_itk_affine(mat_file):
+    """4x4 point transform (LPS) from an ANTs/ITK *GenericAffine.mat file."""
+    mat = sio.loadmat(mat_file)
+    key = [k for k in mat if k.startswith('AffineTransform')][0]
+    params = np.asarray(mat[key], dtype=np.float64).ravel()
+    center = np.asarray(mat['fixed'], dtype=np.float64).ravel()
+    m = params[:9].reshape(3, 3)
+    t = params[9:12]
+    affine = np.eye(4)
+    affine[:3, :3] = m
+    affine[:3, 3] = t + center - m @ center
+    return affine
+
+
+def load_warp(warp_file, smooth_mm=0):
+    # ANTs displacement field (x, y, z, 1, 3) in LPS mm, optionally Gaussian smoothed
+    img = images.load(warp_file)
+    field = np.asarray(img.dataobj, dtype=np.float32).reshape(img.shape[:3] + (3,))
+    if smooth_mm:
+        sigma = smooth_mm / np.asarray(img.header.get_zooms()[:3], dtype=np.float64)
+        field = np.stack([ndimage.gaussian_filter(field[..., c], sigma, mode='nearest') for c in range(3)], axis=-1)
+    return field, img.affine
+
+
+def grid_points(ref_img):
+    """Physical LPS coordinates (N, 3) of every voxel of the reference grid."""
+    ijk = np.indices(ref_img.shape[:3], dtype=np.float64).reshape(3, -1)
+    ras = ref_img.affine[:3, :3] @ ijk + ref_img.affine[:3, 3:4]
+    return (LPS @ ras).T
+
+
+def to_voxels(points, affine):
+    # LPS points -> continuous voxel indices (3, N) of an image with RAS `affine`
+    ras = (LPS @ points.T)
+    inv = np.linalg.inv(affine)
+    return inv[:3, :3] @ ras + inv[:3, 3:4]
+
+
+def displace(points, warp):
+    field, affine = warp
+    vox = to_voxels(points, affine)
+    # Zero displacement outside the field, like ITK's displacement field transform
+    disp = np.stack([ndimage.map_coordinates(field[..., c], vox, order=1, mode='constant', cval=0.0)
+                     for c in range(3)], axis=-1)
+    return points + disp
+
+
+def apply_affine(points, affine):
+    return points @ affine[:3, :3].T + affine[:3, 3]
+
+
+def forward_points(ref_img, affine, warp):
+    """Subject-space sample points for a template-space grid (`-R ref warp affine`)."""
+    return apply_affine(displace(grid_points(ref_img), warp), affine)
+
+
+def inverse_points(ref_img, affine, inverse_warp):
+    """Template-space sample points for a subject-space grid (`-R ref -i affine inverse_warp`)."""
+    return displace(apply_affine(grid_points(ref_img), np.linalg.inv(affine)), inverse_warp)
+
+
+class Sampler:
+    """Samples any number of images at one fixed set of physical points.
+
+    Voxel indices are worked out once per source grid, so label maps sharing
+    a grid (all the atlases) are resampled with a single gather each.
+    """
+
+    def __init__(self, points, out_shape):
+        self.points = points
+        self.out_shape = out_shape
+        self._voxels = {}
+        self._nearest = {}
+
+    def _key(self, img):
+        return (tuple(img.shape[:3]), img.affine.tobytes())
+
+    def voxels(self, img):
+        key = self._key(img)
+        if key not in self._voxels:
+            self._voxels[key] = to_voxels(self.points, img.affine)
+        return self._voxels[key]
+
+    def nearest(self, img):
+        # Flat index of the nearest voxel, -1 outside the image
+        key = self._key(img)
+        if key not in self._nearest:
+            idx = np.floor(self.voxels(img) + 0.5).astype(np.int64)
+            shape = np.asarray(img.shape[:3])[:, None]
+            inside = np.all((idx >= 0) & (idx < shape), axis=0)
+            flat = np.full(idx.shape[1], -1, dtype=np.int64)
+            flat[inside] = np.ravel_multi_index(idx[:, inside], img.shape[:3])
+            self._nearest[key] = flat
+        return self._nearest[key]
+
+    def sample(self, img, interp):
+        if interp == "nn":
+            flat = self.nearest(img)
+            data = np.asanyarray(img.dataobj).reshape(-1)
+            out = np.zeros(flat.shape, dtype=data.dtype)
+            out[flat >= 0] = data[flat[flat >= 0]]
+        else:
+            data = np.asarray(img.dataobj, dtype=np.float32)
+            out = ndimage.map_coordinates(data, self.voxels(img), order=ORDERS[interp], mode='constant', cval=0.0)
+        return out.reshape(self.out_shape)
+
+    def sample_channels(self, img, channels):
+        # Nearest-neighbour gather of the given channels of a 4D (x, y, z, channel) label array at once
+        flat = self.nearest(img)
+        inside = flat >= 0
+        data = np.asanyarray(img.dataobj).reshape(-1, img.shape[3])
+        out = np.zeros((flat.size, len(channels)), dtype=data.dtype)
+        out[inside] = data[np.ix_(flat[inside], channels)]
+        return out.reshape(self.out_shape + (len(channels),))
+
+
+def resample_all(sampler, ref_img, specs):
+    # specs: (input, output, interp); the output takes the reference grid
+    for src, dst, interp in specs:
+        img = images.load(src)
+        data = sampler.sample(img, interp)
+        if interp != "nn":
+            data = data.astype(np.float32)
+        header = ref_img.header.copy()
+        header.set_data_dtype(data.dtype)
+        images.save(nib.Nifti1Image(data, ref_img.affine, header), dst)
+        print(f"Resampled {src} -> {dst} ({interp})")
+
+
+def resample_atlases(sampler, ref_img, store, atlases, out_dir):
+    # Atlases of the store as w_<atlas> images on the reference grid, one gather of the requested channels per store array
+    grids = {}
+    for atlas in atlases:
+        img, channel = store.grid_image(atlas)
+        grids.setdefault(id(img), (img, []))[1].append((atlas, channel))
+    for img, members in grids.values():
+        channels = sorted({channel for _, channel in members})
+        sampled = sampler.sample_channels(img, channels)
+        for atlas, channel in members:
+            data = np.ascontiguousarray(sampled[..., channels.index(channel)])
+            header = ref_img.header.copy()
+            header.set_data_dtype(data.dtype)
+            dst = images.work_file(out_dir, 'w_' + atlas)
+            images.save(nib.Nifti1Image(data, ref_img.affine, header), dst)
+            print(f"Resampled atlas {atlas} -> {dst} (nn)")
+
+
+def parse_spec(spec):
+    parts = spec.rsplit(':', 2)
+    if len(parts) != 3 or parts[2] not in ORDERS:
+        raise argparse.ArgumentTypeError(f"Expected input:output:{{{','.join(ORDERS)}}}, got {spec}")
+    return tuple(parts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Resample images through the ANTs registration in one pass per direction.')
+    parser.add_argument('-affine', type=str, help="The ind2temp0GenericAffine.mat file.")
+    parser.add_argument('-warp', type=str, help="The forward displacement field (subject to template).")
+    parser.add_argument('-inverse_warp', type=str, help="The inverse displacement field (template to subject).")
+    parser.add_argument('-warp_smooth', type=float, default=0, help="Gaussian sigma (mm) applied to the forward field.")
+    parser.add_argument('-forward_ref', type=str, help="The template-space reference image.")
+    parser.add_argument('-inverse_ref', type=str, help="The subject-space reference image.")
+    parser.add_argument('-forward', type=parse_spec, nargs='*', default=[], help="input:output:interp to bring into template space.")
+    parser.add_argument('-inverse', type=parse_spec, nargs='*', default=[], help="input:output:interp to bring into subject space.")
+    parser.add_argument('-atlas_store', type=str, help="Atlas store (atlas_store.py) to bring -atlases from into subject space.")
+    parser.add_argument('-atlases', type=str, nargs='*', default=[], help="Atlases of the store, written as <atlas_out>/w_<atlas>.")
+    parser.add_argument('-atlas_out', type=str, help="Output directory of the atlases.")
+    args = parser.parse_args(argv)
+
+    affine = load_itk_affine(args.affine)
+
+    if args.inverse or args.atlases:
+        ref = images.load(args.inverse_ref)
+        points = inverse_points(ref, affine, load_warp(args.inverse_warp))
+        sampler = Sampler(points, ref.shape[:3])
+        resample_all(sampler, ref, args.inverse)
+        if args.atlases:
+            resample_atlases(sampler, ref, AtlasStore(args.atlas_store), args.atlases, args.atlas_out)
+
+    if args.forward:
+        ref = images.load(args.forward_ref)
+        points = forward_points(ref, affine, load_warp(args.warp, args.warp_smooth))
+        resample_all(Sampler(points, ref.shape[:3]), ref, args.forward)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+import os
+import ast
+import sys
+import glob
+import json
+import time
+import shutil
+import hashlib
+import argparse
+
+# Bump when the cache layout or keying changes so old entries are ignored
+CACHE_VERSION = 3
+CHUNK = 1 << 20
+
+WORKFLOWS_DIR = os.path.dirname(os.path.abspath(__file__))
+# Tool suites with a version file: tools installed under them are keyed by that file, not by the binary
+SUITE_VERSIONS = {"FSLDIR": "etc/fslversion", "FREESURFER_HOME": "build-stamp.txt"}
+
+# Entries not used for this long are pruned, then the oldest ones until the cache fits its size bound
+MAX_AGE_DAYS = float(os.environ.get('ASLSCP_CACHE_MAX_DAYS', 30))
+MAX_SIZE_GB = float(os.environ.get('ASLSCP_CACHE_MAX_GB', 50))
+
+
+def default_cache_dir():
+    return os.environ.get('ASLSCP_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'aslscp'))
+
+
+def hash_path(path, h):
+    # Content hash of a file, or of every file under a directory in sorted order
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                h.update(os.path.relpath(full, path).encode())
+                hash_path(full, h)
+        return
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            h.update(chunk)
+
+
+def script_files(step, folder=WORKFLOWS_DIR):
+    # A workflow script and the workflow modules it imports, transitively, in sorted order
+    found = set()
+    pending = [step]
+    while pending:
+        module = pending.pop()
+        path = os.path.join(folder, f"{module}.py")
+        if module in found or not os.path.isfile(path):
+            continue
+        found.add(module)
+        with open(path, 'r') as f:
+            tree = ast.parse(f.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                pending += [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                pending.append(node.module)
+    return [os.path.join(folder, f"{module}.py") for module in sorted(found)]
+
+
+def tool_version(tool):
+    """What identifies the build of an external tool: its suite's version file, else its binary.
+
+    The binary is identified by its resolved path, size and modification time,
+    so an upgrade changes the key without hashing large executables.
+    """
+    path = shutil.which(tool)
+    if path is None:
+        return f"{tool}: missing"
+    path = os.path.realpath(path)
+    for var, version_file in SUITE_VERSIONS.items():
+        root = os.environ.get(var)
+        if root and path.startswith(os.path.realpath(root) + os.sep):
+            try:
+                with open(os.path.join(root, version_file), 'r') as f:
+                    return f"{tool}: {var} {f.read().strip()}"
+            except OSError:
+                break
+    st = os.stat(path)
+    return f"{tool}: {path} {st.st_size} {st.st_mtime_ns}"
+
+
+def code_key(tools=(), code=""):
+    """Hash of what produces a stage's outputs.
+
+    `tools` are workflow steps (hashed with the workflow modules they import)
+    or external executables (see tool_version); `code` is extra source, e.g.
+    the shell functions a stage runs.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(code.encode())
+    for tool in tools:
+        h.update(f"\0tool\0{tool}\0".encode())
+        scripts = script_files(tool)
+        if scripts:
+            for path in scripts:
+                h.update(os.path.basename(path).encode())
+                hash_path(path, h)
+        else:
+            h.update(tool_version(tool).encode())
+    return h.hexdigest()
+
+
+def stage_key(name, inputs, params="", tools=(), code=""):
+    """Key of a stage: its name, parameters, code (see code_key) and the content of its inputs (not their paths)."""
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"v{CACHE_VERSION}\0{name}\0{params}\0{code_key(tools, code)}\0".encode())
+    for path in inputs:
+        h.update(b"\0input\0")
+        if os.path.exists(path):
+            hash_path(path, h)
+        else:
+            h.update(b"missing")
+    return h.hexdigest()
+
+
+def entry_dir(cache_dir, name, key):
+    return os.path.join(cache_dir, 'stages', name, key)
+
+
+def _copy(src, dst, mode=None):
+    # Entries and work folder outputs never share an inode, so a tool writing a restored output in place
+    # cannot change the entry; copy_file_range clones blocks on btrfs/XFS and copies in the kernel elsewhere
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    try:
+        with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+            while os.copy_file_range(fsrc.fileno(), fdst.fileno(), CHUNK << 4):
+                pass
+    except (AttributeError, OSError):
+        shutil.copyfile(src, tmp)
+    if mode is not None:
+        os.chmod(tmp, mode)
+    os.replace(tmp, dst)
+
+
+def store(cache_dir, name, key, outputs):
+    # Outputs may be files or glob patterns, every match is stored under the pattern's index
+    files = []
+    for i, spec in enumerate(outputs):
+        matches = sorted(glob.glob(spec)) if glob.has_magic(spec) else [spec]
+        for path in matches:
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f"Stage {name} did not produce {path}")
+            files.append((i, path))
+
+    final = entry_dir(cache_dir, name, key)
+    if os.path.exists(final):
+        return final
+    tmp = f"{final}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    for i, path in files:
+        os.makedirs(os.path.join(tmp, str(i)), exist_ok=True)
+        # Read-only, so nothing holding the entry's path writes to it either
+        _copy(path, os.path.join(tmp, str(i), os.path.basename(path)), mode=0o444)
+    with open(os.path.join(tmp, 'entry.json'), 'w') as f:
+        json.dump({"name": name, "outputs": list(outputs),
+                   "files": [[i, os.path.basename(p)] for i, p in files]}, f, indent=2)
+    # The entry only becomes visible once complete, so a crash never leaves a partial hit
+    try:
+        os.rename(tmp, final)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return final
+
+
+def restore(cache_dir, name, key, outputs):
+    """Put a cached stage's outputs in place. Returns False on a cache miss."""
+    entry = entry_dir(cache_dir, name, key)
+    try:
+        with open(os.path.join(entry, 'entry.json'), 'r') as f:
+            files = json.load(f)["files"]
+    except (OSError, ValueError, KeyError):
+        return False
+    for i, base in files:
+        dest_dir = os.path.dirname(outputs[i]) or '.'
+        os.makedirs(dest_dir, exist_ok=True)
+        _copy(os.path.join(entry, str(i), base), os.path.join(dest_dir, base))
+    # entry.json's modification time is the entry's last use, which prune goes by
+    try:
+        os.utime(os.path.join(entry, 'entry.json'))
+    except OSError:
+        pass
+    return True
+
+
+def _entry_size(entry):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(entry) for name in files)
+
+
+def prune(cache_dir, max_age_days=MAX_AGE_DAYS, max_size_gb=MAX_SIZE_GB):
+    """Remove stage entries unused for `max_age_days`, then the least recently used ones over `max_size_gb`.
+
+    Returns (entries removed, bytes freed). Entries being written are left alone.
+    """
+    entries = []
+    for entry_json in glob.glob(os.path.join(cache_dir, 'stages', '*', '*', 'entry.json')):
+        entry = os.path.dirname(entry_json)
+        try:
+            entries.append((os.path.getmtime(entry_json), _entry_size(entry), entry))
+        except OSError:
+            continue
+    entries.sort()
+    cutoff = time.time() - max_age_days * 86400
+    total = sum(size for _, size, _ in entries)
+    removed, freed = 0, 0
+    for used, size, entry in entries:
+        if used >= cutoff and total - freed <= max_size_gb * 2**30:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        removed += 1
+        freed += size
+    return removed, freed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Content-addressed cache for pipeline stage outputs.')
+    parser.add_argument('action', choices=['key', 'store', 'restore', 'prune'])
+    parser.add_argument('-name', type=str, help="The stage name.")
+    parser.add_argument('-key', type=str, help="The stage key (store/restore).")
+    parser.add_argument('-params', type=str, default="", help="Parameters that change the stage output.")
+    parser.add_argument('-tools', type=str, nargs='*', default=[],
+                        help="Workflow steps and external tools the stage runs, whose code or version goes into the key.")
+    parser.add_argument('-code', type=str, default="", help="Other code the stage runs (e.g. its shell functions).")
+    parser.add_argument('-in', dest='inputs', type=str, nargs='*', default=[], help="The stage input files or directories.")
+    parser.add_argument('-out', dest='outputs', type=str, nargs='*', default=[], help="The stage output files or glob patterns.")
+    parser.add_argument('-cache', type=str, default=None, help="The cache directory.")
+    parser.add_argument('-max_age', type=float, default=MAX_AGE_DAYS,
+                        help="prune: days an entry may go unused (default: $ASLSCP_CACHE_MAX_DAYS or 30).")
+    parser.add_argument('-max_size', type=float, default=MAX_SIZE_GB,
+                        help="prune: GB the stage entries may take (default: $ASLSCP_CACHE_MAX_GB or 50).")
+    args = parser.parse_args(argv)
+
+    cache_dir = args.cache or default_cache_dir()
+    if args.action == 'prune':
+        removed, freed = prune(cache_dir, args.max_age, args.max_size)
+        print(f"Pruned {removed} stage cache entries ({freed / 2**20:.0f} MB)")
+    elif args.name is None:
+        parser.error(f"{args.action} needs -name")
+    elif args.action == 'key':
+        print(stage_key(args.name, args.inputs, args.params, args.tools, args.code))
+    elif args.action == 'store':
+        store(cache_dir, args.name, args.key, args.outputs)
+    else:
+        sys.exit(0 if restore(cache_dir, args.name, args.key, args.outputs) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import os
+import sys
+import csv
+import json
+import sqlite3
+import zipfile
+import argparse
+import tempfile
+
+from flywheel_context import FIELDS
+
+# Bump when the schema changes; merge refuses stores of another version
+STORE_VERSION = 1
+# Where a session's store sits in its output (and in final_output.zip)
+SESSION_FILE = os.path.join('stats', 'stats.sqlite')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id INTEGER PRIMARY KEY,
+    subject TEXT,
+    session TEXT,
+    scan_date TEXT,
+    project TEXT,
+    acquisition TEXT,
+    analysis_id TEXT,
+    run_datetime TEXT,
+    UNIQUE (subject, session)
+);
+CREATE TABLE IF NOT EXISTS regions (
+    session_id INTEGER NOT NULL REFERENCES sessions (session_id),
+    atlas TEXT NOT NULL,
+    label INTEGER,
+    region TEXT NOT NULL,
+    mean REAL,
+    sd REAL,
+    voxels INTEGER,
+    volume REAL,
+    rcbf REAL
+);
+CREATE INDEX IF NOT EXISTS regions_region ON regions (atlas, region);
+CREATE INDEX IF NOT EXISTS regions_session ON regions (session_id);
+CREATE INDEX IF NOT EXISTS sessions_subject ON sessions (subject);
+CREATE VIEW IF NOT EXISTS region_stats AS
+    SELECT subject, session, scan_date, atlas, region, label, mean, sd, voxels, volume, rcbf
+    FROM regions JOIN sessions USING (session_id);
+"""
+SESSION_COLUMNS = ("subject", "session", "scan_date", "project", "acquisition", "analysis_id", "run_datetime")
+# metadata.json keys of the session columns
+METADATA_KEYS = {"subject": "subject_label", "session": "session_label", "scan_date": "scan_date",
+                 "project": "project_label", "acquisition": "acquisition_label", "analysis_id": "analysis_id",
+                 "run_datetime": "gear_run_datetime"}
+REGION_COLUMNS = ("atlas", "label", "region", "mean", "sd", "voxels", "volume", "rcbf")
+
+
+def connect(path):
+    con = sqlite3.connect(path)
+    con.executescript(SCHEMA)
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    if version == 0:
+        con.execute(f"PRAGMA user_version = {STORE_VERSION}")
+    elif version != STORE_VERSION:
+        con.close()
+        raise ValueError(f"{path} is a version {version} store, expected {STORE_VERSION}")
+    return con
+
+
+def session_metadata(metadata_file):
+    """Session columns from metadata.json next to `metadata_file`, or from its "Key: Value" lines."""
+    metadata = {}
+    try:
+        with open(os.path.join(os.path.dirname(metadata_file), 'metadata.json'), 'r') as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        keys = {label: key for key, label in FIELDS}
+        try:
+            with open(metadata_file, 'r') as f:
+                for line in f:
+                    label, _, value = line.partition(':')
+                    if label.strip() in keys:
+                        metadata[keys[label.strip()]] = value.strip()
+        except OSError:
+            pass
+    values = {column: metadata.get(key) for column, key in METADATA_KEYS.items()}
+    return {column: None if value in (None, '', 'Unknown') else str(value) for column, value in values.items()}
+
+
+def write_session(path, session, rows):
+    """One session's store: its `session` columns and region rows (tuples in REGION_COLUMNS order)."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    con = connect(tmp)
+    with con:
+        cur = con.execute(f"INSERT INTO sessions ({', '.join(SESSION_COLUMNS)}) VALUES ({', '.join('?' * len(SESSION_COLUMNS))})",
+                          [session.get(c) for c in SESSION_COLUMNS])
+        con.executemany(f"INSERT INTO regions (session_id, {', '.join(REGION_COLUMNS)}) "
+                        f"VALUES (?, {', '.join('?' * len(REGION_COLUMNS))})",
+                        [(cur.lastrowid,) + tuple(row) for row in rows])
+    con.close()
+    os.replace(tmp, path)
+
+
+def _session_file(source, tmp_dir):
+    # A session store, the stats/stats.sqlite of an output folder, or the one inside a final_output.zip
+    if os.path.isdir(source):
+        return os.path.join(source, SESSION_FILE)
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as zf:
+            member = next((n for n in zf.namelist() if n.endswith('stats/stats.sqlite')), None)
+            if member is None:
+                raise ValueError(f"No {SESSION_FILE} in {source}")
+            path = os.path.join(tmp_dir, 'session.sqlite')
+            with zf.open(member) as src, open(path, 'wb') as dst:
+                dst.write(src.read())
+            return path
+    return source
+
+
+def merge(cohort, sources):
+    """Append session stores into the cohort store, in one transaction per source.
+
+    A session already in the cohort (same subject and session labels) is
+    replaced, so merging a rerun or merging twice leaves one copy. Sessions
+    missing either label are always added. Returns the sessions merged.
+    """
+    con = connect(cohort)
+    merged = 0
+    try:
+        for source in sources:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = _session_file(source, tmp_dir)
+                if not os.path.exists(path):
+                    raise ValueError(f"No session store at {path}")
+                src = sqlite3.connect(path)
+                version = src.execute("PRAGMA user_version").fetchone()[0]
+                src.close()
+                if version != STORE_VERSION:
+                    raise ValueError(f"{source} is a version {version} store, expected {STORE_VERSION}")
+                con.execute("ATTACH DATABASE ? AS src", (path,))
+                try:
+                    with con:
+                        for row in con.execute(f"SELECT session_id, {', '.join(SESSION_COLUMNS)} FROM src.sessions").fetchall():
+                            # Sessions without both labels cannot be told apart, so they are always added
+                            old = con.execute("SELECT session_id FROM sessions WHERE subject = ? AND session = ?",
+                                              (row[1], row[2])).fetchone()
+                            if old:
+                                con.execute("DELETE FROM regions WHERE session_id = ?", old)
+                                con.execute("DELETE FROM sessions WHERE session_id = ?", old)
+                            cur = con.execute(f"INSERT INTO sessions ({', '.join(SESSION_COLUMNS)}) "
+                                              f"VALUES ({', '.join('?' * len(SESSION_COLUMNS))})", row[1:])
+                            con.execute(f"INSERT INTO regions (session_id, {', '.join(REGION_COLUMNS)}) "
+                                        f"SELECT ?, {', '.join(REGION_COLUMNS)} FROM src.regions WHERE session_id = ?",
+                                        (cur.lastrowid, row[0]))
+                            merged += 1
+                finally:
+                    con.execute("DETACH DATABASE src")
+    finally:
+        con.close()
+    return merged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Merge per-session CBF stats stores into a cohort store and query it.')
+    parser.add_argument('command', choices=('merge', 'query'),
+                        help="merge: append sessions into -db; query: run -sql on -db and print CSV.")
+    parser.add_argument('-db', type=str, required=True, help="The cohort store (SQLite).")
+    parser.add_argument('-sessions', type=str, nargs='*', default=[],
+                        help="merge: session stores, session output folders or final_output.zip files.")
+    parser.add_argument('-sql', type=str, default="SELECT * FROM region_stats",
+                        help="query: the SQL to run (the region_stats view joins sessions and regions).")
+    args = parser.parse_args(argv)
+
+    if args.command == 'merge':
+        try:
+            n = merge(args.db, args.sessions)
+        except (ValueError, sqlite3.Error) as e:
+            sys.exit(f"Merge failed: {e}")
+        print(f"Merged {n} sessions into {args.db}")
+    else:
+        con = connect(args.db)
+        cur = con.execute(args.sql)
+        writer = csv.writer(sys.stdout)
+        writer.writerow([d[0] for d in cur.description])
+        writer.writerows(cur)
+        con.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,54 +1,123 @@
 import os
 import numpy as np
 import nibabel as nib
-import matplotlib.pyplot as plt
-import scipy 
 import argparse
 import sys
 
-parser = argparse.ArgumentParser(description='get dcm parameters from the pipeline script')
+import images
+from stage_cache import default_cache_dir
 
-# Set up parser for the parameters extracted from the dicom header
-parser.add_argument('-m0_ir', type=str, help="The path to the m0_ir file.")
-parser.add_argument('-stats', type=str, help="The path to the stats directory.")
-parser.add_argument('-m', type=str, help="The path to the mask file.")
-parser.add_argument('-out',type=str, help='The output directory.')
-args = parser.parse_args()
+# Default inversion-recovery timing of the M0-IR pair (ms)
+TI = 1978
+TREC = 5000
+# T1 grid of the lookup table (ms): start, stop, step
+T1_GRID = (100, 5010, 10)
 
-m0_ir_file = args.m0_ir
-mask = args.m
-out_dir = args.out
-stats_dir = args.stats
 
-ref_data = nib.load(m0_ir_file).get_fdata().astype(np.float64)
+def z_curve(T1, TI=TI, trec=TREC):
+    # Signal ratio of the inversion-recovery image to the M0 image for a given T1
+    return (1 - 2 * np.exp(-TI / T1) + np.exp(-trec / T1)) / (1 - np.exp(-trec / T1))
 
-mask_img = nib.load(mask).get_fdata().astype(np.float64)
 
-T1 = np.arange(100, 5010, 10)
-trec = 5000
-TI = 1978
+def build_lut(TI=TI, trec=TREC, grid=T1_GRID):
+    # Lookup table sorted by increasing z so it can be searched directly
+    T1 = np.arange(*grid, dtype=np.float64)
+    z = z_curve(T1, TI, trec)
+    if not (np.all(np.diff(z) < 0) or np.all(np.diff(z) > 0)):
+        raise ValueError(f"z(T1) is not monotone for TI={TI}, trec={trec}, grid={grid}")
+    order = np.argsort(z)
+    return z[order], T1[order]
+
+
+def load_lut(TI=TI, trec=TREC, grid=T1_GRID, cache_dir=None):
+    """Return the (z, T1) lookup table, cached on disk by (TI, trec, grid)."""
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    name = "t1lut_TI{}_trec{}_grid{}-{}-{}.npz".format(TI, trec, *grid)
+    path = os.path.join(cache_dir, name)
+    if os.path.exists(path):
+        try:
+            with np.load(path) as cached:
+                return cached['z'], cached['T1']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    z, T1 = build_lut(TI, trec, grid)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary name first so concurrent jobs never read a partial file
+        tmp = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp, z=z, T1=T1)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Could not cache T1 lookup table in {cache_dir}: {e}", file=sys.stderr)
+    return z, T1
+
+
+def lookup_t1(ratio, lut):
+    # Piecewise-linear inverse of z(T1), extrapolating linearly past both ends
+    z, T1 = lut
+    t1 = np.interp(ratio, z, T1)
+    lo = ratio < z[0]
+    hi = ratio > z[-1]
+    t1[lo] = T1[0] + (ratio[lo] - z[0]) * (T1[1] - T1[0]) / (z[1] - z[0])
+    t1[hi] = T1[-1] + (ratio[hi] - z[-1]) * (T1[-1] - T1[-2]) / (z[-1] - z[-2])
+    return t1
+
+
+def fit_t1(m0, ir, mask, lut):
+    """Fit T1 (ms) from the M0 and inversion-recovery volumes inside the mask only."""
+    z = lut[0]
+    inside = mask > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = ir[inside].astype(np.float64) / m0[inside]
+    ratio[ratio == 0] = z.min()
+    ratio[ratio >= 1] = z.max()
+
+    t1 = np.zeros(mask.shape, dtype=np.float32)
+    fitted = lookup_t1(ratio, lut)
+    fitted[~np.isfinite(fitted)] = 0
+    t1[inside] = fitted
+    return t1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='get dcm parameters from the pipeline script')
+
+    # Set up parser for the parameters extracted from the dicom header
+    parser.add_argument('-m0_ir', type=str, help="The path to the m0_ir file.")
+    parser.add_argument('-stats', type=str, help="The path to the stats directory.")
+    parser.add_argument('-m', type=str, help="The path to the mask file.")
+    parser.add_argument('-out',type=str, help='The output directory.')
+    parser.add_argument('-ti', type=float, default=TI, help='Inversion time in ms.')
+    parser.add_argument('-trec', type=float, default=TREC, help='Recovery time in ms.')
+    parser.add_argument('-cache', type=str, default=None, help='Directory for the cached T1 lookup tables.')
+    args = parser.parse_args(argv)
+
+    m0_ir_file = args.m0_ir
+    mask = args.m
+    out_dir = args.out
+
+    ir_img = images.load(m0_ir_file)
+    m0_data = np.asarray(ir_img.dataobj[..., 0], dtype=np.float32)
+    ir_data = np.asarray(ir_img.dataobj[..., 1], dtype=np.float32)
+
+    nii = images.load(mask)
+    mask_data = np.asanyarray(nii.dataobj)
+
+    lut = load_lut(args.ti, args.trec, cache_dir=args.cache)
+    t1 = fit_t1(m0_data, ir_data, mask_data, lut)
+
+    header = nii.header.copy()
+    header.set_data_dtype(np.float32)
+    nii_img = nib.Nifti1Image(t1, nii.affine, header)
+    name = images.work_file(out_dir, 't1')
+    images.save(nii_img, name)
+
+    nii_img_m0 = nib.Nifti1Image(m0_data, nii.affine, header)
+    name_m0 = images.work_file(out_dir, 'm0')
+    images.save(nii_img_m0, name_m0)
+
 
-z = (1 - 2 * np.exp(-TI / T1) + np.exp(-trec / T1)) / (1 - np.exp(-trec / T1))
-
-ratio = ref_data[:,:,:,1] / ref_data[:,:,:,0]
-# ratio = ratio * mask_img
-ratio[ratio==0] = np.min(z)
-ratio[ratio>=1] = np.max(z)
-f = scipy.interpolate.interp1d(z,T1, fill_value='extrapolate')
-
-t1 = f(ratio)
-t1[np.isnan(t1)] = 0
-t1 = t1 * mask_img
-
-nii = nib.load(mask)
-nii.header.set_data_dtype(np.float32)
-nii_data = np.asarray(t1, dtype=np.float32)
-nii_img = nib.Nifti1Image(nii_data, nii.affine,nii.header)
-name = out_dir + '/t1.nii.gz'
-nib.save(nii_img, name)
-
-nii_data_m0 = ref_data[:,:,:,0]
-nii_data_m0 = np.asarray(nii_data_m0, dtype=np.float32)
-nii_img_m0 = nib.Nifti1Image(nii_data_m0, nii.affine,nii.header)
-name_m0 = out_dir + '/m0.nii.gz'
-nib.save(nii_img_m0, name_m0)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The workflow steps import each other as top-level modules, like when run from workflows/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,106 @@
+import os
+import zipfile
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import archive
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+@pytest.fixture
+def pool():
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        yield pool
+
+
+@pytest.fixture
+def payloads():
+    # Compressible text across several deflate chunks, incompressible bytes, an empty file, a UTF-8 name
+    return {"stats/table.txt": b"Region | Mean CBF\n" * (archive.CHUNK // 8),
+            "viz/noise.png": os.urandom(archive.CHUNK + 123),
+            "empty.txt": b"",
+            "café.json": b'{"a": 1}'}
+
+
+def check_roundtrip(path, payloads):
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == sorted(payloads)
+        for name, data in payloads.items():
+            assert zf.read(name) == data
+
+
+def test_stored_and_deflated_members(tmp_path, pool, payloads):
+    target = str(tmp_path / "out.zip")
+    writer = archive.ZipWriter(target, pool, window=2)
+    results = {}
+    for name, data in payloads.items():
+        deflate = not name.endswith('.png')
+        results[name] = writer.add(write(str(tmp_path / "src" / name), data), name, deflate)
+    writer.close()
+
+    check_roundtrip(target, payloads)
+    with zipfile.ZipFile(target) as zf:
+        for name, data in payloads.items():
+            info = zf.getinfo(name)
+            assert info.compress_type == (zipfile.ZIP_STORED if name.endswith('.png') else zipfile.ZIP_DEFLATED)
+            size, compressed, sha = results[name]
+            assert (size, compressed) == (info.file_size, info.compress_size)
+            assert sha == hashlib.sha256(data).hexdigest()
+    assert results["stats/table.txt"][1] < len(payloads["stats/table.txt"]) // 10
+
+
+def test_members_past_4gib_use_zip64(tmp_path, pool, payloads):
+    # A sparse gap before the first member puts every offset past the 32-bit limit without writing 4 GiB
+    target = str(tmp_path / "big.zip")
+    writer = archive.ZipWriter(target, pool)
+    writer.f.seek(archive.ZIP64_LIMIT + 1)
+    for name, data in payloads.items():
+        writer.add(write(str(tmp_path / "src" / name), data), name, not name.endswith('.png'))
+    writer.close()
+
+    with open(target, 'rb') as f:
+        f.seek(-(56 + 20 + 22), os.SEEK_END)
+        # zip64 end of central directory record, its locator, then the classic end record
+        assert f.read(4) == b"PK\x06\x06"
+    check_roundtrip(target, payloads)
+    with zipfile.ZipFile(target) as zf:
+        assert all(info.header_offset > archive.ZIP64_LIMIT for info in zf.infolist())
+
+
+def test_policy_archives_dedupe_and_manifest(tmp_path):
+    export = tmp_path / "export"
+    work = tmp_path / "work"
+    write(str(export / "cbf.nii.gz"), b"\x1f\x8b" + os.urandom(5000))
+    write(str(export / "stats" / "table.txt"), b"mean 40\n" * 1000)
+    write(str(work / "cbf.nii"), b"volume" * 1000)
+    # Same content as an exported file: listed, not archived again
+    write(str(work / "copy.txt"), b"mean 40\n" * 1000)
+    write(str(work / "sub.nii"), b"excluded" * 10)
+    policy = {"store": [".gz"],
+              "archives": [{"name": "final_output.zip", "root": "export", "members": ["+ *", "- *.zip"]},
+                           {"name": "work_dir.zip", "root": "work", "dedupe": True,
+                            "members": ["+ *", "- sub.nii*"]}]}
+
+    manifest = archive.build_archives(policy, {"export": str(export), "work": str(work)}, str(export), jobs=2)
+
+    final, work_zip = manifest["archives"]
+    assert {m["path"]: m["method"] for m in final["members"]} == {"cbf.nii.gz": "store", "stats/table.txt": "deflate"}
+    assert [m["path"] for m in work_zip["members"]] == ["cbf.nii"]
+    assert work_zip["duplicates"] == [{"path": "copy.txt", "sha256": hashlib.sha256(b"mean 40\n" * 1000).hexdigest(),
+                                       "same_as": "final_output.zip:stats/table.txt"}]
+    for entry in manifest["archives"]:
+        path = str(export / entry["name"])
+        assert entry["sha256"] == archive.file_sha256(path)
+        with zipfile.ZipFile(path) as zf:
+            assert zf.testzip() is None
+            for member in entry["members"]:
+                assert hashlib.sha256(zf.read(member["path"])).hexdigest() == member["sha256"]
@@ -0,0 +1,123 @@
+import struct
+import zipfile
+
+import pytest
+
+import ascconv
+
+EXPLICIT_LE = b"1.2.840.10008.1.2.1"
+PROTOCOL = (b"### ASCCONV BEGIN object=MrProtDataImpl@MrProtocolData ###\n"
+            b"sWipMemBlock.alFree[0]\t = 1800000\n"
+            b"sWipMemBlock.alFree[1] = 2000000\n"
+            b"sWipMemBlock.alFree[11] = 4\n"
+            b"sWipMemBlock.adFree[3] = 1.25\n"
+            b"### ASCCONV END ###\n"
+            b"sWipMemBlock.alFree[20] = 99\n")
+
+
+def element(group, elem, vr, value, implicit=False):
+    if len(value) % 2:
+        value += b"\0"
+    if implicit and group != 0x0002:
+        return struct.pack('<HHI', group, elem, len(value)) + value
+    if vr in ascconv.LONG_VRS:
+        return struct.pack('<HH2sHI', group, elem, vr, 0, len(value)) + value
+    return struct.pack('<HH2sH', group, elem, vr, len(value)) + value
+
+
+def referenced_series(uid, implicit=False):
+    # (0008,1115) sequence of undefined length holding another series' UID, which must not be picked up
+    item = struct.pack('<HHI', 0xFFFE, 0xE000, ascconv.UNDEFINED) + element(0x0020, 0x000E, b"UI", uid, implicit)
+    item += struct.pack('<HHI', 0xFFFE, 0xE00D, 0)
+    head = (struct.pack('<HHI', 0x0008, 0x1115, ascconv.UNDEFINED) if implicit
+            else struct.pack('<HH2sHI', 0x0008, 0x1115, b"SQ", 0, ascconv.UNDEFINED))
+    return head + item + struct.pack('<HHI', 0xFFFE, 0xE0DD, 0)
+
+
+def dicom(uid=b"1.2.3.4", protocol=PROTOCOL, pixels=64, transfer=EXPLICIT_LE):
+    implicit = transfer == ascconv.IMPLICIT_LE
+    data = b"\0" * 128 + b"DICM" + element(0x0002, 0x0010, b"UI", transfer)
+    data += element(0x0008, 0x103E, b"LO", b"pCASL", implicit)
+    data += referenced_series(b"9.9.9", implicit)
+    data += element(0x0020, 0x000E, b"UI", uid, implicit)
+    if protocol is not None:
+        data += element(0x0029, 0x0010, b"LO", b"SIEMENS CSA HEADER", implicit)
+        data += element(0x0029, 0x1020, b"OB", b"\x01" * 300 + protocol, implicit)
+    return data + element(0x7FE0, 0x0010, b"OW", b"\x07" * pixels, implicit)
+
+
+def test_series_uid_skips_referenced_series():
+    assert ascconv.series_uid(dicom()) == "1.2.3.4"
+
+
+def test_series_uid_implicit_vr():
+    assert ascconv.series_uid(dicom(uid=b"5.6.7", transfer=ascconv.IMPLICIT_LE)) == "5.6.7"
+
+
+def test_series_uid_of_other_files_is_none():
+    assert ascconv.series_uid(b"\0" * 200) is None
+    # Truncated inside the header
+    assert ascconv.series_uid(dicom()[:150]) is None
+
+
+def test_parse_wip_block_reads_only_the_first_block():
+    wip = ascconv.parse_wip_block(dicom())
+    assert wip == {"alFree": {0: 1800000, 1: 2000000, 11: 4}, "adFree": {3: 1.25}}
+    assert ascconv.parse_wip_block(dicom(protocol=None)) is None
+
+
+def test_read_protocol_from_file_and_zip_member(tmp_path):
+    data = dicom(pixels=4 * ascconv.CHUNK)
+    path = tmp_path / "IM0001.dcm"
+    path.write_bytes(data)
+    archive = tmp_path / "asl.zip"
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("series/IM0001.dcm", data)
+        zf.writestr("series/readme.txt", b"not a dicom")
+
+    expected = ("1.2.3.4", ascconv.parse_wip_block(data))
+    assert ascconv.read_protocol(str(path)) == expected
+    files = ascconv.dicom_files(str(archive))
+    assert files == [f"{archive}{ascconv.ZIP_MEMBER}series/IM0001.dcm"]
+    assert ascconv.read_protocol(files[0]) == expected
+
+
+def test_read_header_stops_before_the_pixel_data(tmp_path):
+    archive = tmp_path / "m0.zip"
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("a.dcm", dicom(pixels=8 * ascconv.CHUNK))
+        zf.writestr("b.dcm", dicom(protocol=None, pixels=8 * ascconv.CHUNK))
+    with zipfile.ZipFile(archive) as zf:
+        for name in ("a.dcm", "b.dcm"):
+            with zf.open(name) as f:
+                assert len(ascconv.read_header(f)) == ascconv.CHUNK
+    assert ascconv.read_protocol(f"{archive}{ascconv.ZIP_MEMBER}b.dcm") == ("1.2.3.4", None)
+
+
+def test_series_protocol_checks_samples_and_caches(tmp_path):
+    folder = tmp_path / "asl"
+    folder.mkdir()
+    for i in range(5):
+        (folder / f"IM{i:04d}.dcm").write_bytes(dicom())
+    (folder / "asl.json").write_text("{}")
+    cache = tmp_path / "cache"
+
+    wip = ascconv.series_protocol(str(folder), str(cache))
+    assert ascconv.pipeline_params(wip) == {"ld": 1800000, "pld": 2000000, "nbs": 4}
+    assert (cache / "ascconv" / "1.2.3.4.json").exists()
+    # Cached by series UID, so a later read no longer needs the protocol
+    (folder / "IM0000.dcm").write_bytes(dicom(protocol=None))
+    assert ascconv.series_protocol(str(folder), str(cache)) == wip
+
+
+def test_series_protocol_rejects_mixed_series_and_protocols(tmp_path):
+    folder = tmp_path / "asl"
+    folder.mkdir()
+    (folder / "a.dcm").write_bytes(dicom())
+    (folder / "b.dcm").write_bytes(dicom(uid=b"1.2.3.5"))
+    with pytest.raises(ascconv.ProtocolError, match="several series"):
+        ascconv.series_protocol(str(folder), str(tmp_path / "cache"))
+
+    (folder / "b.dcm").write_bytes(dicom(protocol=PROTOCOL.replace(b"[11] = 4", b"[11] = 3")))
+    with pytest.raises(ascconv.ProtocolError, match=r"alFree\[11\] differ"):
+        ascconv.series_protocol(str(folder), str(tmp_path / "cache"))
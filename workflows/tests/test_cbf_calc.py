@@ -0,0 +1,117 @@
+import json
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import images
+import cbf_calc
+
+SHAPE = (12, 10, 7)
+N_PAIRS = 12
+M0 = 1000.0
+
+
+def phantom(seed=0):
+    """(ASL difference series, M0, mask): a GM-like and a WM-like tissue and small noise on every pair."""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(SHAPE, dtype=np.uint8)
+    mask[1:-1, 1:-1, 1:-1] = 1
+    level = np.where(rng.random(SHAPE) > 0.5, 8.0, 3.0) * mask
+    asl = level[..., None] + rng.normal(0, 0.2, SHAPE + (N_PAIRS,)) * mask[..., None]
+    m0 = np.full(SHAPE, M0) * mask
+    return asl.astype(np.float32), m0.astype(np.float32), mask
+
+
+def image(data):
+    return nib.Nifti1Image(data, np.diag([2.0, 2.0, 3.0, 1.0]))
+
+
+def run_score(asl, m0, mask, **kwargs):
+    series = cbf_calc.quantify_pairs(asl, m0, mask, 1.0, 1.0)
+    classes = cbf_calc.perfusion_classes(series)
+    return cbf_calc.score(series, classes, **kwargs)
+
+
+def test_score_keeps_clean_pairs():
+    kept, _ = run_score(*phantom())
+    assert kept.sum() >= N_PAIRS - 2
+
+
+def test_score_rejects_a_global_outlier_pair():
+    asl, m0, mask = phantom()
+    asl[..., 5] *= 3
+    kept, rejected = run_score(asl, m0, mask)
+    assert (5, "gm_outlier") in rejected and not kept[5]
+
+
+def test_score_rejects_a_spatially_noisy_pair():
+    # With the GM outlier step off, only the variance step can find it
+    asl, m0, mask = phantom()
+    asl[..., 7] += np.random.default_rng(1).normal(0, 4, SHAPE) * mask
+    kept, rejected = run_score(asl, m0, mask, threshold=np.inf)
+    assert (7, "variance") in rejected and not kept[7]
+    assert rejected[0][0] == 7
+
+
+def test_pooled_variance_matches_a_direct_computation():
+    asl, m0, mask = phantom()
+    series = cbf_calc.quantify_pairs(asl, m0, mask, 1.0, 1.0).astype(np.float64)
+    classes = cbf_calc.perfusion_classes(series)
+    sizes = [int(c.sum()) for c in classes]
+    sums = [series[c].sum(axis=0) for c in classes]
+    grams = [series[c].T @ series[c] for c in classes]
+    w = np.ones(N_PAIRS)
+    w[2] = 0
+    current, loo = cbf_calc.pooled_variance(w, sizes, sums, grams)
+
+    def direct(weights):
+        mean = series @ (weights / weights.sum())
+        return sum(mean[c].var() * c.sum() for c in classes) / sum(sizes)
+    assert current == pytest.approx(direct(w))
+    for pair in (0, 5):
+        without = w.copy()
+        without[pair] = 0
+        assert loo[pair] == pytest.approx(direct(without))
+
+
+@pytest.mark.parametrize("slab", [1, 3, 16])
+def test_slabs_match_the_whole_volume(slab):
+    asl, m0, mask = phantom()
+    # Slabs without brain are skipped, and one slab has a single voxel
+    mask[:, :, 1] = 0
+    mask[:, :, 2] = 0
+    mask[4, 4, 2] = 1
+    whole = cbf_calc.quantify(asl, m0, mask, 2.0, 50.0)
+    np.testing.assert_array_equal(cbf_calc.quantify_slabs(image(asl), image(m0), image(mask), 2.0, 50.0, slab), whole)
+
+    series, slabs = cbf_calc.quantify_pair_slabs(image(asl), image(m0), image(mask), 2.0, 50.0, slab)
+    for pair in (0, N_PAIRS - 1):
+        expected = cbf_calc.quantify(asl[..., pair], m0, mask, 2.0, 50.0)
+        np.testing.assert_allclose(cbf_calc.scatter_slabs(series[:, pair], slabs, SHAPE), expected, rtol=1e-6)
+    np.testing.assert_allclose(cbf_calc.scatter_slabs(series.mean(axis=1), slabs, SHAPE), whole, rtol=1e-5, atol=1e-5)
+
+
+def test_main_score_with_and_without_slabs(tmp_path, monkeypatch):
+    monkeypatch.setenv(images.WORK_EXT_ENV, '.nii')
+    asl, m0, mask = phantom()
+    asl[..., 5] *= 3
+    for name, data in (("sub", asl), ("m0", m0), ("mask", mask)):
+        nib.save(image(data), str(tmp_path / f"{name}.nii"))
+    outputs = {}
+    for slab in (0, 2):
+        out = tmp_path / f"slab{slab}"
+        out.mkdir()
+        cbf_calc.main(['-m0', str(tmp_path / "m0.nii"), '-asl', str(tmp_path / "sub.nii"), '-m', str(tmp_path / "mask.nii"),
+                       '-ld', '1800000', '-pld', '1800000', '-nbs', '4', '-scale', '1', '-out', str(out),
+                       '-score', str(out / "score.json"), '-slab', str(slab)])
+        with open(out / "score.json") as f:
+            report = json.load(f)
+        assert 5 not in report["kept"] and report["pairs"] == N_PAIRS
+        outputs[slab] = (report, np.asanyarray(nib.load(str(out / "cbf.nii")).dataobj),
+                         np.asanyarray(nib.load(str(out / "cbf_pairs.nii")).dataobj))
+    assert outputs[0][0] == outputs[2][0]
+    np.testing.assert_allclose(outputs[2][1], outputs[0][1], rtol=1e-5)
+    np.testing.assert_array_equal(outputs[2][2], outputs[0][2])
+    assert outputs[2][2].shape == SHAPE + (N_PAIRS,)
+    assert np.all(outputs[2][1][mask == 0] == 0)
@@ -0,0 +1,164 @@
+import os
+import re
+import json
+import shutil
+import zipfile
+import subprocess
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import dicom_ingest
+
+# Oblique slices: rows and columns rotated 20 degrees about the z axis, then tilted about x
+ANGLE, TILT = np.radians(20), np.radians(10)
+ROW = np.array([np.cos(ANGLE), np.sin(ANGLE), 0.0])
+COL = np.array([-np.sin(ANGLE) * np.cos(TILT), np.cos(ANGLE) * np.cos(TILT), np.sin(TILT)])
+NORMAL = np.cross(ROW, COL)
+ORIGIN = np.array([-100.0, -80.0, -30.0])
+# (row spacing, column spacing) as in PixelSpacing, and the slice gap
+SPACING = (2.0, 2.5)
+GAP = 4.0
+
+
+def series(n_rows=5, n_cols=6, n_slices=4, n_volumes=3, seed=0):
+    """Frames of a synthetic series in shuffled order and the (x, y, z, t) volume they should make."""
+    rng = np.random.default_rng(seed)
+    # pixels[t, k] is slice k of volume t as stored in DICOM: (rows, columns)
+    pixels = rng.integers(0, 4000, (n_volumes, n_slices, n_rows, n_cols)).astype(np.uint16)
+    frames = []
+    for t in range(n_volumes):
+        for k in range(n_slices):
+            position = ORIGIN + k * GAP * NORMAL
+            frames.append((list(position), list(ROW) + list(COL), list(SPACING), GAP, 1, 0, (t + 1, k, 0),
+                           pixels[t, k]))
+    shuffled = [frames[i] for i in rng.permutation(len(frames))]
+    return shuffled, pixels.transpose(3, 2, 1, 0)
+
+
+def lps_of_voxel(i, j, k):
+    # Pixel (row j, column i) of slice k in patient (LPS) coordinates
+    return ORIGIN + i * SPACING[1] * ROW + j * SPACING[0] * COL + k * GAP * NORMAL
+
+
+def test_assemble_orders_slices_and_volumes():
+    frames, expected = series()
+    data, affine, slope, intercept = dicom_ingest.assemble(frames)
+    assert data.dtype == np.uint16
+    np.testing.assert_array_equal(data, expected)
+    assert (slope, intercept) == (1.0, 0.0)
+
+
+def test_assemble_affine_maps_voxels_to_ras():
+    frames, _ = series()
+    _, affine, _, _ = dicom_ingest.assemble(frames)
+    for ijk in [(0, 0, 0), (5, 0, 0), (0, 4, 0), (3, 2, 3)]:
+        ras = affine @ np.array(ijk + (1,), dtype=np.float64)
+        np.testing.assert_allclose(ras[:3], lps_of_voxel(*ijk) * [-1, -1, 1], atol=1e-9)
+
+
+def test_assemble_single_volume_and_single_slice():
+    frames, expected = series(n_slices=1, n_volumes=1)
+    data, affine, _, _ = dicom_ingest.assemble(frames)
+    np.testing.assert_array_equal(data, expected[..., 0])
+    # One slice: the slice direction comes from the slice thickness
+    np.testing.assert_allclose(affine[:3, 2], GAP * NORMAL * [-1, -1, 1], atol=1e-9)
+
+
+def test_assemble_applies_mixed_rescaling():
+    frames, expected = series(n_volumes=2)
+    frames = [f[:4] + ((2.0, -5.0) if f[6][0] == 2 else (1.0, 0.0)) + f[6:] for f in frames]
+    data, _, slope, intercept = dicom_ingest.assemble(frames)
+    assert data.dtype == np.float32 and (slope, intercept) == (1.0, 0.0)
+    np.testing.assert_allclose(data[..., 0], expected[..., 0])
+    np.testing.assert_allclose(data[..., 1], expected[..., 1] * 2.0 - 5.0)
+
+
+def test_assemble_keeps_a_common_rescaling_for_the_header():
+    frames, expected = series()
+    frames = [f[:4] + (0.5, 10.0) + f[6:] for f in frames]
+    data, _, slope, intercept = dicom_ingest.assemble(frames)
+    assert data.dtype == np.uint16 and (slope, intercept) == (0.5, 10.0)
+    np.testing.assert_array_equal(data, expected)
+
+
+def test_assemble_rejects_inconsistent_series():
+    frames, _ = series()
+    with pytest.raises(dicom_ingest.IngestError, match="different numbers of frames"):
+        dicom_ingest.assemble(frames[:-1])
+    tilted = frames[0][:1] + (list(COL) + list(ROW),) + frames[0][2:]
+    with pytest.raises(dicom_ingest.IngestError, match="orientations"):
+        dicom_ingest.assemble([tilted] + frames[1:])
+
+
+# The pipeline's qT1 test (Rule 1), read from the script so the two cannot drift apart
+PIPELINE = os.path.join(os.path.dirname(__file__), '..', '..', 'pipeline_singlePLD.sh')
+
+
+def test_pulse_sequence_unescapes_the_protocol():
+    protocol = b'### ASCCONV BEGIN ###\ntSequenceFileName\t = \t""%CustomerSeq%\\\\upenn_spiral_pcasl""\n'
+    assert dicom_ingest.pulse_sequence(protocol) == '%CustomerSeq%\\upenn_spiral_pcasl'
+    assert dicom_ingest.pulse_sequence(b'no protocol here') is None
+
+
+def test_sidecar_sequence_matches_the_pipeline_qt1_check(tmp_path):
+    if shutil.which('jq') is None:
+        pytest.skip("jq is not installed")
+    with open(PIPELINE) as f:
+        pattern = re.search(r'\[\[ \$s =~ (\S*upenn_spiral_pcasl) \]\]', f.read()).group(1)
+    protocol = b'tSequenceFileName\t = \t""%CustomerSeq%\\\\upenn_spiral_pcasl""\n'
+    header = {"PulseSequenceDetails": dicom_ingest.pulse_sequence(protocol)}
+    path = tmp_path / "asl.json"
+    path.write_text(json.dumps(dicom_ingest.sidecar(header, 1), indent=2))
+    script = ("while IFS= read -r s; do [[ $s =~ " + pattern + " ]] && { echo match; exit; }; "
+              "done < <(jq -r '.. | strings' \"$1\"); echo no match")
+    result = subprocess.run(['bash', '-c', script, 'qt1', str(path)], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "match"
+
+
+def test_ingest_zip_writes_nifti_and_sidecar(tmp_path):
+    pytest.importorskip("pydicom")
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+    frames, expected = series(n_volumes=2)
+    uid = generate_uid()
+    archive = tmp_path / "asl.zip"
+    with zipfile.ZipFile(archive, 'w') as zf:
+        for n, (position, orientation, spacing, thickness, _, _, order, pixels) in enumerate(frames):
+            meta = FileMetaDataset()
+            meta.MediaStorageSOPClassUID = MRImageStorage
+            meta.MediaStorageSOPInstanceUID = generate_uid()
+            meta.TransferSyntaxUID = ExplicitVRLittleEndian
+            ds = Dataset()
+            ds.file_meta = meta
+            ds.SOPClassUID = MRImageStorage
+            ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+            ds.Modality = "MR"
+            ds.SeriesInstanceUID = uid
+            ds.SeriesDescription = "pCASL 3D"
+            ds.RepetitionTime = 4000
+            ds.AcquisitionNumber = order[0]
+            ds.InstanceNumber = n + 1
+            ds.ImagePositionPatient = [round(v, 6) for v in position]
+            ds.ImageOrientationPatient = [round(v, 8) for v in orientation]
+            ds.PixelSpacing = list(spacing)
+            ds.SliceThickness = thickness
+            ds.Rows, ds.Columns = pixels.shape
+            ds.SamplesPerPixel = 1
+            ds.PhotometricInterpretation = "MONOCHROME2"
+            ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 0
+            ds.PixelData = pixels.tobytes()
+            path = tmp_path / "dcm"
+            ds.save_as(path, enforce_file_format=True)
+            zf.write(path, f"DICOM/IM{n:04d}")
+
+    written = dicom_ingest.ingest(str(archive), str(tmp_path / "out"), jobs=2)
+    assert [p.rsplit('/', 1)[-1] for p in written] == ["pCASL_3D.nii"]
+    img = nib.load(written[0])
+    np.testing.assert_array_equal(np.asanyarray(img.dataobj), expected)
+    np.testing.assert_allclose(img.affine @ [2, 3, 1, 1], np.append(lps_of_voxel(2, 3, 1) * [-1, -1, 1], 1), atol=1e-4)
+    assert img.header.get_zooms()[3] == pytest.approx(4.0)
+    sidecar = (tmp_path / "out" / "pCASL_3D.json").read_text()
+    assert '"Volumes": 2' in sidecar and '"RepetitionTime": 4.0' in sidecar
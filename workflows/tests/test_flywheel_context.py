@@ -0,0 +1,72 @@
+import os
+import json
+
+import pytest
+
+import flywheel_context
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'flywheel.json')
+
+
+@pytest.fixture
+def fw():
+    return flywheel_context.FakeClient(FIXTURE)
+
+
+def test_session_analysis_labels(fw):
+    labels = flywheel_context.resolve(fw, "an1")
+    assert labels == {"project_label": "StudyA", "subject_label": "S001", "session_label": "S001x20240102x3TxStudyA",
+                      "acquisition_label": "pCASL", "analysis_id": "an1", "scan_date": "20240102"}
+    # The analysis, then project, session and subject in parallel; the acquisition comes from the session listing
+    assert fw.calls == 4
+
+
+def test_acquisition_analysis_fetches_its_acquisition(fw):
+    labels = flywheel_context.resolve(fw, "an2")
+    assert labels["acquisition_label"] == "pCASL_repeat"
+    assert fw.calls == 5
+
+
+def test_subject_from_the_session_when_the_analysis_lacks_it(fw):
+    labels = flywheel_context.resolve(fw, "an3")
+    assert (labels["subject_label"], labels["session_label"], labels["scan_date"]) == ("S002", "S002_baseline", "Unknown")
+    # No acquisition in se2
+    assert labels["acquisition_label"] == "Unknown"
+    assert fw.calls == 4
+
+
+def test_unknown_analysis_raises(fw):
+    with pytest.raises(LookupError):
+        flywheel_context.resolve(fw, "nope")
+
+
+def test_cache_hit_makes_no_calls(tmp_path, fw):
+    first = flywheel_context.cached_resolve(fw, "an1", str(tmp_path))
+    assert fw.calls == 4
+    assert os.path.exists(flywheel_context.cache_file(str(tmp_path), "an1"))
+
+    again = flywheel_context.FakeClient(FIXTURE)
+    assert flywheel_context.cached_resolve(again, "an1", str(tmp_path)) == first
+    assert again.calls == 0
+    # Another analysis is a miss
+    flywheel_context.cached_resolve(again, "an2", str(tmp_path))
+    assert again.calls == 5
+
+
+def test_stale_cache_version_is_refetched(tmp_path, fw):
+    path = flywheel_context.cache_file(str(tmp_path), "an1")
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        json.dump({"version": flywheel_context.CACHE_VERSION - 1, "labels": {"subject_label": "old"}}, f)
+    assert flywheel_context.cached_resolve(fw, "an1", str(tmp_path))["subject_label"] == "S001"
+    assert fw.calls == 4
+
+
+def test_main_writes_metadata_offline(tmp_path):
+    flywheel_context.main(['-fake', FIXTURE, '-workdir', str(tmp_path / "work"), '-cache', str(tmp_path / "cache")])
+    with open(tmp_path / "work" / "metadata.json") as f:
+        metadata = json.load(f)
+    assert metadata["subject_label"] == "S001" and metadata["analysis_id"] == "an1"
+    with open(tmp_path / "work" / "metadata.txt") as f:
+        text = f.read()
+    assert "Subject: S001\n" in text and "Scan Date: 20240102\n" in text
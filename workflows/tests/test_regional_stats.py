@@ -0,0 +1,100 @@
+import os
+import json
+
+import numpy as np
+import pytest
+
+import regional_stats
+
+SHAPE = (10, 10, 4)
+
+
+@pytest.fixture
+def session():
+    """CBF, mask and two atlases: 'tissue' (1: cortex, 2: white matter, 3: a 4-voxel sliver) and 'lobes'."""
+    cbf = np.zeros(SHAPE, dtype=np.float32)
+    tissue = np.zeros(SHAPE, dtype=np.int16)
+    tissue[:5] = 1
+    tissue[5:] = 2
+    tissue[9, 9, :] = 3
+    cbf[tissue == 1] = 60.0
+    cbf[tissue == 2] = 20.0
+    cbf[tissue == 3] = 500.0
+    lobes = np.zeros(SHAPE, dtype=np.int16)
+    # Frontal overlaps both tissues
+    lobes[3:7, :5] = 1
+    mask = np.ones(SHAPE, dtype=np.uint8)
+    # A masked-out row and a zero-CBF voxel are not counted
+    mask[0, 0] = 0
+    cbf[1, 1, 1] = 0
+    label_maps = {"tissue": tissue, "lobes": lobes}
+    label_names = {"tissue": ["Cortex", "White", "Sliver"], "lobes": ["Frontal"]}
+    return cbf, mask, label_maps, label_names
+
+
+def region(name, **members):
+    return {"name": name, "members": members}
+
+
+def test_composites_weight_by_voxels_and_count_overlaps_once(session):
+    cbf, mask, label_maps, label_names = session
+    regions = [region("Whole", tissue=["Cortex", "White"]),
+               region("Cortex+Frontal", tissue=["Cortex"], lobes=["Frontal"])]
+    whole, overlap = regional_stats.composite_stats(cbf, mask, label_maps, label_names, regions)
+    cortex = int(((label_maps["tissue"] == 1) & (mask > 0) & (cbf != 0)).sum())
+    white = int(((label_maps["tissue"] == 2) & (mask > 0)).sum())
+    assert whole == ("Whole", pytest.approx((60.0 * cortex + 20.0 * white) / (cortex + white)), cortex + white)
+    # Frontal voxels in the cortex are counted once; 40 frontal voxels (x 5..6) are white matter
+    assert overlap[2] == cortex + 40
+    assert overlap[1] == pytest.approx((60.0 * cortex + 20.0 * 40) / (cortex + 40))
+
+
+def test_composites_leave_out_tiny_member_labels(session):
+    cbf, mask, label_maps, label_names = session
+    regions = [region("White+Sliver", tissue=["White", "Sliver"]), region("Sliver", tissue=["Sliver"])]
+    with_sliver, sliver = regional_stats.composite_stats(cbf, mask, label_maps, label_names, regions)
+    white_only = regional_stats.composite_stats(cbf, mask, label_maps, label_names, [region("White", tissue=["White"])])[0]
+    # The 4-voxel label is not in formatted_cbf_tissue.txt, and not in the composites either
+    stats = regional_stats.regional_stats(cbf, mask, label_maps, 8.0)["tissue"]
+    assert [r for _, r in regional_stats.table_labels(label_names["tissue"], stats)] == ["Cortex", "White"]
+    assert with_sliver[1:] == white_only[1:] and sliver[2] == 0
+    # With the filter off it counts
+    assert regional_stats.composite_stats(cbf, mask, label_maps, label_names, regions, min_voxels=1)[1][2] == 4
+
+
+def test_composite_errors(session):
+    cbf, mask, label_maps, label_names = session
+    with pytest.raises(ValueError, match="atlas cortical"):
+        regional_stats.composite_stats(cbf, mask, label_maps, label_names, [region("X", cortical=["A"])])
+    with pytest.raises(ValueError, match="no label 'Insula'"):
+        regional_stats.composite_stats(cbf, mask, label_maps, label_names, [region("X", tissue=["Insula"])])
+
+
+def test_weighted_tables_report_voxel_counts(tmp_path, session):
+    cbf, mask, label_maps, label_names = session
+    results = regional_stats.composite_stats(cbf, mask, label_maps, label_names,
+                                             [region("Whole", tissue=["Cortex", "White"]),
+                                              region("Cortex", tissue=["Cortex"]),
+                                              region("Empty", tissue=["Sliver"]),
+                                              region("Reference", tissue=["White"])])
+    reference = results.pop()
+    regional_stats.write_composites(str(tmp_path), results, reference)
+    rcbf = regional_stats.read_table(os.path.join(tmp_path, 'weighted_rcbf.txt'))
+    table = regional_stats.read_table(os.path.join(tmp_path, 'weighted_table.txt'))
+    # Regions without voxels are left out; Voxels is a count, not a volume
+    assert [r["Region"] for r in rcbf] == ["Whole", "Cortex"]
+    assert [int(r["Voxels"]) for r in rcbf] == [count for _, _, count in results[:2]]
+    assert table[1] == {"Region": "Cortex", "Mean": "60", "rCBF": "3.0", "Voxels": str(results[1][2])}
+
+
+def test_pipeline_composite_config_loads():
+    regions, reference = regional_stats.load_composites(regional_stats.COMPOSITES)
+    assert reference["name"] == "Putamen L+R"
+    assert [r["name"] for r in regions][:3] == ["Whole brain", "Grey_Matter L+R", "White_Matter L+R"]
+
+
+def test_load_composites_rejects_bad_regions(tmp_path):
+    path = tmp_path / "bad.json"
+    path.write_text(json.dumps({"regions": [{"name": "No members"}]}))
+    with pytest.raises(ValueError, match="members"):
+        regional_stats.load_composites(str(path))
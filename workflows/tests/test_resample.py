@@ -0,0 +1,61 @@
+import numpy as np
+import nibabel as nib
+
+import images
+import resample
+
+AFFINE = np.diag([2.0, 2.0, 2.0, 1.0])
+
+
+class GridStore:
+    # The part of AtlasStore resample_atlases uses: atlases as channels of one 4D label array
+    def __init__(self, channels, data):
+        self.channels = channels
+        self.img = nib.Nifti1Image(data, AFFINE)
+
+    def grid_image(self, atlas):
+        return self.img, self.channels.index(atlas)
+
+
+def labels(seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 50, (6, 5, 4, 4)).astype(np.int16)
+
+
+def half_voxel_sampler():
+    # A reference grid shifted by a little under half a voxel, so nearest neighbour picks the same voxels
+    ref = nib.Nifti1Image(np.zeros((6, 5, 4), dtype=np.float32), AFFINE)
+    points = resample.grid_points(ref) + np.array([0.9, -0.9, 0.0])
+    return ref, resample.Sampler(points, ref.shape)
+
+
+def test_sample_channels_gathers_only_the_requested_channels():
+    data = labels()
+    ref, sampler = half_voxel_sampler()
+    img = nib.Nifti1Image(data, AFFINE)
+    sampled = sampler.sample_channels(img, [1, 3])
+    assert sampled.shape == ref.shape + (2,) and sampled.dtype == data.dtype
+    for i, channel in enumerate([1, 3]):
+        single = sampler.sample(nib.Nifti1Image(np.ascontiguousarray(data[..., channel]), AFFINE), "nn")
+        np.testing.assert_array_equal(sampled[..., i], single)
+
+
+def test_sample_channels_is_zero_outside_the_source():
+    data = labels() + 1
+    ref, _ = half_voxel_sampler()
+    sampler = resample.Sampler(resample.grid_points(ref) + np.array([6.0, 0.0, 0.0]), ref.shape)
+    sampled = sampler.sample_channels(nib.Nifti1Image(data, AFFINE), [0])
+    # Shifted by 6 mm (3 voxels) in LPS x, i.e. -x in RAS: the first three columns fall outside
+    assert np.all(sampled[:3, ..., 0] == 0) and np.all(sampled[3:, ..., 0] > 0)
+
+
+def test_resample_atlases_writes_the_requested_atlases(tmp_path, monkeypatch):
+    monkeypatch.setenv(images.WORK_EXT_ENV, '.nii')
+    data = labels()
+    store = GridStore(["tissue", "tissue_ero", "parcels", "parcels_ero"], data)
+    ref, sampler = half_voxel_sampler()
+    resample.resample_atlases(sampler, ref, store, ["parcels", "tissue"], str(tmp_path))
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["w_parcels.nii", "w_tissue.nii"]
+    for atlas in ("tissue", "parcels"):
+        written = np.asanyarray(nib.load(str(tmp_path / f"w_{atlas}.nii")).dataobj)
+        np.testing.assert_array_equal(written, data[..., store.channels.index(atlas)])
@@ -0,0 +1,132 @@
+import os
+import time
+from functools import partial
+
+import pytest
+
+import stage_cache
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(data)
+    return str(path)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+@pytest.fixture
+def steps(tmp_path):
+    # Workflow scripts: a step importing a helper that imports another, plus stdlib and third-party imports
+    folder = tmp_path / "steps"
+    write(folder / "step.py", "import os\nimport numpy as np\nimport helper\n")
+    write(folder / "helper.py", "from base import X\n")
+    write(folder / "base.py", "X = 1\n")
+    write(folder / "other.py", "Y = 2\n")
+    return str(folder)
+
+
+def test_script_files_follows_local_imports(steps):
+    assert [os.path.basename(p) for p in stage_cache.script_files("step", steps)] == ["base.py", "helper.py", "step.py"]
+    assert stage_cache.script_files("missing", steps) == []
+
+
+def test_script_files_of_a_workflow_step():
+    scripts = [os.path.basename(p) for p in stage_cache.script_files("transform_store")]
+    assert scripts == ["images.py", "stage_cache.py", "transform_store.py"]
+
+
+def test_stage_key_covers_input_content_not_paths(tmp_path):
+    a = write(tmp_path / "a" / "in.nii", "data")
+    b = write(tmp_path / "b" / "in.nii", "data")
+    key = stage_cache.stage_key("stage", [a])
+    assert stage_cache.stage_key("stage", [b]) == key
+    assert stage_cache.stage_key("other", [a]) != key
+    assert stage_cache.stage_key("stage", [a], params="-x 1") != key
+    assert stage_cache.stage_key("stage", [a], code="function f { :; }") != key
+    assert stage_cache.stage_key("stage", [a, str(tmp_path / "missing")]) != key
+    write(a, "changed")
+    assert stage_cache.stage_key("stage", [a]) != key
+
+
+def test_code_key_changes_with_imported_modules(steps, monkeypatch):
+    monkeypatch.setattr(stage_cache, "script_files", partial(stage_cache.script_files, folder=steps))
+    key = stage_cache.code_key(["step"])
+    write(os.path.join(steps, "other.py"), "Y = 3\n")
+    assert stage_cache.code_key(["step"]) == key
+    write(os.path.join(steps, "base.py"), "X = 2\n")
+    assert stage_cache.code_key(["step"]) != key
+
+
+def test_tool_version_of_a_binary(tmp_path, monkeypatch):
+    tool = tmp_path / "bin" / "tool"
+    write(tool, "#!/bin/sh\n")
+    os.chmod(tool, 0o755)
+    monkeypatch.setenv("PATH", str(tool.parent))
+    version = stage_cache.tool_version("tool")
+    assert version.startswith(f"tool: {os.path.realpath(tool)} ")
+    assert stage_cache.tool_version("no_such_tool") == "no_such_tool: missing"
+    # A tool inside an FSL install is keyed by FSL's version file
+    fsl = tmp_path / "fsl"
+    write(fsl / "etc" / "fslversion", "6.0.7.9\n")
+    write(fsl / "bin" / "flirt", "#!/bin/sh\n")
+    os.chmod(fsl / "bin" / "flirt", 0o755)
+    monkeypatch.setenv("PATH", str(fsl / "bin"))
+    monkeypatch.setenv("FSLDIR", str(fsl))
+    assert stage_cache.tool_version("flirt") == "flirt: FSLDIR 6.0.7.9"
+
+
+def test_store_and_restore_do_not_share_files(tmp_path):
+    cache = str(tmp_path / "cache")
+    out = write(tmp_path / "work" / "cbf.nii", "cbf")
+    pairs = write(tmp_path / "work" / "pairs_1.txt", "pair")
+    outputs = [out, str(tmp_path / "work" / "pairs_*.txt")]
+    entry = stage_cache.store(cache, "stage", "k1", outputs)
+    assert not os.stat(os.path.join(entry, "0", "cbf.nii")).st_mode & 0o222
+
+    # A tool writing its output in place after the stage ran leaves the entry alone
+    with open(out, 'w') as f:
+        f.write("overwritten")
+    os.remove(pairs)
+    assert stage_cache.restore(cache, "stage", "k1", outputs)
+    assert read(out) == "cbf" and read(pairs) == "pair"
+    # So does one writing a restored output
+    assert os.access(out, os.W_OK) or os.geteuid() == 0
+    with open(out, 'w') as f:
+        f.write("overwritten")
+    assert os.stat(out).st_ino != os.stat(os.path.join(entry, "0", "cbf.nii")).st_ino
+    assert read(os.path.join(entry, "0", "cbf.nii")) == "cbf"
+    assert not stage_cache.restore(cache, "stage", "k2", outputs)
+
+
+def test_store_needs_every_output(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        stage_cache.store(str(tmp_path / "cache"), "stage", "k", [str(tmp_path / "missing.nii")])
+    assert not os.path.exists(stage_cache.entry_dir(str(tmp_path / "cache"), "stage", "k"))
+
+
+def test_prune_by_age_then_size(tmp_path):
+    cache = str(tmp_path / "cache")
+    now = time.time()
+    for n, age_days in enumerate([40, 3, 2, 1]):
+        out = write(tmp_path / "work" / f"out{n}.bin", "x" * 1000)
+        entry = stage_cache.store(cache, "stage", f"k{n}", [out])
+        os.utime(os.path.join(entry, "entry.json"), (now - age_days * 86400,) * 2)
+
+    # The entry unused for 40 days goes; the rest fit in the size bound
+    assert stage_cache.prune(cache, max_age_days=30, max_size_gb=1)[0] == 1
+    # Over the size bound, the least recently used go first
+    removed, freed = stage_cache.prune(cache, max_age_days=30, max_size_gb=2500 / 2**30)
+    assert removed == 1 and freed >= 1000
+    left = sorted(os.listdir(os.path.join(cache, "stages", "stage")))
+    assert left == ["k2", "k3"]
+    # A restore counts as a use
+    out = str(tmp_path / "work" / "out2.bin")
+    os.utime(os.path.join(cache, "stages", "stage", "k3", "entry.json"), (now - 86400,) * 2)
+    assert stage_cache.restore(cache, "stage", "k2", [out])
+    stage_cache.prune(cache, max_age_days=30, max_size_gb=1500 / 2**30)
+    assert os.listdir(os.path.join(cache, "stages", "stage")) == ["k2"]
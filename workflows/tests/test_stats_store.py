@@ -0,0 +1,109 @@
+import os
+import sqlite3
+import zipfile
+
+import pytest
+
+import stats_store
+
+
+def session_row(subject, session, **extra):
+    row = {"subject": subject, "session": session, "scan_date": "2024-01-02", "project": "proj"}
+    row.update(extra)
+    return row
+
+
+def regions(mean):
+    # (atlas, label, region, mean, sd, voxels, volume, rcbf)
+    return [("cortical", 1, "Frontal Pole", mean, 5.0, 120, 960.0, 1.1),
+            ("cortical", 2, "Insular Cortex", mean + 10, 6.0, 80, 640.0, 1.2)]
+
+
+def write_output(folder, session, rows):
+    # A session output folder with its store at stats/stats.sqlite
+    path = os.path.join(folder, stats_store.SESSION_FILE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    stats_store.write_session(path, session, rows)
+    return str(folder)
+
+
+def query(db, sql):
+    con = sqlite3.connect(db)
+    try:
+        return con.execute(sql).fetchall()
+    finally:
+        con.close()
+
+
+def test_write_session_and_merge(tmp_path):
+    a = write_output(tmp_path / "a", session_row("sub-01", "ses-A"), regions(40.0))
+    b = write_output(tmp_path / "b", session_row("sub-02", "ses-A"), regions(50.0))
+    db = str(tmp_path / "cohort.sqlite")
+    assert stats_store.merge(db, [a, b]) == 2
+    rows = query(db, "SELECT subject, region, mean FROM region_stats ORDER BY subject, label")
+    assert rows == [("sub-01", "Frontal Pole", 40.0), ("sub-01", "Insular Cortex", 50.0),
+                    ("sub-02", "Frontal Pole", 50.0), ("sub-02", "Insular Cortex", 60.0)]
+
+
+def test_merging_a_session_again_replaces_it(tmp_path):
+    db = str(tmp_path / "cohort.sqlite")
+    first = write_output(tmp_path / "first", session_row("sub-01", "ses-A"), regions(40.0))
+    stats_store.merge(db, [first])
+    stats_store.merge(db, [first])
+    rerun = write_output(tmp_path / "rerun", session_row("sub-01", "ses-A", analysis_id="rerun"), regions(45.0))
+    stats_store.merge(db, [rerun])
+    assert query(db, "SELECT subject, session, analysis_id FROM sessions") == [("sub-01", "ses-A", "rerun")]
+    assert query(db, "SELECT count(*), min(mean) FROM regions") == [(2, 45.0)]
+
+
+def test_sessions_without_labels_are_always_added(tmp_path):
+    db = str(tmp_path / "cohort.sqlite")
+    unlabelled = write_output(tmp_path / "u1", session_row("sub-01", None), regions(40.0))
+    anonymous = write_output(tmp_path / "u2", session_row(None, None), regions(41.0))
+    assert stats_store.merge(db, [unlabelled, unlabelled, anonymous, anonymous]) == 4
+    assert query(db, "SELECT count(*) FROM sessions") == [(4,)]
+    # Each keeps its own regions
+    assert query(db, "SELECT count(DISTINCT session_id), count(*) FROM regions") == [(4, 8)]
+
+
+def test_merge_rejects_another_store_version(tmp_path):
+    db = str(tmp_path / "cohort.sqlite")
+    old = write_output(tmp_path / "old", session_row("sub-01", "ses-A"), regions(40.0))
+    con = sqlite3.connect(os.path.join(old, stats_store.SESSION_FILE))
+    con.execute(f"PRAGMA user_version = {stats_store.STORE_VERSION + 1}")
+    con.close()
+    good = write_output(tmp_path / "good", session_row("sub-02", "ses-A"), regions(40.0))
+    stats_store.merge(db, [good])
+    with pytest.raises(ValueError, match="version"):
+        stats_store.merge(db, [old])
+    # The cohort is untouched, and a cohort of another version is refused too
+    assert query(db, "SELECT subject FROM sessions") == [("sub-02",)]
+    con = sqlite3.connect(db)
+    con.execute(f"PRAGMA user_version = {stats_store.STORE_VERSION + 1}")
+    con.close()
+    with pytest.raises(ValueError, match="version"):
+        stats_store.merge(db, [good])
+
+
+def test_merge_reads_the_store_out_of_final_output_zip(tmp_path):
+    output = write_output(tmp_path / "out", session_row("sub-03", "ses-B"), regions(30.0))
+    archive = str(tmp_path / "final_output.zip")
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.write(os.path.join(output, stats_store.SESSION_FILE), "output/stats/stats.sqlite")
+        zf.writestr("output/stats/table.txt", "not a store")
+    db = str(tmp_path / "cohort.sqlite")
+    assert stats_store.merge(db, [archive]) == 1
+    assert query(db, "SELECT subject, session, count(*) FROM region_stats") == [("sub-03", "ses-B", 2)]
+
+    empty = str(tmp_path / "empty.zip")
+    with zipfile.ZipFile(empty, 'w') as zf:
+        zf.writestr("output/stats/table.txt", "no store")
+    with pytest.raises(ValueError, match="No"):
+        stats_store.merge(db, [empty])
+
+
+def test_session_metadata_from_metadata_txt(tmp_path):
+    path = tmp_path / "metadata.txt"
+    path.write_text("Subject: sub-01\nSession: Unknown\n")
+    metadata = stats_store.session_metadata(str(path))
+    assert metadata["subject"] == "sub-01" and metadata["session"] is None
@@ -0,0 +1,134 @@
+import os
+import json
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import transform_store
+
+
+def write_image(path, data):
+    nib.save(nib.Nifti1Image(np.asarray(data, dtype=np.float32), np.eye(4)), str(path))
+    return str(path)
+
+
+def write_bytes(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+@pytest.fixture
+def session(tmp_path):
+    # A template, one session's registration outputs and its metadata.txt
+    rng = np.random.default_rng(0)
+    template = rng.random((8, 8, 6)) + 1.0
+    folder = tmp_path / "sess1"
+    folder.mkdir()
+    (folder / "metadata.txt").write_text("Subject: sub-01\nSession: ses-A\n")
+    return {"store": str(tmp_path / "store"),
+            "template": write_image(tmp_path / "template.nii.gz", template),
+            "warped": write_image(folder / "warped.nii.gz", template + 0.1 * rng.random(template.shape)),
+            "moving": write_image(folder / "s_asl.nii.gz", rng.random((8, 8, 6))),
+            "affine": write_bytes(folder / "affine.mat", b"affine of ses-A"),
+            "metadata": str(folder / "metadata.txt"),
+            "tmp": tmp_path}
+
+
+def args(s, action, *extra):
+    return [action, '-store', s["store"], '-metadata', s["metadata"], '-template', s["template"]] + list(extra)
+
+
+def entry_of(s):
+    with open(os.path.join(transform_store.subject_dir(s["store"], "sub-01"), 'entry.json')) as f:
+        return json.load(f)
+
+
+def test_subject_label_from_metadata_txt(session):
+    assert transform_store.subject_label(session["metadata"]) == "sub-01"
+    unknown = session["tmp"] / "metadata_unknown.txt"
+    unknown.write_text("Subject: Unknown\n")
+    assert transform_store.subject_label(str(unknown)) is None
+
+
+def test_save_then_lookup_copies_the_prior(session):
+    entry = transform_store.save(session["store"], "sub-01", session["template"], session["affine"],
+                                 session["moving"], "ses-A", 0.9, full=True)
+    assert entry["reference_similarity"] == 0.9 and entry["moving"] == "moving.nii.gz"
+    out = str(session["tmp"] / "prior")
+    found = transform_store.lookup(session["store"], "sub-01", session["template"], out)
+    assert found == entry
+    with open(os.path.join(out, 'affine.mat'), 'rb') as f:
+        assert f.read() == b"affine of ses-A"
+    assert transform_store.file_sha256(os.path.join(out, 'moving.nii.gz')) == transform_store.file_sha256(session["moving"])
+
+
+def test_lookup_rejects_mismatched_copies(session):
+    transform_store.save(session["store"], "sub-01", session["template"], session["affine"],
+                         session["moving"], "ses-A", 0.9, full=True)
+    folder = transform_store.subject_dir(session["store"], "sub-01")
+    out = str(session["tmp"] / "prior")
+    # Another session of the subject overwrote the moving image but not (yet) entry.json
+    write_image(os.path.join(folder, 'moving.nii.gz'), np.zeros((8, 8, 6)))
+    assert transform_store.lookup(session["store"], "sub-01", session["template"], out) is None
+    assert not os.path.exists(out)
+    # A stale entry of another store version or template is not used either
+    transform_store.save(session["store"], "sub-01", session["template"], session["affine"],
+                         session["moving"], "ses-A", 0.9, full=True)
+    other = write_image(session["tmp"] / "other_template.nii.gz", np.ones((8, 8, 6)))
+    assert transform_store.lookup(session["store"], "sub-01", other, out) is None
+    assert transform_store.lookup(str(session["tmp"] / "empty"), "sub-01", session["template"], out) is None
+
+
+def test_warm_started_save_keeps_the_full_reference(session):
+    transform_store.save(session["store"], "sub-01", session["template"], session["affine"],
+                         session["moving"], "ses-A", 0.9, full=True)
+    entry = transform_store.save(session["store"], "sub-01", session["template"], session["affine"],
+                                 session["moving"], "ses-B", 0.88, full=False)
+    assert entry["similarity"] == 0.88 and entry["reference_similarity"] == 0.9
+    # A later warm start still compares against the last full registration, not the warm one
+    entry = transform_store.save(session["store"], "sub-01", session["template"], session["affine"],
+                                 session["moving"], "ses-C", 0.87, full=False)
+    assert entry["reference_similarity"] == 0.9
+    entry = transform_store.save(session["store"], "sub-01", session["template"], session["affine"],
+                                 session["moving"], "ses-D", 0.8, full=True)
+    assert entry["reference_similarity"] == 0.8
+
+
+def test_check_exit_codes(session):
+    # No entry for the subject yet
+    with pytest.raises(SystemExit) as e:
+        transform_store.main(args(session, 'check', '-warped', session["warped"]))
+    assert e.value.code == 1
+    transform_store.main(args(session, 'save', '-affine', session["affine"], '-moving', session["moving"],
+                              '-warped', session["warped"], '-full'))
+    reference = entry_of(session)["reference_similarity"]
+    assert reference == pytest.approx(transform_store.similarity(session["template"], session["warped"]))
+    assert entry_of(session)["session"] == "sess1"
+    # The same registration passes; one that matches the template worse than the tolerance allows fails
+    with pytest.raises(SystemExit) as e:
+        transform_store.main(args(session, 'check', '-warped', session["warped"]))
+    assert e.value.code == 0
+    noise = write_image(session["tmp"] / "noise.nii.gz", np.random.default_rng(1).random((8, 8, 6)))
+    with pytest.raises(SystemExit) as e:
+        transform_store.main(args(session, 'check', '-warped', noise))
+    assert e.value.code == 1
+
+
+def test_lookup_exit_codes(session):
+    out = str(session["tmp"] / "prior")
+    with pytest.raises(SystemExit) as e:
+        transform_store.main(args(session, 'lookup', '-out', out))
+    assert e.value.code == 1
+    transform_store.main(args(session, 'save', '-affine', session["affine"], '-moving', session["moving"],
+                              '-warped', session["warped"], '-full'))
+    transform_store.main(args(session, 'lookup', '-out', out))
+    assert sorted(os.listdir(out)) == ["affine.mat", "moving.nii.gz"]
+    # Without a subject label the store is not used at all
+    anonymous = session["tmp"] / "metadata_anonymous.txt"
+    anonymous.write_text("Session: ses-A\n")
+    with pytest.raises(SystemExit) as e:
+        transform_store.main(['lookup', '-store', session["store"], '-metadata', str(anonymous),
+                              '-template', session["template"], '-out', out])
+    assert e.value.code == 1
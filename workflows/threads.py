@@ -0,0 +1,114 @@
+import os
+import math
+import argparse
+from contextlib import contextmanager
+
+# Total threads of the run (set by the pipeline from `plan`, or to override the detection)
+BUDGET_ENV = 'ASLSCP_THREADS'
+# What the threaded libraries of the tools read: OpenMP, MKL, OpenBLAS, ITK (ANTs) and PyTorch (synthstrip via OMP)
+THREAD_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS")
+
+# Stages whose tools scale with threads get the whole budget ("all") or a fixed count;
+# everything else runs single-threaded. Process/thread pools (viz, export, archive)
+# size themselves with -jobs from budget() instead and keep their workers at one thread.
+STAGE_THREADS = {
+    "registration": "all",
+    "registration_rigid": "all",
+    "synthstrip": "all",
+}
+
+
+def cgroup_cpus(root='/sys/fs/cgroup'):
+    """CPUs allowed by the cgroup CPU quota (rounded up), None when unlimited or unknown."""
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open(os.path.join(root, 'cpu.max'), 'r') as f:
+            quota, period = f.read().split()[:2]
+        if quota == 'max':
+            return None
+        return max(1, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1
+        with open(os.path.join(root, 'cpu', 'cpu.cfs_quota_us'), 'r') as f:
+            quota = int(f.read())
+        with open(os.path.join(root, 'cpu', 'cpu.cfs_period_us'), 'r') as f:
+            period = int(f.read())
+        return max(1, math.ceil(quota / period)) if quota > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def budget():
+    """Threads this run may use: ASLSCP_THREADS, else the CPUs we are pinned to capped by the cgroup quota."""
+    try:
+        return max(1, int(os.environ[BUDGET_ENV]))
+    except (KeyError, ValueError):
+        pass
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpus()
+    return max(1, min(cpus, quota) if quota else cpus)
+
+
+def stage_threads(stage, total=None):
+    n = STAGE_THREADS.get(stage, 1)
+    total = total or budget()
+    return total if n == "all" else max(1, min(int(n), total))
+
+
+def stage_env(stage, total=None):
+    n = str(stage_threads(stage, total))
+    return {var: n for var in THREAD_VARS}
+
+
+@contextmanager
+def limited(stage):
+    """Thread variables of `stage` for a step run in this process (and the processes it starts).
+
+    Libraries read the variables when they load, so the BLAS pool of an
+    already imported NumPy is limited through threadpoolctl when it is installed.
+    """
+    env = stage_env(stage)
+    saved = {var: os.environ.get(var) for var in env}
+    os.environ.update(env)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        threadpool_limits = None
+    try:
+        if threadpool_limits is None:
+            yield
+        else:
+            with threadpool_limits(limits=int(env["OMP_NUM_THREADS"])):
+                yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Thread budget of the run and of each stage.')
+    parser.add_argument('command', choices=('plan', 'show'),
+                        help="plan: bash declarations for the pipeline; show: the budget of every stage.")
+    args = parser.parse_args(argv)
+
+    total = budget()
+    if args.command == 'plan':
+        print(f"export {BUDGET_ENV}={total}")
+        print("declare -A stage_threads=(" + " ".join(f"[{s}]={stage_threads(s, total)}" for s in STAGE_THREADS) + ")")
+    else:
+        print(f"budget: {total} (cgroup quota: {cgroup_cpus() or 'none'})")
+        for stage in STAGE_THREADS:
+            print(f"{stage}: {stage_threads(stage, total)}")
+        print("other stages: 1")
+
+
+if __name__ == "__main__":
+    main()
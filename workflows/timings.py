@@ -0,0 +1,228 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+from contextlib import contextmanager
+
+# JSON-lines trace the pipeline points every stage at; tracing is off when unset
+TRACE_ENV = 'ASLSCP_TRACE'
+
+# Stages listed in the QC summary, slowest first
+SUMMARY_STAGES = 10
+
+
+def trace_file():
+    return os.environ.get(TRACE_ENV) or None
+
+
+def _io_counters():
+    # Bytes read/written through syscalls; includes children once they are reaped
+    counters = {}
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters.get('rchar', 0), counters.get('wchar', 0)
+
+
+def _reset_peak_rss():
+    # Linux >= 4.0 resets VmHWM when "5" is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_kb():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _snapshot():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read, written = _io_counters()
+    return {
+        "wall": time.time(),
+        "user": own.ru_utime + children.ru_utime,
+        "sys": own.ru_stime + children.ru_stime,
+        "children_rss_kb": children.ru_maxrss,
+        "read": read,
+        "written": written,
+    }
+
+
+def _record(stage, kind, start, end, peak_rss_kb, status):
+    return {
+        "stage": stage,
+        "kind": kind,
+        "start": round(start["wall"], 3),
+        "wall_s": round(end["wall"] - start["wall"], 3),
+        "user_s": round(end["user"] - start["user"], 3),
+        "sys_s": round(end["sys"] - start["sys"], 3),
+        "peak_rss_mb": round(peak_rss_kb / 1024, 1),
+        "read_mb": round((end["read"] - start["read"]) / 2**20, 2),
+        "written_mb": round((end["written"] - start["written"]) / 2**20, 2),
+        "status": status,
+    }
+
+
+def append(log, record):
+    # One write per line with O_APPEND, so concurrent writers never interleave records
+    line = (json.dumps(record) + "\n").encode()
+    fd = os.open(log, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def measure(stage, kind="python", log=None):
+    """Trace a block running in this process (and any children it reaps).
+
+    Yields a dict whose "status" the caller may set; the record is appended to
+    `log` (default: $ASLSCP_TRACE) when the block exits. No-op without a log.
+    """
+    log = log or trace_file()
+    outcome = {"status": 0}
+    if not log:
+        yield outcome
+        return
+    reset = _reset_peak_rss()
+    start = _snapshot()
+    try:
+        yield outcome
+    except BaseException:
+        outcome["status"] = 1
+        raise
+    finally:
+        end = _snapshot()
+        peak = _peak_rss_kb() if reset else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Children (e.g. render workers) only count if one of them set a new high
+        if end["children_rss_kb"] > start["children_rss_kb"]:
+            peak = max(peak, end["children_rss_kb"])
+        append(log, _record(stage, kind, start, end, peak, outcome["status"]))
+
+
+def run_command(stage, cmd, log=None):
+    """Run an external tool and trace it. Returns its exit status."""
+    log = log or trace_file()
+    start = _snapshot()
+    try:
+        status = subprocess.call(cmd)
+    except OSError as e:
+        print(f"{cmd[0]}: {e}", file=sys.stderr)
+        status = 127
+    if log:
+        end = _snapshot()
+        # This process only ever has this one child, so its max RSS is the tool's
+        # (never below this interpreter's own, which the child starts from before exec)
+        append(log, _record(stage, "tool", start, end, end["children_rss_kb"], status))
+    return status
+
+
+def read_trace(log):
+    records = []
+    try:
+        with open(log, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def summarize(records):
+    """Per-stage totals in first-run order plus the whole-run total."""
+    stages = {}
+    for rec in records:
+        s = stages.setdefault(rec["stage"], {"stage": rec["stage"], "kind": rec["kind"], "runs": 0, "wall_s": 0.0,
+                                             "user_s": 0.0, "sys_s": 0.0, "peak_rss_mb": 0.0, "read_mb": 0.0,
+                                             "written_mb": 0.0, "failed": 0})
+        s["runs"] += 1
+        for key in ("wall_s", "user_s", "sys_s", "read_mb", "written_mb"):
+            s[key] = round(s[key] + rec[key], 3)
+        s["peak_rss_mb"] = max(s["peak_rss_mb"], rec["peak_rss_mb"])
+        s["failed"] += rec["status"] != 0
+
+    rows = list(stages.values())
+    total = {"stages": len(rows), "wall_s": 0.0, "cpu_s": 0.0, "peak_rss_mb": 0.0, "read_mb": 0.0, "written_mb": 0.0}
+    if records:
+        total["wall_s"] = round(max(r["start"] + r["wall_s"] for r in records) - min(r["start"] for r in records), 3)
+    for s in rows:
+        total["cpu_s"] = round(total["cpu_s"] + s["user_s"] + s["sys_s"], 3)
+        total["peak_rss_mb"] = max(total["peak_rss_mb"], s["peak_rss_mb"])
+        total["read_mb"] = round(total["read_mb"] + s["read_mb"], 2)
+        total["written_mb"] = round(total["written_mb"] + s["written_mb"], 2)
+    return rows, total
+
+
+def write_report(log, out_file):
+    records = read_trace(log)
+    stages, total = summarize(records)
+    report = {"total": total, "stages": stages, "records": records}
+    tmp = out_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp, out_file)
+    return report
+
+
+def summary_rows(report, n=SUMMARY_STAGES):
+    # Slowest stages for the QC report: (stage, wall, cpu, peak RSS, read, written)
+    stages = sorted(report.get("stages", []), key=lambda s: s["wall_s"], reverse=True)[:n]
+    rows = [(s["stage"], f"{s['wall_s']:.1f}", f"{s['user_s'] + s['sys_s']:.1f}", f"{s['peak_rss_mb']:.0f}",
+             f"{s['read_mb']:.0f}", f"{s['written_mb']:.0f}") for s in stages]
+    total = report.get("total")
+    if total:
+        rows.append(("Total", f"{total['wall_s']:.1f}", f"{total['cpu_s']:.1f}", f"{total['peak_rss_mb']:.0f}",
+                     f"{total['read_mb']:.0f}", f"{total['written_mb']:.0f}"))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Trace pipeline stages and report wall time, CPU, peak RSS and I/O.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    run_parser = sub.add_parser('run', help="Run a command and append its trace record.")
+    run_parser.add_argument('-stage', type=str, required=True, help="The stage name.")
+    run_parser.add_argument('-log', type=str, help="The trace file (default: $ASLSCP_TRACE).")
+    run_parser.add_argument('cmd', nargs=argparse.REMAINDER, help="The command, after '--'.")
+    report_parser = sub.add_parser('report', help="Summarise a trace into timings.json.")
+    report_parser.add_argument('-log', type=str, help="The trace file (default: $ASLSCP_TRACE).")
+    report_parser.add_argument('-out', type=str, required=True, help="The timings.json to write.")
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        cmd = args.cmd[1:] if args.cmd[:1] == ['--'] else args.cmd
+        if not cmd:
+            parser.error("No command given")
+        sys.exit(run_command(args.stage, cmd, args.log))
+
+    log = args.log or trace_file()
+    if not log:
+        parser.error(f"No trace file (-log or ${TRACE_ENV})")
+    report = write_report(log, args.out)
+    for stage, wall, cpu, rss, read, written in summary_rows(report):
+        print(f"{stage:<20} wall {wall:>8}s  cpu {cpu:>8}s  rss {rss:>6}MB  read {read:>6}MB  written {written:>6}MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import numpy as np
+
+import images
+from stage_cache import default_cache_dir, hash_path
+
+# A warm-started registration is kept if its similarity to the template is at most this much below
+# the subject's last full registration (correlation inside the template)
+TOLERANCE = 0.02
+# Bump when the layout of a subject entry changes so old entries are ignored
+STORE_VERSION = 2
+
+
+def default_store_dir():
+    return os.environ.get('ASLSCP_TRANSFORMS', os.path.join(default_cache_dir(), 'transforms'))
+
+
+def subject_label(metadata_file):
+    # Subject of the session from metadata.json, or the "Subject: ..." line of metadata.txt
+    json_file = os.path.join(os.path.dirname(metadata_file), 'metadata.json')
+    try:
+        with open(json_file, 'r') as f:
+            label = json.load(f).get("subject_label")
+    except (OSError, ValueError):
+        label = None
+        try:
+            with open(metadata_file, 'r') as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key.strip() == 'Subject':
+                        label = value.strip()
+        except OSError:
+            pass
+    return None if not label or label == 'Unknown' else label
+
+
+def subject_dir(store_dir, subject):
+    return os.path.join(store_dir, re.sub(r'[^A-Za-z0-9._-]+', '_', subject))
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    hash_path(path, h)
+    return h.hexdigest()
+
+
+def _copy(src, dst):
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def lookup(store_dir, subject, template, out_dir):
+    """Copy the subject's stored affine and moving image into `out_dir`.
+
+    Returns the entry, or None if there is none for this template or it is
+    incomplete (e.g. overwritten by a concurrent session halfway).
+    """
+    folder = subject_dir(store_dir, subject)
+    try:
+        with open(os.path.join(folder, 'entry.json'), 'r') as f:
+            entry = json.load(f)
+        if entry.get("version") != STORE_VERSION or entry.get("template") != file_sha256(template):
+            return None
+        # A prior left by an earlier run of this session may have the other image extension
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.makedirs(out_dir, exist_ok=True)
+        affine = os.path.join(out_dir, 'affine.mat')
+        moving = os.path.join(out_dir, entry["moving"])
+        _copy(os.path.join(folder, 'affine.mat'), affine)
+        _copy(os.path.join(folder, entry["moving"]), moving)
+        # The copies are checked: sessions of the subject saving at once can leave one's affine with the other's image
+        if file_sha256(affine) != entry["affine_sha256"] or file_sha256(moving) != entry["moving_sha256"]:
+            shutil.rmtree(out_dir, ignore_errors=True)
+            return None
+    except (OSError, ValueError, KeyError):
+        shutil.rmtree(out_dir, ignore_errors=True)
+        return None
+    return entry
+
+
+def save(store_dir, subject, template, affine, moving, session, similarity, full):
+    """Store the session's affine and moving image as the subject's warm start.
+
+    A full registration sets the reference similarity warm starts are judged by;
+    a warm-started one keeps the previous reference.
+    """
+    folder = subject_dir(store_dir, subject)
+    os.makedirs(folder, exist_ok=True)
+    reference = similarity
+    if not full:
+        try:
+            with open(os.path.join(folder, 'entry.json'), 'r') as f:
+                reference = json.load(f).get("reference_similarity", similarity)
+        except (OSError, ValueError):
+            pass
+    moving_name = 'moving' + ('.nii.gz' if moving.endswith('.gz') else '.nii')
+    _copy(affine, os.path.join(folder, 'affine.mat'))
+    _copy(moving, os.path.join(folder, moving_name))
+    entry = {"version": STORE_VERSION, "subject": subject, "session": session, "template": file_sha256(template),
+             "moving": moving_name, "affine_sha256": file_sha256(affine),
+             "moving_sha256": file_sha256(moving), "similarity": similarity,
+             "reference_similarity": reference}
+    # entry.json goes last: a reader only trusts the files it describes
+    tmp = os.path.join(folder, f"entry.json.{os.getpid()}.tmp")
+    with open(tmp, 'w') as f:
+        json.dump(entry, f, indent=2)
+    os.replace(tmp, os.path.join(folder, 'entry.json'))
+    return entry
+
+
+def similarity(template, warped):
+    # Correlation of the registered image with the template inside the template's support
+    fixed = images.load(template).get_fdata(dtype=np.float32)
+    moving = images.load(warped).get_fdata(dtype=np.float32)
+    inside = (fixed != 0) & np.isfinite(moving)
+    if inside.sum() < 2:
+        return 0.0
+    return float(np.corrcoef(fixed[inside], moving[inside])[0, 1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Per-subject store of template registrations for warm starts.')
+    parser.add_argument('action', choices=['lookup', 'check', 'save'],
+                        help="lookup: copy the stored prior into -out (exit 1 if none); "
+                             "check: exit 1 if -warped is not good enough for a warm start; save: store this session.")
+    parser.add_argument('-metadata', type=str, help="metadata.txt of the session (the subject is read from it).")
+    parser.add_argument('-template', type=str, help="The registration template.")
+    parser.add_argument('-out', type=str, help="Where lookup puts the prior (affine.mat and the moving image).")
+    parser.add_argument('-affine', type=str, help="The session's affine (save).")
+    parser.add_argument('-moving', type=str, help="The session's moving image (save).")
+    parser.add_argument('-warped', type=str, help="The moving image registered to the template (check/save).")
+    parser.add_argument('-full', action='store_true', help="save: this was a full registration.")
+    parser.add_argument('-tolerance', type=float, default=TOLERANCE, help="check: allowed drop in similarity.")
+    parser.add_argument('-store', type=str, default=None, help="The store directory.")
+    args = parser.parse_args(argv)
+
+    store_dir = args.store or default_store_dir()
+    subject = subject_label(args.metadata) if args.metadata else None
+    if subject is None:
+        print(f"No subject label in {args.metadata}, the registration store is not used")
+        sys.exit(1)
+
+    if args.action == 'lookup':
+        entry = lookup(store_dir, subject, args.template, args.out)
+        if entry is None:
+            print(f"No stored registration for subject {subject}")
+            sys.exit(1)
+        print(f"Warm start from session {entry['session']} of subject {subject}")
+    elif args.action == 'check':
+        try:
+            with open(os.path.join(subject_dir(store_dir, subject), 'entry.json'), 'r') as f:
+                reference = json.load(f)["reference_similarity"]
+        except (OSError, ValueError, KeyError):
+            sys.exit(1)
+        value = similarity(args.template, args.warped)
+        ok = value >= reference - args.tolerance
+        print(f"Warm-started registration similarity {value:.4f} (reference {reference:.4f}): "
+              f"{'kept' if ok else 'rejected'}")
+        sys.exit(0 if ok else 1)
+    else:
+        session = os.path.basename(os.path.dirname(os.path.abspath(args.metadata)))
+        try:
+            with open(os.path.join(os.path.dirname(args.metadata), 'metadata.json'), 'r') as f:
+                session = json.load(f).get("session_label") or session
+        except (OSError, ValueError):
+            pass
+        entry = save(store_dir, subject, args.template, args.affine, args.moving, session,
+                     similarity(args.template, args.warped), args.full)
+        print(f"Stored the registration of subject {subject} (similarity {entry['similarity']:.4f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,89 +1,80 @@
-import sys
 import os
-import logging
 import argparse
 import nibabel as nb
-import shutil
-from nibabel.processing import smooth_image
-import nilearn
-import nilearn.plotting
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
 import numpy as np
 
-parser = argparse.ArgumentParser(description='Take processed images and create visualizations.')
-
-# Set up parser for the CBF file and output directory
-parser.add_argument('-cbf', type=str, help="The path to the CBF file.")
-parser.add_argument('-t1', type=str, help="The path to the qT1 image.")
-parser.add_argument('-mask', type=str, help="The path to the CBF mask.")
-parser.add_argument('-out', type=str, help="The output path.")
-parser.add_argument('-seg_folder', type=str, help="The path to the segmentation files.")
-parser.add_argument('-seg', type=str, nargs='+', help="The list of segmentations to display.")
-
-args = parser.parse_args()
-
-# Load the images
-mcbf_img = args.cbf
-mcbf_nii = nb.load(mcbf_img)
-mcbf_mask = args.mask
-mask_nii = nb.load(mcbf_mask)
-t1_img = args.t1
-t1_nii = nb.load(t1_img)
-outputdir = args.out
-
-img_data  = mcbf_nii.get_fdata(dtype=np.float32)      # or float64 if you prefer
-mask_data = mask_nii.get_fdata(dtype=np.float32)
-
-# ---- Sanity checks ----
-if img_data.shape != mask_data.shape:
-    raise ValueError(
-        f"Shape mismatch: image {img_data.shape} vs mask {mask_data.shape}"
-    )
-
-# ---- Binarise the mask ----
-mask_bool = mask_data > 0     # True inside mask, False outside
-
-# ---- Apply the mask ----
-# voxels outside the mask get `fill_value`
-fill_value = 0.0
-masked_data = np.where(mask_bool, img_data, fill_value).astype(img_data.dtype)
-
-# ---- Re‑create a NIfTI object ----
-# Use the *image*’s affine so you preserve its spatial orientation
-masked_img = nb.Nifti1Image(masked_data, affine=mcbf_nii.affine, header=mcbf_nii.header)
-
-# Take the list of segmentations and loop through for vizualizations
-seg_folder = args.seg_folder
-seg_list = args.seg
-
-for i in seg_list:
-    seg_file = os.path.join(seg_folder + 'w_' + i + '.nii.gz')
-    seg_nii = nb.load(seg_file)
-    seg_name = os.path.basename(seg_file)
-    split = seg_name.split('.')
-    seg = split[0]
-
-    # Plot the mean CBF map with two different vmax
-    nilearn.plotting.plot_roi(seg_nii, masked_img, display_mode='mosaic', black_bg=True, alpha=0.5, cmap="prism", draw_cross=False,
-        vmin=0,vmax=80, cut_coords=8, title="meanCBF_80_segmentation",
-        output_file=os.path.join(outputdir, seg + "_meanCBF_80_mosaic_prism.png"))
-
-
-# Now plot the absolute CBF with discrete scale
-n_colors = 16
-base_cmap = plt.get_cmap('jet')
-color_list = base_cmap(np.linspace(0, 1, n_colors))
-discrete_cmap = ListedColormap(color_list)
-
-nilearn.plotting.plot_stat_map(masked_img, display_mode='mosaic', bg_img=None, black_bg=True, draw_cross=False, cmap=base_cmap,
-        vmin=0, vmax=100, cut_coords=8, title="meanCBF_mosaic", cbar_tick_format="%i",
-        output_file=os.path.join(outputdir, "meanCBF_mosaic.png"))
-
-nilearn.plotting.plot_stat_map(masked_img, display_mode='mosaic', bg_img=None, black_bg=True, draw_cross=False, cmap='gist_yarg_r',
-        vmin=0, vmax=100, cut_coords=8, title="meanCBF_bw", cbar_tick_format="%i",
-        output_file=os.path.join(outputdir, "meanCBF_bw.png"))
-
-nilearn.plotting.plot_stat_map(t1_nii, display_mode='mosaic', bg_img=None, black_bg=True, draw_cross=False, cmap='gist_yarg_r',
-        vmin=0, vmax=100, cut_coords=8, title="meanCBF_bw", cbar_tick_format="%i",
-        output_file=os.path.join(outputdir, "qT1.png"))
+import images
+import threads
+from mosaic import cut_indices, extract_planes, sample_planes, render_all, display_planes
+
+# CBF figures are drawn on a grid of this many mm, smoothed with a Gaussian of SMOOTH mm sigma
+RESOLUTION = 1.0
+SMOOTH = 2.0
+
+
+def cbf_jobs(cbf_nii, mask_nii, seg_folder, seg_list, outputdir, resolution=RESOLUTION, smooth=SMOOTH):
+    """Figure jobs for the segmentation overlays and the CBF mosaics.
+
+    Only the drawn planes of the native CBF are upsampled and smoothed;
+    every figure draws from the same planes.
+    """
+    grid, cuts, planes = display_planes(cbf_nii, mask_nii, resolution, smooth)
+    zooms = (resolution,) * 3
+
+    jobs = []
+    # Take the list of segmentations and loop through for vizualizations
+    for i in seg_list:
+        seg_file = images.work_file(seg_folder, 'w_' + i)
+        seg_nii = images.load(seg_file)
+        seg = os.path.basename(seg_file).split('.')[0]
+        overlay = sample_planes(seg_nii, grid, cuts)
+
+        # Plot the mean CBF map with the segmentation on top
+        jobs.append(dict(planes=planes, overlay=overlay, overlay_max=float(np.max(seg_nii.dataobj)), zooms=zooms,
+                         cmap='gray', vmin=0, vmax=80, title="meanCBF_80_segmentation",
+                         output_file=os.path.join(outputdir, seg + "_meanCBF_80_mosaic_prism.png")))
+
+    # Now plot the absolute CBF
+    jobs.append(dict(planes=planes, zooms=zooms, cmap='jet', vmin=0, vmax=100, title="meanCBF_mosaic",
+                     colorbar=True, cbar_format="%i", output_file=os.path.join(outputdir, "meanCBF_mosaic.png")))
+    jobs.append(dict(planes=planes, zooms=zooms, cmap='gist_yarg_r', vmin=0, vmax=100, title="meanCBF_bw",
+                     colorbar=True, cbar_format="%i", output_file=os.path.join(outputdir, "meanCBF_bw.png")))
+    return jobs
+
+
+def t1_job(t1_nii, outputdir):
+    # qT1 (ms) is sliced on its own grid, file name is the one report.py picks up
+    t1_img = nb.as_closest_canonical(t1_nii)
+    t1_data = t1_img.get_fdata(dtype=np.float32)
+    cuts = cut_indices(t1_data)
+    return dict(planes=extract_planes(t1_data, cuts), zooms=t1_img.header.get_zooms()[:3], cmap='gist_yarg_r',
+                vmin=0, vmax=3000, title="qT1", colorbar=True, cbar_format="%i",
+                output_file=os.path.join(outputdir, "qT1_mosaic.png"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Take processed images and create visualizations.')
+
+    # Set up parser for the CBF file and output directory
+    parser.add_argument('-cbf', type=str, help="The path to the CBF file.")
+    parser.add_argument('-t1', type=str, help="The path to the qT1 image.")
+    parser.add_argument('-mask', type=str, help="The path to the CBF mask.")
+    parser.add_argument('-out', type=str, help="The output path.")
+    parser.add_argument('-seg_folder', type=str, help="The path to the segmentation files.")
+    parser.add_argument('-seg', type=str, nargs='+', help="The list of segmentations to display.")
+    parser.add_argument('-jobs', type=int, default=threads.budget(), help="Number of figures rendered in parallel.")
+    parser.add_argument('-resolution', type=float, default=RESOLUTION, help="Voxel size (mm) the CBF is drawn at.")
+    parser.add_argument('-smooth', type=float, default=SMOOTH, help="Sigma (mm) of the Gaussian smoothing of the CBF.")
+    args = parser.parse_args(argv)
+
+    jobs = cbf_jobs(images.load(args.cbf), images.load(args.mask), args.seg_folder, args.seg, args.out,
+                    args.resolution, args.smooth)
+    if args.t1:
+        jobs.append(t1_job(images.load(args.t1), args.out))
+
+    for output_file in render_all(jobs, args.jobs):
+        print(f"Saved {output_file}")
+
+
+if __name__ == "__main__":
+    main()